@@ -0,0 +1,68 @@
+"""
+Multi-pattern substring search (Aho-Corasick) for the PDF audit.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+The audit checks thousands of unitizer codes against the text of each extrato.
+Testing `code in text` for every code rescans the whole text once per code;
+the automaton is built once over all codes and finds every one of them
+(overlapping or nested in other codes included) in a single pass per text.
+"""
+from collections import deque
+
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        self._goto = [{}] # state -> { char: next state }
+        self._fail = [0]
+        self._out = [()] # state -> patterns ending at this state (suffix matches included)
+
+        for pattern in patterns:
+            if not pattern: continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            if pattern not in self._out[state]:
+                self._out[state] += (pattern,)
+
+        # Breadth-first: the failure link of a state is always shallower than the state
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                link = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = link if link != next_state else 0
+                self._out[next_state] += self._out[self._fail[next_state]]
+
+    def find(self, text):
+        """Returns the set of patterns that occur in `text`."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state or 0
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def find_in_texts(self, texts):
+        """Scans each text once: { pattern: [indexes of the texts containing it] }"""
+        matches = {}
+        for index, text in enumerate(texts):
+            for pattern in self.find(text):
+                matches.setdefault(pattern, []).append(index)
+        return matches
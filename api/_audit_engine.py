@@ -0,0 +1,310 @@
+"""
+The extrato audit, shared by the Vercel function (api/audit_pdf.py) and local_server.py.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+run_audit matches the unitizers of the notas against the extratos and writes
+the matches back. Storage is a backend object, so both entry points get the
+same behavior and every optimization. The engine can also run without the
+network against MemoryBackend, for example to benchmark it.
+
+A backend provides:
+- text_caches(): PDF text caches for scan_texts, fastest first;
+- load_index(): (_meta fields { "complete", "rebuilt_at" }, { code: { nota id: { "item_index",
+  "data_ocorrencia_iso" } } }) from the unitizer index (api/_unitizer_index.py);
+- iter_notas(bounds): (nota id, data_ocorrencia_iso, items) for every nota, or only
+  those with data_ocorrencia_iso in [bounds[0], bounds[1]);
+- get_notas(nota ids): { nota id: items }, notas read together (batch reads);
+- write_itens({ nota id: items }, on_progress): rewrites the notas' itens, each on condition that
+  the nota is still the version iter_notas / get_notas last read; on_progress(written) as writes
+  complete. Returns the set of nota ids whose write failed (a changed nota fails: the engine reads
+  it again with get_notas, applies the matches to it and writes it again);
+- remove_index_entries({ code: [nota ids] }): the matched entries leave the index;
+- rebuild_index(doc_itens, doc_dates): rewrites the index from a full scan and marks it complete,
+  keeping the entries a sync added since load_index.
+Items are dicts with at least "unitizador"; the correios_* fields are the ones the audit writes.
+"""
+import copy
+import re
+import unicodedata
+from datetime import datetime, timedelta
+
+from _aho_corasick import AhoCorasick
+from _pdf_text import scan_texts
+from _unitizer_index import normalize_code, shard_id, index_status, plain_shards, read_plain_entries
+
+WRITE_CONFLICT_ATTEMPTS = 3 # Times a nota that changed under the audit is read again and rewritten
+MESES = ["JANEIRO", "FEVEREIRO", "MARCO", "ABRIL", "MAIO", "JUNHO",
+         "JULHO", "AGOSTO", "SETEMBRO", "OUTUBRO", "NOVEMBRO", "DEZEMBRO"]
+
+
+# -------------------------------------------------------------------------
+# AUDIT DATE WINDOW
+# -------------------------------------------------------------------------
+def parse_ref_month(value):
+    """'Março/2026', '03/2026' or '2026-03' -> (2026, 3); None if not recognized"""
+    if not value: return None
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode().strip().upper()
+    match = re.match(r'^(\d{4})-(\d{1,2})$', value)
+    if match:
+        year, month = int(match.group(1)), int(match.group(2))
+    else:
+        match = re.match(r'^([A-Z]+|\d{1,2})\s*/\s*(\d{4})$', value)
+        if not match: return None
+        name, year = match.group(1), int(match.group(2))
+        month = int(name) if name.isdigit() else (MESES.index(name) + 1 if name in MESES else 0)
+    return (year, month) if 1 <= month <= 12 else None
+
+
+def audit_date_bounds(ref_months, margin_days):
+    """
+    [start, end) of data_ocorrencia_iso for the notes of the audited extratos: from the first
+    day of the earliest month minus margin_days up to the end of the latest month plus margin_days.
+    None if no month is recognized.
+    """
+    months = sorted(m for m in map(parse_ref_month, ref_months) if m)
+    if not months: return None
+
+    (first_year, first_month), (last_year, last_month) = months[0], months[-1]
+    start = datetime(first_year, first_month, 1) - timedelta(days=margin_days)
+    end = datetime(last_year + last_month // 12, last_month % 12 + 1, 1) + timedelta(days=margin_days)
+    return start.strftime("%Y-%m-%dT%H:%M"), end.strftime("%Y-%m-%dT%H:%M")
+
+
+# -------------------------------------------------------------------------
+# AUDIT
+# -------------------------------------------------------------------------
+def match_fields(file_info):
+    """Fields written into an item found in the extrato file_info."""
+    return {
+        "correios_match": True,
+        "correios_ref_month": file_info['month'],
+        "correios_type": file_info['type'],
+        "correios_value": file_info['price']
+    }
+
+
+def apply_matches(items, matches):
+    """
+    Items of one nota with the matches ({ code: match_fields }) applied.
+    Returns (items, changed); an item already matched to the same month is left as is.
+    """
+    changed = False
+    updated = []
+    for item in items:
+        match = matches.get(normalize_code(item.get('unitizador', '')))
+        if match and (item.get('correios_match') is not True
+                      or item.get('correios_ref_month') != match['correios_ref_month']):
+            item = {**item, **match}
+            changed = True
+        updated.append(item)
+    return updated, changed
+
+
+def run_audit(backend, files_to_process, ref_months=(), date_margin_days=None, rebuild_index=False, progress=None,
+              checkpoint=None, pause=None, on_checkpoint=None):
+    """
+    Audits the notas' unitizers against the extratos and writes the matches back.
+    files_to_process: [{ "type", "path", "month", "price" }] (Postal before Densa).
+    ref_months / date_margin_days: optional data_ocorrencia_iso window (audit_date_bounds).
+    progress(phase, **counters): optional callback (api/_audit_jobs.py phases and counters).
+    Returns the response payload.
+
+    An audit too long for one invocation runs in steps (the job worker of api/audit_pdf.py):
+    - pause(): polled while scanning and before writing; once True the audit stops and returns
+      { "status": "paused", "checkpoint" } without writing anything;
+    - on_checkpoint(checkpoint): the state reached, after every scanned range and once the
+      scan is over, so an invocation that is killed can be resumed too;
+    - checkpoint: { "codes", "scan", "scanned" } from a previous step. The scan continues where
+      it stopped (api/_pdf_text.py scan_texts), over the codes of the first step only: codes
+      indexed since then are left for the next audit. The writes are idempotent (apply_matches)
+      and run again in full.
+    """
+    progress = progress or (lambda phase, **counters: None)
+    progress("loading")
+
+    # Optional window: extrato months ± "date_margin_days" on data_ocorrencia_iso.
+    # Notes synced before data_ocorrencia_iso existed do not have it and are left out of windowed audits.
+    bounds = audit_date_bounds(ref_months, int(date_margin_days)) if date_margin_days else None
+
+    # Pending unitizers come from the index while a recent full scan has built it ("rebuild_index" forces a scan)
+    index_meta, entries = backend.load_index()
+    index_state = "rebuild_requested" if rebuild_index else index_status(index_meta)
+    use_index = index_state == "current"
+
+    # Match map: { code: [nota ids] } - the notas to rewrite when a code is found
+    code_notas = {}
+    doc_itens = {} # { nota id: items } - every nota in a full scan, the matched ones otherwise
+    doc_dates = {} # { nota id: data_ocorrencia_iso }
+
+    if use_index:
+        for code, notas in entries.items():
+            if bounds:
+                notas = {doc_id: entry for doc_id, entry in notas.items()
+                         if entry['data_ocorrencia_iso'] and bounds[0] <= entry['data_ocorrencia_iso'] < bounds[1]}
+            if notas: code_notas[code] = list(notas)
+    else:
+        for doc_id, data_iso, items in backend.iter_notas(bounds):
+            doc_dates[doc_id] = data_iso
+            doc_itens[doc_id] = items
+            for item in items:
+                code = normalize_code(item.get('unitizador', ''))
+                if not code: continue
+                notas = code_notas.setdefault(code, [])
+                if not notas or notas[-1] != doc_id: notas.append(doc_id)
+
+    if checkpoint:
+        codes = set(checkpoint['codes'])
+        code_notas = {code: notas for code, notas in code_notas.items() if code in codes}
+    else:
+        checkpoint = {"codes": list(code_notas), "scan": None, "scanned": False}
+    save = on_checkpoint or (lambda checkpoint: None)
+
+    # One automaton over every code; the extratos are extracted page range by page range and the
+    # search stops once every code is found (api/_pdf_text.py). Last file first: a code found in
+    # both extratos keeps the last file's data (Densa over Postal).
+    scan_order = files_to_process[::-1]
+    progress("scanning", codes_total=len(code_notas))
+    if checkpoint['scanned']:
+        found, pages_read = checkpoint['scan']['found'], checkpoint['scan']['pages_read']
+    else:
+        found, pages_read, position = scan_texts(
+            [file_info['path'] for file_info in scan_order],
+            AhoCorasick(code_notas.keys()), code_notas.keys(),
+            caches=backend.text_caches(),
+            on_progress=lambda pages, codes: progress("scanning", pages_read=pages, codes_found=codes),
+            resume=checkpoint['scan'], stop=pause,
+            on_position=lambda position: save({**checkpoint, "scan": position})
+        )
+        if position:
+            return {"status": "paused", "checkpoint": {**checkpoint, "scan": position}}
+        checkpoint = {**checkpoint, "scan": {"found": found, "pages_read": pages_read}, "scanned": True}
+        save(checkpoint)
+    if pause and pause():
+        return {"status": "paused", "checkpoint": checkpoint}
+    matches = {code: match_fields(scan_order[file_index]) for code, file_index in found.items()}
+
+    # Rewrite the notas holding a matched unitizer
+    progress("writing", pages_read=pages_read, codes_found=len(matches), docs_written=0)
+    matched_notas = list(dict.fromkeys(doc_id for code in matches for doc_id in code_notas[code]))
+    if use_index:
+        doc_itens.update(backend.get_notas(matched_notas))
+
+    updates = {}
+    for doc_id in matched_notas:
+        if doc_id not in doc_itens: continue # Deleted since it was indexed
+        items, changed = apply_matches(doc_itens[doc_id], matches)
+        if changed: updates[doc_id] = items
+
+    failed_notas = backend.write_itens(updates, lambda written: progress("writing", docs_written=written))
+    # A nota changed since it was read (a sync, the frontend) fails the write's precondition:
+    # it is read again and the matches are applied to what it holds now
+    for _ in range(WRITE_CONFLICT_ATTEMPTS):
+        if not failed_notas: break
+        current = backend.get_notas(failed_notas)
+        retry = {}
+        for doc_id in failed_notas:
+            if doc_id in current:
+                doc_itens[doc_id] = current[doc_id]
+                items, changed = apply_matches(current[doc_id], matches)
+                if changed:
+                    retry[doc_id] = updates[doc_id] = items
+                    continue
+            del updates[doc_id] # Deleted meanwhile, or nothing left to write
+        written = len(updates) - len(retry)
+        failed_notas = backend.write_itens(retry, lambda count: progress("writing", docs_written=written + count))
+    for doc_id, items in updates.items():
+        if doc_id not in failed_notas: doc_itens[doc_id] = items # The index sees what was written
+    docs_updated = len(updates) - len(failed_notas)
+
+    # Unitizer index
+    progress("indexing", docs_written=docs_updated)
+    if use_index:
+        # Matched codes are no longer pending; a nota whose write failed keeps its entries
+        backend.remove_index_entries({code: [doc_id for doc_id in code_notas[code] if doc_id not in failed_notas]
+                                      for code in matches})
+        unitizer_index = "used"
+    elif not bounds:
+        # A full scan saw every nota: rewrite the index from scratch
+        backend.rebuild_index(doc_itens, doc_dates)
+        unitizer_index = "rebuilt"
+    else:
+        unitizer_index = "not_used"
+
+    missing_codes = sorted(code_notas.keys() - matches.keys())
+    return {
+        "status": "success",
+        "found_count": len(matches),
+        "missing_count": len(missing_codes),
+        "total_processed": len(code_notas),
+        "docs_updated": docs_updated,
+        "docs_failed": len(failed_notas),
+        "missing_codes": missing_codes,
+        "scan_mode": "index" if use_index else "full",
+        "index_status": index_state,
+        "unitizer_index": unitizer_index,
+        "pages_read": pages_read
+    }
+
+
+# -------------------------------------------------------------------------
+# IN-MEMORY BACKEND
+# -------------------------------------------------------------------------
+class MemoryBackend:
+    """
+    Notas and index kept in dicts: { nota id: { "itens": [...], "data_ocorrencia_iso": ... } }.
+    Runs the engine without a database (benchmarks, local experiments).
+    A nota whose "itens" list was replaced since the engine read it is not written (the
+    updateTime precondition of the Firestore backends); writers outside the engine replace it.
+    """
+    def __init__(self, notas, caches=()):
+        self.notas = notas
+        self.index = None # { shard id: { code: { nota id: entry } } } once rebuilt
+        self.index_meta = {} # _meta fields: { "complete", "rebuilt_at" }
+        self.caches = list(caches)
+        self.versions = {} # { nota id: the itens list as last read }
+
+    def text_caches(self):
+        return self.caches
+
+    def load_index(self):
+        if self.index is None: return {}, {}
+        return self.index_meta, read_plain_entries({"codes": codes} for codes in self.index.values())
+
+    def iter_notas(self, bounds):
+        for doc_id, nota in self.notas.items():
+            data_iso = nota.get('data_ocorrencia_iso')
+            if bounds and not (data_iso and bounds[0] <= data_iso < bounds[1]): continue
+            self.versions[doc_id] = nota.get('itens')
+            yield doc_id, data_iso, copy.deepcopy(nota.get('itens', []))
+
+    def get_notas(self, doc_ids):
+        notas = {}
+        for doc_id in doc_ids:
+            if doc_id not in self.notas: continue
+            self.versions[doc_id] = self.notas[doc_id].get('itens')
+            notas[doc_id] = copy.deepcopy(self.notas[doc_id].get('itens', []))
+        return notas
+
+    def write_itens(self, itens_by_nota, on_progress=None):
+        failed = set()
+        written = 0
+        for doc_id, items in itens_by_nota.items():
+            nota = self.notas.get(doc_id)
+            if nota is None or nota.get('itens') is not self.versions.get(doc_id):
+                failed.add(doc_id) # Deleted or changed since it was read
+                continue
+            nota['itens'] = self.versions[doc_id] = items
+            written += 1
+            if on_progress: on_progress(written)
+        return failed
+
+    def remove_index_entries(self, code_notas):
+        for code, doc_ids in code_notas.items():
+            codes = (self.index or {}).get(shard_id(code), {})
+            for doc_id in doc_ids:
+                codes.get(code, {}).pop(doc_id, None)
+            if code in codes and not codes[code]: del codes[code]
+
+    def rebuild_index(self, doc_itens, doc_dates):
+        self.index = plain_shards(doc_itens, doc_dates)
+        self.index_meta = {"complete": True, "rebuilt_at": datetime.utcnow().isoformat() + "Z"}
@@ -0,0 +1,336 @@
+"""
+Asynchronous audit jobs (audit_pdf "job" mode and local_server's runner).
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+A job is created with the uploaded extratos and answered with a job id right away;
+a worker runs the audit later and reports its progress. Both stores below keep
+the same status and result-page shapes (job_status / result_page), so the
+clients poll local and serverless jobs the same way.
+
+- FirestoreJobStore: tb_auditoria_jobs/<job id> holds the parameters, phase and
+  counters; the missing codes are stored in pages under
+  tb_auditoria_jobs/<job id>/resultados/<page>. The PDFs go to the Firebase
+  Storage bucket (StorageUploads). A worker claims the job with a lease, so a
+  second trigger does not run it twice and a dead worker's job can be retaken.
+  A worker runs one step of the audit, bounded by the function's maxDuration: an
+  audit that does not fit is left "paused" with a checkpoint, and the client
+  triggers the worker again to resume it (same run URL). The checkpoint is also
+  saved while scanning, so a step killed by the timeout resumes from its last save
+  once the lease expires. Its codes and the codes found so far are stored in pages
+  under tb_auditoria_jobs/<job id>/checkpoint/<page> (an audit can have more codes
+  than fit in the job document's 1 MiB); the job document keeps the scan position.
+- LocalJobRunner: in-memory jobs run on threads (local_server.py).
+"""
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from _firestore_codec import encode_fields, encode_value, decode_fields, decode_value
+
+JOBS_COLLECTION = "tb_auditoria_jobs"
+RESULTS_SUBCOLLECTION = "resultados"
+CHECKPOINT_SUBCOLLECTION = "checkpoint"
+RESULT_PAGE_SIZE = 1000 # Missing codes per result page (and codes per checkpoint page)
+JOB_MAX_DURATION_SECONDS = int(os.environ.get('AUDIT_MAX_DURATION_SECONDS', 300)) # maxDuration of api/audit_pdf.py (vercel.json)
+JOB_STEP_MARGIN_SECONDS = 60 # Left at the end of a step for the writes, the index and the checkpoint
+JOB_LEASE_SECONDS = JOB_MAX_DURATION_SECONDS + 30 # A worker never outlives its invocation: its job can then be claimed again
+PROGRESS_INTERVAL_SECONDS = 2 # Minimum time between progress writes (phase changes are always written)
+CHECKPOINT_INTERVAL_SECONDS = 15 # Minimum time between checkpoint writes while scanning
+STORAGE_PREFIX = "auditoria_jobs"
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+PHASES = ("queued", "loading", "scanning", "writing", "indexing", "paused", "done", "error")
+COUNTERS = ("pages_read", "codes_total", "codes_found", "docs_written")
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def _utcnow():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def job_status(job_id, job):
+    """Status payload of a job (job: the dict kept by either store)."""
+    status = {"job_id": job_id, "phase": job.get('phase', 'queued')}
+    for counter in COUNTERS:
+        status[counter] = job.get(counter, 0)
+    status['error'] = job.get('error')
+    status['result'] = job.get('result') # Summary, without the missing codes
+    status['result_pages'] = job.get('result_pages', 0)
+    status['updated_at'] = job.get('updated_at')
+    return status
+
+
+def result_summary(result):
+    """(summary, missing codes) of an audit response."""
+    summary = {k: v for k, v in result.items() if k != 'missing_codes'}
+    return summary, result.get('missing_codes', [])
+
+
+def result_page(job_id, codes, page):
+    pages = max(1, -(-len(codes) // RESULT_PAGE_SIZE))
+    return {
+        "job_id": job_id,
+        "page": page,
+        "pages": pages,
+        "missing_codes": codes[page * RESULT_PAGE_SIZE:(page + 1) * RESULT_PAGE_SIZE]
+    }
+
+
+class ProgressReporter:
+    """progress(phase, **counters) callback for run_audit, throttled to PROGRESS_INTERVAL_SECONDS."""
+    def __init__(self, write):
+        self.write = write
+        self.phase = None
+        self.counters = {}
+        self.last_write = 0
+
+    def __call__(self, phase, **counters):
+        self.counters.update(counters)
+        now = time.monotonic()
+        if phase == self.phase and now - self.last_write < PROGRESS_INTERVAL_SECONDS:
+            return
+        self.phase = phase
+        self.last_write = now
+        self.write(phase, dict(self.counters))
+
+
+class CheckpointSaver:
+    """on_checkpoint callback for run_audit: saves at most every CHECKPOINT_INTERVAL_SECONDS; a finished scan at once."""
+    def __init__(self, write):
+        self.write = write
+        self.last_write = time.monotonic()
+
+    def __call__(self, checkpoint):
+        now = time.monotonic()
+        if not checkpoint['scanned'] and now - self.last_write < CHECKPOINT_INTERVAL_SECONDS:
+            return
+        self.last_write = now
+        self.write(checkpoint)
+
+
+# -------------------------------------------------------------------------
+# SERVERLESS: FIRESTORE + FIREBASE STORAGE
+# -------------------------------------------------------------------------
+class StorageUploads:
+    """Job PDFs in the Firebase Storage bucket (Cloud Storage JSON API)."""
+    def __init__(self, auth, bucket):
+        self.auth = auth
+        self.bucket = bucket
+
+    def _request(self, method, url, **kwargs):
+        from _http_client import authorized_request # Lazy: requests is only needed by the serverless jobs
+        return authorized_request(self.auth, method, url, **kwargs)
+
+    def _object_url(self, name):
+        return f"https://storage.googleapis.com/storage/v1/b/{self.bucket}/o/{quote(name, safe='')}"
+
+    def put(self, name, path):
+        url = f"https://storage.googleapis.com/upload/storage/v1/b/{self.bucket}/o"
+        from _http_client import request_with_retry
+        headers = {**self.auth.get(), "Content-Type": "application/pdf"} # The object's content type
+        # Streamed from the spooled file, reopened for every attempt (never held in memory)
+        response = request_with_retry('POST', url, params={"uploadType": "media", "name": name},
+                                      open_body=lambda: open(path, 'rb'), headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"Storage UPLOAD Error {response.status_code}: {response.text}")
+
+    def get(self, name, directory=None):
+        """Downloads the object to a temp file; returns its path."""
+        response = self._request('GET', self._object_url(name), params={"alt": "media"}, stream=True)
+        try:
+            if response.status_code != 200:
+                raise Exception(f"Storage DOWNLOAD Error {response.status_code}")
+            fd, path = tempfile.mkstemp(suffix=".pdf", dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    f.write(chunk)
+            return path
+        finally:
+            response.close()
+
+    def delete(self, name):
+        response = self._request('DELETE', self._object_url(name))
+        if response.status_code not in (200, 204, 404):
+            print(f"Aviso: PDF do job nao removido ({response.status_code})")
+
+
+class FirestoreJobStore:
+    """
+    Jobs in tb_auditoria_jobs. db: audit_pdf's FirestoreClient (commit / batch_get).
+    Job documents: phase, counters, params (dict), files ([{type, month, price, object}]),
+    worker, lease_until, checkpoint ({scan, scanned, pages}: the scan position, between steps),
+    error, result (summary), result_pages, created_at, updated_at.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.saved_pages = {} # { (job id, page): codes found } of the checkpoint pages written or read
+
+    def _name(self, job_id, *path):
+        return "/".join([self.db.documents_path, JOBS_COLLECTION, job_id, *path])
+
+    def _write(self, job_id, fields, precondition=None):
+        write = {
+            "update": {"name": self._name(job_id), "fields": encode_fields(fields)},
+            "updateMask": {"fieldPaths": list(fields)}
+        }
+        if precondition: write['currentDocument'] = precondition
+        return write
+
+    def create(self, job_id, params, files):
+        fields = {"phase": "queued", "params": params, "files": files, "created_at": _utcnow(), "updated_at": _utcnow()}
+        write = self._write(job_id, fields, {"exists": False})
+        if self.db.commit([write]):
+            raise Exception("Firestore JOB Error: job nao criado")
+
+    def get(self, job_id):
+        """(job dict, updateTime) or (None, None)."""
+        doc = self.db.batch_get(JOBS_COLLECTION, [job_id]).get(job_id)
+        if not doc: return None, None
+        return decode_fields(doc.get('fields', {})), doc.get('updateTime')
+
+    def claim(self, job_id, worker_id):
+        """Takes the job for worker_id if it is queued, paused or its lease expired. Returns the job or None."""
+        job, update_time = self.get(job_id)
+        if not job: return None
+        if job['phase'] in ("done", "error"): return None
+        if job['phase'] not in ("queued", "paused") and job.get('lease_until', '') > _utcnow(): return None
+        lease_until = (datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat() + "Z"
+        write = self._write(job_id, {"phase": "loading", "worker": worker_id, "lease_until": lease_until,
+                                     "updated_at": _utcnow()},
+                            {"updateTime": update_time}) # Lost race: another worker claimed it first
+        if self.db.commit([write]): return None
+        return job
+
+    def progress(self, job_id, phase, counters):
+        self.db.commit([self._write(job_id, {"phase": phase, **counters, "updated_at": _utcnow()})])
+
+    def checkpoint(self, job_id, job):
+        """run_audit checkpoint of a claimed job, read back from its pages (None before the first save)."""
+        saved = job.get('checkpoint')
+        if not saved: return None
+        pages = [str(page) for page in range(saved['pages'])]
+        docs = self.db.batch_get(f"{JOBS_COLLECTION}/{job_id}/{CHECKPOINT_SUBCOLLECTION}", pages)
+        codes, found = [], {}
+        for page in pages:
+            if not docs.get(page):
+                raise Exception(f"Firestore JOB Error: pagina {page} do checkpoint nao encontrada")
+            fields = decode_fields(docs[page].get('fields', {}))
+            codes += fields['codes']
+            found.update(fields['found'])
+            self.saved_pages[(job_id, int(page))] = len(fields['found'])
+        scan = {**saved['scan'], "found": found} if saved['scan'] else None
+        return {"codes": codes, "scan": scan, "scanned": saved['scanned']}
+
+    def _save_checkpoint(self, job_id, checkpoint, fields):
+        """
+        Writes the pages of the checkpoint that changed since the last save, then the job document
+        (fields, and the checkpoint without its codes). Pages first: the job document never points
+        past the codes found that are stored.
+        """
+        codes = checkpoint['codes']
+        found = (checkpoint['scan'] or {}).get('found', {})
+        pages = -(-len(codes) // RESULT_PAGE_SIZE)
+        writes, written = [], {}
+        for page in range(pages):
+            page_codes = codes[page * RESULT_PAGE_SIZE:(page + 1) * RESULT_PAGE_SIZE]
+            page_found = {code: found[code] for code in page_codes if code in found}
+            if self.saved_pages.get((job_id, page)) == len(page_found): continue # Codes are fixed, found only grows
+            writes.append({"update": {"name": self._name(job_id, CHECKPOINT_SUBCOLLECTION, str(page)),
+                                      "fields": encode_fields({"codes": page_codes, "found": page_found})}})
+            written[(job_id, page)] = len(page_found)
+        if writes and self.db.commit(writes):
+            raise Exception("Firestore JOB Error: checkpoint nao gravado")
+        self.saved_pages.update(written)
+
+        scan = {k: v for k, v in checkpoint['scan'].items() if k != 'found'} if checkpoint['scan'] else None
+        job_checkpoint = {"scan": scan, "scanned": checkpoint['scanned'], "pages": pages}
+        if self.db.commit([self._write(job_id, {**fields, "checkpoint": job_checkpoint, "updated_at": _utcnow()})]):
+            raise Exception("Firestore JOB Error: checkpoint nao gravado")
+
+    def save_checkpoint(self, job_id, checkpoint):
+        self._save_checkpoint(job_id, checkpoint, {})
+
+    def pause(self, job_id, checkpoint):
+        """End of a step: the job keeps its checkpoint and can be claimed at once by the next trigger."""
+        self._save_checkpoint(job_id, checkpoint, {"phase": "paused", "lease_until": _utcnow()})
+
+    def finish(self, job_id, result):
+        summary, codes = result_summary(result)
+        pages = max(1, -(-len(codes) // RESULT_PAGE_SIZE))
+        writes = [
+            {"update": {"name": self._name(job_id, RESULTS_SUBCOLLECTION, str(page)), "fields": {
+                "missing_codes": encode_value(codes[page * RESULT_PAGE_SIZE:(page + 1) * RESULT_PAGE_SIZE])
+            }}}
+            for page in range(pages)
+        ]
+        job, _ = self.get(job_id)
+        saved = (job or {}).get('checkpoint') or {}
+        writes += [{"delete": self._name(job_id, CHECKPOINT_SUBCOLLECTION, str(page))}
+                   for page in range(saved.get('pages', 0))]
+        # Job document last: "done" is only visible once every page is written
+        writes.append(self._write(job_id, {"phase": "done", "result": summary, "result_pages": pages,
+                                           "checkpoint": None, "updated_at": _utcnow()}))
+        if self.db.commit(writes):
+            raise Exception("Firestore JOB Error: resultado nao gravado")
+
+    def fail(self, job_id, error):
+        self.db.commit([self._write(job_id, {"phase": "error", "error": str(error), "updated_at": _utcnow()})])
+
+    def result_page(self, job_id, page):
+        doc = self.db.batch_get(f"{JOBS_COLLECTION}/{job_id}/{RESULTS_SUBCOLLECTION}", [str(page)]).get(str(page))
+        job, _ = self.get(job_id)
+        codes = decode_value(doc['fields']['missing_codes']) if doc else []
+        return {"job_id": job_id, "page": page, "pages": (job or {}).get('result_pages', 0), "missing_codes": codes}
+
+
+# -------------------------------------------------------------------------
+# LOCAL: THREADS
+# -------------------------------------------------------------------------
+class LocalJobRunner:
+    """Runs jobs on background threads of this process; same status/result shapes as the Firestore jobs."""
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, work):
+        """work(progress) -> audit response dict. Returns the job id."""
+        job_id = new_job_id()
+        with self.lock:
+            self.jobs[job_id] = {"phase": "queued", "created_at": _utcnow(), "updated_at": _utcnow()}
+
+        def write(phase, counters):
+            with self.lock:
+                self.jobs[job_id].update(counters, phase=phase, updated_at=_utcnow())
+
+        def run():
+            try:
+                result = work(ProgressReporter(write))
+                summary, codes = result_summary(result)
+                with self.lock:
+                    self.jobs[job_id].update(phase="done", result=summary, codes=codes, updated_at=_utcnow(),
+                                             result_pages=max(1, -(-len(codes) // RESULT_PAGE_SIZE)))
+            except Exception as e:
+                print(f"❌ Erro no job {job_id}: {e}")
+                with self.lock:
+                    self.jobs[job_id].update(phase="error", error=str(e), updated_at=_utcnow())
+
+        threading.Thread(target=run, daemon=True).start()
+        return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job_status(job_id, job) if job else None
+
+    def result_page(self, job_id, page):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job or job['phase'] != "done": return None
+            return result_page(job_id, job['codes'], page)
@@ -0,0 +1,141 @@
+"""
+Bounded-concurrency bulk writes for the Firestore REST clients in api/.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+The audit can rewrite thousands of notas at the end of the month; one blocking
+PATCH per nota made the write phase take minutes. BulkWriter groups the writes
+into documents:batchWrite calls (BULK_WRITE_BATCH_SIZE writes, at most
+BULK_WRITE_MAX_BYTES of JSON each), keeps BULK_WRITE_WORKERS of them in flight
+and paces them with a token bucket of BULK_WRITE_OPS_PER_SECOND document writes
+(Firestore's recommended starting rate for a new write load).
+
+batchWrite applies every write on its own and answers one status per write,
+so a write that fails with a transient code (aborted, unavailable...) is
+retried by itself, with backoff, up to BULK_WRITE_MAX_ATTEMPTS times.
+Writes are not atomic across documents.
+"""
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+BATCH_WRITE_MAX_WRITES = 500 # Firestore limit of writes per batchWrite
+BULK_WRITE_BATCH_SIZE = 100 # itens arrays are large: keeps each request far below the 10 MiB limit
+BULK_WRITE_MAX_BYTES = 8 * 1024 * 1024
+BULK_WRITE_WORKERS = int(os.environ.get('BULK_WRITE_WORKERS', 4))
+BULK_WRITE_OPS_PER_SECOND = int(os.environ.get('BULK_WRITE_OPS_PER_SECOND', 500))
+BULK_WRITE_MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 1
+# google.rpc.Code values worth retrying: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+RETRYABLE_CODES = (4, 8, 10, 13, 14)
+RETRYABLE_HTTP_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire(n) blocks until n tokens are available."""
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        count = min(count, self.capacity) # A batch larger than the bucket waits for a full bucket
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = (count - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BulkWriter:
+    """
+    request(method, url, **kwargs): the client's authorized request (FirestoreClient._request).
+    base_url: the client's .../documents URL.
+    """
+    def __init__(self, request, base_url, workers=None, ops_per_second=None):
+        self.request = request
+        self.url = f"{base_url}:batchWrite"
+        self.workers = workers or BULK_WRITE_WORKERS
+        self.bucket = TokenBucket(ops_per_second or BULK_WRITE_OPS_PER_SECOND)
+
+    def _batches(self, writes):
+        batch, size = [], 0
+        for write in writes:
+            write_size = len(json.dumps(write))
+            if batch and (len(batch) >= min(BULK_WRITE_BATCH_SIZE, BATCH_WRITE_MAX_WRITES)
+                          or size + write_size > BULK_WRITE_MAX_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(write)
+            size += write_size
+        if batch:
+            yield batch
+
+    def _send(self, batch):
+        """[(write, None or (error message, retryable))] for one batchWrite call."""
+        self.bucket.acquire(len(batch))
+        try:
+            response = self.request('POST', self.url, json={"writes": batch})
+        except Exception as e:
+            return [(write, (f"Firestore BATCHWRITE Error: {e}", True)) for write in batch]
+        if response.status_code != 200:
+            error = (f"Firestore BATCHWRITE Error {response.status_code}: {response.text}",
+                     response.status_code in RETRYABLE_HTTP_STATUS)
+            return [(write, error) for write in batch]
+
+        statuses = response.json().get('status', [])
+        results = []
+        for index, write in enumerate(batch):
+            if index >= len(statuses):
+                # A write the response has no status for was not confirmed: failed, retried
+                results.append((write, (f"Firestore BATCHWRITE Error: sem status ({len(statuses)} de {len(batch)})", True)))
+                continue
+            status = statuses[index]
+            code = status.get('code', 0)
+            if code:
+                results.append((write, (f"Firestore BATCHWRITE Error {code}: {status.get('message', '')}",
+                                        code in RETRYABLE_CODES)))
+            else:
+                results.append((write, None))
+        return results
+
+    def write(self, writes, on_progress=None):
+        """
+        Applies the writes (documents:commit write objects, one per document).
+        on_progress(documents written): optional, called as batches complete.
+        Returns: list of failures [{ "name", "error" }] (after the retries).
+        """
+        pending = list(writes)
+        failures = {}
+        written = 0
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for attempt in range(BULK_WRITE_MAX_ATTEMPTS):
+                if not pending: break
+                if attempt:
+                    # Full jitter, as the per-request retries in _http_client
+                    time.sleep(random.uniform(0, RETRY_BACKOFF_SECONDS * (2 ** attempt)))
+                retry = []
+                futures = [pool.submit(self._send, batch) for batch in self._batches(pending)]
+                for future in as_completed(futures):
+                    for write, error in future.result():
+                        name = write.get('update', {}).get('name') or write.get('delete')
+                        if error is None:
+                            written += 1
+                            failures.pop(name, None)
+                            continue
+                        failures[name] = error[0]
+                        if error[1]: retry.append(write)
+                    if on_progress: on_progress(written)
+                pending = retry
+
+        return [{"name": name, "error": error} for name, error in failures.items()]
@@ -0,0 +1,295 @@
+"""
+Table extractor for the TIM "Nota de Despacho" e-mails read by sync_emails.py.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+parse_email_html only reads table rows and cells: the text of each cell, once as
+str() for limpar_html and once with its <br> replaced by a separator. Instead of a
+tree, parse_tables keeps one flat list of rendered pieces and the spans of the
+table, tr, td, th and br elements; other tags only take part in the open-element
+stack. Spans follow BeautifulSoup's html.parser tree: no implicit closing, an end
+tag closes up to the nearest open element with that name, void elements are closed
+at once (and bs4 ignores one later end tag of theirs), entities decoded like bs4.
+
+Markup outside the Outlook subset (unusual tag syntax, processing instructions,
+CDATA, template/ruby elements, a <br> left open around table cells...) raises
+UnsupportedMarkup: the caller parses that e-mail with BeautifulSoup instead.
+"""
+import re
+from bisect import bisect_left, bisect_right
+
+from bs4.dammit import EntitySubstitution
+
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+    'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr'
+])
+RAW_TEXT_ELEMENTS = frozenset(['script', 'style']) # Content is not parsed (html.parser CDATA mode)
+PLAIN_TEXT_ELEMENTS = frozenset(['title', 'textarea']) # Supported while their content has no markup
+UNSUPPORTED_ELEMENTS = frozenset([
+    'template', 'rt', 'rp', # bs4 gives their strings special types
+    'xmp', 'iframe', 'noembed', 'noframes', 'noscript', 'plaintext' # Raw text in newer html.parser versions
+])
+SPECIAL_ELEMENTS = RAW_TEXT_ELEMENTS | PLAIN_TEXT_ELEMENTS | UNSUPPORTED_ELEMENTS
+TABLE_ELEMENTS = frozenset(['table', 'tr', 'td', 'th'])
+LIST_SEPARATOR = ' ||| ' # What a <br> is replaced by in list_text()
+
+# Markup tokens; the text between them is a run of character data.
+# Groups: 1 start tag name, 2 "/" of <tag/> | 3 end tag name | 4 comment | otherwise a "<" of anything else.
+# The start tag branch is a strict subset of html.parser's tolerant grammar.
+_token = re.compile(r'''
+    <([a-zA-Z][^\s/>\x00]*)(?=[\t\n\r\f\ />])
+    (?:[\t\n\r\f\ ]+[^\s/>"'=<][^\s/=>"'<]*
+        (?:[\t\n\r\f\ ]*=[\t\n\r\f\ ]*(?:"[^"]*"|'[^']*'|[^\s>"'=][^\s>]*))?
+    )*
+    [\t\n\r\f\ ]*(/?)>
+  | </\s*([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>
+  | <!--(?!>|->)((?s:.*?))--\s*>
+  | <
+''', re.VERBOSE)
+# Entity and character references of a run (a run ends before a "<"); groups: 1 entity name | 2 number
+_reference = re.compile(r'&(?:([a-zA-Z][-.a-zA-Z0-9]*)(?=[^a-zA-Z0-9]|$);?|#([0-9]+|[xX][0-9a-fA-F]+)(?=[^0-9a-fA-F]|$);?|(?=[a-zA-Z#]))')
+_ms_section = re.compile(r'<!\[(?i:if|else|endif)(?![-_.a-zA-Z0-9])\s*([^<>]*?)\]\s*>')
+_end_tag_patterns = {}
+
+
+class UnsupportedMarkup(Exception):
+    pass
+
+
+class Cell:
+    """A td / th: its span [start, end] of the document's pieces."""
+    __slots__ = ('document', 'start', 'end')
+
+    def __init__(self, document, start, end):
+        self.document = document
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        """The cell as markup (tags without their attributes), as limpar_html reads it."""
+        return ''.join(self.document.pieces[self.start:self.end + 1])
+
+    def list_text(self):
+        """get_text(separator=' ', strip=True) once every <br> of the cell is replaced by LIST_SEPARATOR."""
+        document = self.document
+        pieces, texts, brs = document.pieces, document.texts, document.brs
+        lo = bisect_right(document.br_starts, self.start)
+        hi = bisect_left(document.br_starts, self.end, lo)
+        for index in range(lo, hi):
+            start, end = brs[index]
+            if start in document.detached: continue
+            # As bs4's replace_with: what the <br> held leaves the cell, with the <br> inside it
+            pieces[start] = texts[start] = LIST_SEPARATOR
+            for position in range(start + 1, end + 1):
+                pieces[position], texts[position] = '', None
+            document.detached.update(document.br_starts[index + 1:bisect_left(document.br_starts, end, index + 1)])
+        return ' '.join(filter(None, map(str.strip, filter(None, texts[self.start + 1:self.end]))))
+
+
+class Tables:
+    """
+    pieces: every token rendered ('<td>', '</td>', escaped text, '<!--...-->'...), in document order.
+    texts: the decoded strings get_text reads, None for the other pieces.
+    Element spans [start, end] are indexes of their start and end tags in pieces.
+    """
+    def __init__(self):
+        self.pieces = []
+        self.texts = []
+        self.tables = []
+        self.rows = []
+        self.cells = []
+        self.brs = []
+        self.br_starts = []
+        self.detached = set() # Starts of the <br> replaced along with an enclosing one
+
+    def table_rows(self):
+        """For every table, then every tr inside it (nested tables' rows too, as find_all): its td / th cells."""
+        row_starts = [row[0] for row in self.rows]
+        cell_starts = [cell[0] for cell in self.cells]
+        for table_start, table_end in self.tables:
+            lo = bisect_right(row_starts, table_start)
+            for row_start, row_end in self.rows[lo:bisect_left(row_starts, table_end, lo)]:
+                first = bisect_right(cell_starts, row_start)
+                yield [Cell(self, start, end) for start, end in self.cells[first:bisect_left(cell_starts, row_end, first)]]
+
+
+def _decode_charref(number):
+    # Same as bs4: code points below 256 are read as windows-1252 first
+    number = int(number[1:], 16) if number[:1] in ('x', 'X') else int(number)
+    data = None
+    if number < 256:
+        try:
+            data = bytearray([number]).decode('windows-1252')
+        except UnicodeDecodeError:
+            pass
+    if not data:
+        try:
+            data = chr(number)
+        except (ValueError, OverflowError):
+            pass
+    return data or "\N{REPLACEMENT CHARACTER}"
+
+
+def _decode_reference(match, entities=EntitySubstitution.HTML_ENTITY_TO_CHARACTER):
+    if match[1]:
+        character = entities.get(match[1])
+        return character if character is not None else '&' + match[1]
+    if match[2]:
+        return _decode_charref(match[2])
+    raise UnsupportedMarkup('reference')
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _end_tag_pattern(name):
+    pattern = _end_tag_patterns.get(name)
+    if pattern is None:
+        pattern = _end_tag_patterns[name] = re.compile(r'</\s*%s\s*>' % name, re.I)
+    return pattern
+
+
+def parse_tables(markup):
+    """Tables of an e-mail body. Raises UnsupportedMarkup for markup outside the modelled subset."""
+    tables = Tables()
+    pieces, texts = tables.pieces, tables.texts
+    spans = {'table': tables.tables, 'tr': tables.rows, 'td': tables.cells, 'th': tables.cells, 'br': tables.brs}
+    names = [] # Open elements, innermost last
+    open_spans = [] # Their spans (None for the elements not kept)
+    closed_void = {} # End tags bs4 ignores for void elements already closed { name: count }
+    text = '' # Character data of the current string
+    last_table_element = -1 # Start of the last table / tr / td / th
+
+    def end(name):
+        # Closes the open elements up to the innermost one named `name`
+        while True:
+            element, span = names.pop(), open_spans.pop()
+            if span:
+                span[1] = len(pieces)
+                if element == 'br' and last_table_element > span[0]: raise UnsupportedMarkup('table inside <br>')
+            pieces.append('</' + element + '>')
+            texts.append(None)
+            if element == name: return
+
+    def end_data(text):
+        texts.append(text)
+        pieces.append(_escape(text) if '&' in text or '<' in text or '>' in text else text)
+
+    position = 0
+    while True:
+        last = position
+        # Hot path: one iteration per token (a run of text is what lies between two tokens),
+        # with end_data() and the usual end() inlined
+        for match in _token.finditer(markup, position):
+            start = match.start()
+            if start > last:
+                run = markup[last:start]
+                text += _reference.sub(_decode_reference, run) if '&' in run else run
+            last = match.end()
+            group = match.lastindex
+
+            if group == 2:
+                name = match[1].lower()
+                if text:
+                    texts.append(text)
+                    pieces.append(_escape(text) if '&' in text or '<' in text or '>' in text else text)
+                    text = ''
+                span = None
+                if name in spans:
+                    span = [len(pieces), None]
+                    spans[name].append(span)
+                    if name in TABLE_ELEMENTS: last_table_element = span[0]
+                pieces.append('<' + name + '>')
+                texts.append(None)
+
+                if name in VOID_ELEMENTS and not match[2]:
+                    if span: span[1] = len(pieces)
+                    pieces.append('</' + name + '>')
+                    texts.append(None)
+                    closed_void[name] = closed_void.get(name, 0) + 1
+                    continue
+
+                names.append(name)
+                open_spans.append(span)
+                if match[2]:
+                    # <tag/>: bs4 ignores the end tag of a void element closed earlier
+                    if closed_void.get(name):
+                        closed_void[name] -= 1
+                    else:
+                        end(name)
+                elif name not in SPECIAL_ELEMENTS:
+                    continue
+                elif name in RAW_TEXT_ELEMENTS:
+                    close = _end_tag_pattern(name).search(markup, last)
+                    if not close or '</' in markup[last:close.start()]: raise UnsupportedMarkup(name)
+                    if last < close.start():
+                        pieces.append(markup[last:close.start()]) # Rendered, not text
+                        texts.append(None)
+                    end(name)
+                    position = close.end()
+                    break
+                elif name in PLAIN_TEXT_ELEMENTS:
+                    close = markup.find('<', last)
+                    if close < 0 or not _end_tag_pattern(name).match(markup, close): raise UnsupportedMarkup(name)
+                elif name in UNSUPPORTED_ELEMENTS:
+                    raise UnsupportedMarkup(name)
+
+            elif group == 3:
+                name = match[3].lower()
+                if closed_void and closed_void.get(name):
+                    closed_void[name] -= 1
+                    continue
+                if text:
+                    texts.append(text)
+                    pieces.append(_escape(text) if '&' in text or '<' in text or '>' in text else text)
+                    text = ''
+                if names and names[-1] == name and name != 'br':
+                    names.pop()
+                    span = open_spans.pop()
+                    if span: span[1] = len(pieces)
+                    pieces.append('</' + name + '>')
+                    texts.append(None)
+                elif name in names:
+                    end(name)
+
+            elif group == 4:
+                if '--!>' in match[4]: raise UnsupportedMarkup('comment')
+                if text:
+                    end_data(text)
+                    text = ''
+                pieces.append('<!--' + match[4] + '-->')
+                texts.append(None)
+
+            else:
+                next_char = markup[start + 1:start + 2]
+                section = _ms_section.match(markup, start)
+                if section:
+                    # MS Office conditionals (<![if ...]>, <![endif]>), rendered as bs4 renders Declarations
+                    piece, position = '<?' + markup[start + 3:section.end(1)] + '?>', section.end()
+                elif markup[start:start + 9].upper() == '<!DOCTYPE':
+                    close = markup.find('>', start)
+                    if close < 0: raise UnsupportedMarkup('declaration')
+                    piece, position = '<!DOCTYPE ' + markup[start + 10:close] + '>\n', close + 1
+                elif next_char in ('!', '?', '/') or (next_char.isascii() and next_char.isalpha()):
+                    raise UnsupportedMarkup('tag') # Markup outside the modelled subset
+                else:
+                    text += '<'
+                    continue
+                if text:
+                    end_data(text)
+                    text = ''
+                pieces.append(piece)
+                texts.append(None)
+                break
+        else:
+            run = markup[last:]
+            if '&' in run: raise UnsupportedMarkup('reference') # A reference may be cut by the end of the markup
+            text += run
+            break
+
+    if text: end_data(text)
+    while names:
+        end(names[-1])
+    tables.br_starts = [start for start, _ in tables.brs]
+    return tables
@@ -0,0 +1,243 @@
+"""
+Firestore REST value codec: python values <-> typed JSON values
+({"stringValue": ...}, {"mapValue": {"fields": {...}}}, ...), shared by the handlers in api/.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+- encode_value / encode_fields: None, bool, int, float, str, bytes, datetime,
+  list / tuple and dict (nested at any depth). Strings are always stringValue:
+  the "SERVER_TIMESTAMP" placeholder of the notas is stored as text.
+- decode_value / decode_fields: every value type of the REST API. Timestamps
+  come back as aware UTC datetimes, references as their path, geo points as
+  { "latitude", "longitude" }.
+- as_str / as_int / as_float / as_bool / as_list: a decoded value if it has the
+  expected type, else the default (what the hand-written
+  .get('stringValue', '') chains used to give for missing or mistyped fields).
+- decode_records: typed projection of an array of maps (itens, itens_conferencia),
+  for reads that only need some fields of hundreds of items.
+
+Both directions dispatch on a table (python type / value kind) instead of an
+isinstance chain per value. The kinds every item field uses (strings, finite
+doubles, booleans, maps) are converted inline by the map and array loops,
+without a call per value.
+"""
+import base64
+import math
+from datetime import datetime, timezone
+
+
+# -------------------------------------------------------------------------
+# ENCODE
+# -------------------------------------------------------------------------
+def _encode_int(value):
+    return {"integerValue": str(value)}
+
+
+def _encode_float(value):
+    # JSON has no NaN/Infinity: the REST API takes them as strings
+    if value != value: return {"doubleValue": "NaN"}
+    if value - value == 0: return {"doubleValue": value}
+    return {"doubleValue": "Infinity" if value > 0 else "-Infinity"}
+
+
+def _encode_bytes(value):
+    return {"bytesValue": base64.b64encode(value).decode('ascii')}
+
+
+def _encode_datetime(value):
+    # Naive datetimes are taken as UTC (datetime.utcnow() style)
+    if value.tzinfo is not None: value = value.astimezone(timezone.utc)
+    return {"timestampValue": value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+
+
+def _encode_list(value):
+    values = []
+    append = values.append
+    for v in value:
+        t = type(v)
+        if t is dict: append({"mapValue": {"fields": encode_fields(v)}})
+        elif t is str: append({"stringValue": v})
+        else: append(_encode(v))
+    return {"arrayValue": {"values": values}}
+
+
+def _encode_dict(value):
+    return {"mapValue": {"fields": encode_fields(value)}}
+
+
+_ENCODERS = {
+    type(None): lambda value: {"nullValue": None},
+    bool: lambda value: {"booleanValue": value},
+    int: _encode_int,
+    float: _encode_float,
+    str: lambda value: {"stringValue": value},
+    bytes: _encode_bytes,
+    datetime: _encode_datetime,
+    list: _encode_list,
+    tuple: _encode_list,
+    dict: _encode_dict,
+}
+# Subclasses (IntEnum, OrderedDict...) resolve to the first matching base; bool before int
+_FALLBACK = [(bool, lambda v: {"booleanValue": bool(v)}), (int, lambda v: _encode_int(int(v))), (float, _encode_float),
+             (str, lambda v: {"stringValue": str(v)}), (bytes, _encode_bytes), (datetime, _encode_datetime),
+             ((list, tuple), _encode_list), (dict, _encode_dict)]
+
+
+def _encode(value):
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        encoder = next((enc for types, enc in _FALLBACK if isinstance(value, types)), None)
+        if encoder is None:
+            raise TypeError(f"Tipo sem representacao no Firestore: {type(value).__name__}")
+    return encoder(value)
+
+
+def encode_value(value):
+    """Typed Firestore value of a python value."""
+    return _encode(value)
+
+
+def encode_fields(data):
+    """Firestore "fields" map of a python dict."""
+    fields = {}
+    for key, v in data.items():
+        # Inline: the item fields (strings, finite doubles, booleans) and nested maps
+        t = type(v)
+        if t is str: fields[key] = {"stringValue": v}
+        elif t is float and v - v == 0: fields[key] = {"doubleValue": v}
+        elif t is bool: fields[key] = {"booleanValue": v}
+        elif t is dict: fields[key] = {"mapValue": {"fields": encode_fields(v)}}
+        else: fields[key] = _encode(v)
+    return fields
+
+
+# -------------------------------------------------------------------------
+# DECODE
+# -------------------------------------------------------------------------
+def parse_timestamp(value):
+    """RFC 3339 timestamp as written by Firestore ("...T10:00:00.123456789Z") -> aware UTC datetime."""
+    value = value[:-1] if value.endswith("Z") else value
+    offset = None
+    if value[-6:-5] in "+-" and value[-3:-2] == ":":
+        value, offset = value[:-6], value[-6:]
+    if "." in value:
+        value, fraction = value.split(".", 1)
+        value = f"{value}.{fraction[:6].ljust(6, '0')}" # Nanoseconds: python keeps microseconds
+    else:
+        value += ".000000"
+    parsed = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    if offset:
+        parsed = datetime.fromisoformat(parsed.isoformat() + offset)
+        return parsed.astimezone(timezone.utc)
+    return parsed.replace(tzinfo=timezone.utc)
+
+
+def _decode_array(inner):
+    values = []
+    append = values.append
+    for value in inner.get('values', ()):
+        for kind, v in value.items():
+            append(v if kind in _AS_IS else _DECODERS[kind](v))
+            break
+        else:
+            append(None)
+    return values
+
+
+def _decode_map(inner):
+    return decode_fields(inner.get('fields', {}))
+
+
+# Kinds whose JSON value already is the python value: decoded inline, without a call
+_AS_IS = frozenset(("stringValue", "booleanValue", "nullValue"))
+_DECODERS = {
+    "integerValue": int,
+    "doubleValue": float, # Numbers, or "NaN" / "Infinity" / "-Infinity"
+    "timestampValue": parse_timestamp,
+    "bytesValue": base64.b64decode,
+    "referenceValue": str,
+    "geoPointValue": lambda inner: {"latitude": inner.get('latitude', 0.0), "longitude": inner.get('longitude', 0.0)},
+    "arrayValue": _decode_array,
+    "mapValue": _decode_map,
+}
+
+
+def decode_value(value):
+    """Python value of a typed Firestore value (None for an empty one)."""
+    for kind, inner in value.items(): # A value has exactly one kind
+        return inner if kind in _AS_IS else _DECODERS[kind](inner)
+    return None
+
+
+def decode_fields(fields):
+    """Python dict of a Firestore "fields" map (a document's or a mapValue's)."""
+    data = {}
+    for key, value in fields.items():
+        for kind, inner in value.items():
+            data[key] = inner if kind in _AS_IS else _DECODERS[kind](inner)
+            break
+        else:
+            data[key] = None
+    return data
+
+
+# -------------------------------------------------------------------------
+# TYPED ACCESS
+# -------------------------------------------------------------------------
+def as_str(value, default=''):
+    return value if isinstance(value, str) else default
+
+
+def as_int(value, default=0):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value): return default
+    return int(value)
+
+
+def as_float(value, default=0.0):
+    if isinstance(value, bool) or not isinstance(value, (int, float)): return default
+    return float(value)
+
+
+def as_bool(value, default=False):
+    return value if isinstance(value, bool) else default
+
+
+def as_list(value):
+    return value if isinstance(value, list) else []
+
+
+# -------------------------------------------------------------------------
+# RECORDS (arrays of maps: the notas' itens)
+# -------------------------------------------------------------------------
+_EMPTY = {}
+_EXPECTED_KINDS = {str: "stringValue", bool: "booleanValue", float: "doubleValue", int: "integerValue"}
+_TYPED = {str: as_str, bool: as_bool, float: as_float, int: as_int}
+
+
+def _typed_value(raw, default):
+    """Slow path of decode_records: any kind, converted to the default's type."""
+    if not raw: return default
+    value = decode_value(raw)
+    typed = _TYPED.get(type(default))
+    return typed(value, default) if typed else value
+
+
+def decode_records(value, schema):
+    """
+    arrayValue of mapValues -> list of dicts with exactly the keys of schema ({ key: default }).
+    Missing fields and values of another type read as the default (as_str / as_float ...);
+    an array entry that is not a map reads as all defaults.
+    The expected kind of each key is read directly, the other kinds go through decode_value.
+    """
+    columns = [(key, _EXPECTED_KINDS.get(type(default)), type(default)) for key, default in schema.items()]
+    records = []
+    append = records.append
+    for entry in value.get('arrayValue', _EMPTY).get('values', ()):
+        fields = entry.get('mapValue', _EMPTY).get('fields', _EMPTY)
+        record = {}
+        for key, kind, expected in columns:
+            inner = fields.get(key, _EMPTY).get(kind)
+            if type(inner) is not expected: # Missing, another kind, an integral doubleValue, an integerValue string...
+                inner = _typed_value(fields.get(key, _EMPTY), schema[key])
+            record[key] = inner
+        append(record)
+    return records
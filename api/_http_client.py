@@ -0,0 +1,192 @@
+"""
+Shared HTTP plumbing for the Firestore REST clients in api/.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+- One pooled keep-alive requests.Session per process, reused across warm invocations.
+- Transient 429/5xx responses and connection errors are retried with
+  jittered exponential backoff, honoring Retry-After.
+- Auth headers are cached until the token is close to expiry.
+- Large JSON array responses (runQuery) can be decoded element by element while they stream in.
+"""
+import codecs
+import json
+import random
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20
+REQUEST_TIMEOUT_SECONDS = 60
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+STREAM_CHUNK_BYTES = 64 * 1024
+
+_array_separators = re.compile(r'[\s,]*')
+
+_session = None
+
+
+def get_session():
+    """Returns the process-wide pooled session (created on first use)."""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        _session = session
+    return _session
+
+
+def _retry_after_seconds(response):
+    value = (response.headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_seconds(attempt):
+    # "Full jitter": random delay up to the exponential cap
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+def request_with_retry(method, url, open_body=None, **kwargs):
+    """
+    Sends a request through the shared session, retrying transient failures.
+    open_body: returns a new file object with the body, for every attempt (uploads
+    streamed from disk: a consumed file cannot be sent again).
+    Returns the last response (the caller still checks status_code).
+    """
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT_SECONDS)
+
+    for attempt in range(MAX_RETRIES + 1):
+        body = open_body() if open_body else None
+        try:
+            if body is not None: kwargs['data'] = body
+            response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(_backoff_seconds(attempt))
+            continue
+        finally:
+            if body is not None: body.close()
+
+        if response.status_code not in RETRY_STATUS or attempt == MAX_RETRIES:
+            return response
+
+        delay = _retry_after_seconds(response)
+        if delay is None:
+            delay = _backoff_seconds(attempt)
+        response.close() # Releases the connection of a streamed response
+        time.sleep(min(delay, BACKOFF_MAX_SECONDS))
+
+    return response
+
+
+class AuthHeaders:
+    """Builds the JSON + Bearer headers, refreshing the token only near expiry."""
+
+    def __init__(self, creds, refresh_request_factory):
+        self.creds = creds
+        self.refresh_request_factory = refresh_request_factory
+        self._headers = None
+        self._valid_until = 0.0
+        self._force_refresh = False
+
+    def _expires_at(self):
+        expiry = getattr(self.creds, "expiry", None)
+        if not expiry:
+            return float("inf")
+        # google-auth stores expiry as naive UTC
+        return expiry.replace(tzinfo=timezone.utc).timestamp()
+
+    def get(self):
+        now = time.time()
+        if self._headers is not None and now < self._valid_until:
+            return self._headers
+
+        if self._force_refresh or not self.creds.valid or self._expires_at() - TOKEN_REFRESH_MARGIN_SECONDS <= now:
+            self.creds.refresh(self.refresh_request_factory())
+            self._force_refresh = False
+
+        self._valid_until = self._expires_at() - TOKEN_REFRESH_MARGIN_SECONDS
+        self._headers = {
+            "Authorization": f"Bearer {self.creds.token}",
+            "Content-Type": "application/json"
+        }
+        return self._headers
+
+    def invalidate(self):
+        """Forces a token refresh on the next get() (e.g. after a 401)."""
+        self._headers = None
+        self._force_refresh = True
+
+
+def authorized_request(auth_headers, method, url, **kwargs):
+    """request_with_retry with auth headers; a 401 refreshes the token and retries once."""
+    response = request_with_retry(method, url, headers=auth_headers.get(), **kwargs)
+    if response.status_code == 401:
+        auth_headers.invalidate()
+        response = request_with_retry(method, url, headers=auth_headers.get(), **kwargs)
+    return response
+
+
+def iter_json_array(response, chunk_size=STREAM_CHUNK_BYTES):
+    """
+    Yields the elements of a JSON array body one at a time as the response streams in
+    (send the request with stream=True), so the whole array is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    retry_size = 0 # An incomplete element is decoded again only once its buffer doubled (stays linear)
+
+    chunks = response.iter_content(chunk_size)
+    while True:
+        chunk = next(chunks, None)
+        finished = chunk is None
+        buffer += text.decode(chunk or b"", final=finished)
+
+        pos = 0
+        while True:
+            pos = _array_separators.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            if not finished and len(buffer) - pos < retry_size:
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if finished: raise
+                retry_size = 2 * (len(buffer) - pos)
+                break
+            if not finished and (end == len(buffer) or buffer[end] not in " \t\n\r,]"):
+                break # A number may continue in the next chunk
+            retry_size = 0
+            pos = end
+            yield element
+
+        buffer = buffer[pos:]
+        if finished:
+            raise ValueError("Truncated JSON array")
@@ -0,0 +1,181 @@
+"""
+Streaming multipart/form-data parser for the upload handlers (replaces cgi.FieldStorage,
+deprecated and removed in Python 3.13).
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+The body is read in chunks: file parts are spooled straight to temp files
+(never held whole in memory), the other fields are kept as strings.
+"""
+import email.message
+import email.utils
+import os
+import tempfile
+
+READ_CHUNK_BYTES = 256 * 1024
+MAX_HEADER_BYTES = 16 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class UploadedFile:
+    def __init__(self, filename, path):
+        self.filename = filename
+        self.path = path
+        self.size = 0
+
+
+class MultipartForm:
+    """
+    Parsed form: `name in form`, form.getvalue(name, default) for the text fields,
+    form.files[name] (UploadedFile) for the file parts.
+    Use as a context manager (or call cleanup()) to remove the spooled files.
+    """
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+
+    def __contains__(self, name):
+        return name in self.fields or name in self.files
+
+    def getvalue(self, name, default=None):
+        return self.fields.get(name, default)
+
+    def cleanup(self):
+        for upload in self.files.values():
+            try:
+                os.remove(upload.path)
+            except FileNotFoundError:
+                pass
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+def _header_param(headers, name, param):
+    message = email.message.Message()
+    message[name] = headers.get(name, '')
+    return message.get_param(param, header=name)
+
+
+def _parse_part_headers(raw):
+    headers = {}
+    for line in raw.decode('utf-8', 'replace').split('\r\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+    name = _header_param(headers, 'content-disposition', 'name')
+    if not name:
+        raise MultipartError("parte sem nome no Content-Disposition")
+    filename = _header_param(headers, 'content-disposition', 'filename')
+    # RFC 2231 values come back as (charset, language, value)
+    if isinstance(name, tuple): name = email.utils.collapse_rfc2231_value(name)
+    if isinstance(filename, tuple): filename = email.utils.collapse_rfc2231_value(filename)
+    return name, filename
+
+
+def parse_multipart(stream, headers, spool_dir=None):
+    """
+    Reads a multipart/form-data body from stream (rfile) into a MultipartForm.
+    headers: the request headers (Content-Type with boundary, Content-Length).
+    Raises MultipartError on a malformed body.
+    """
+    message = email.message.Message()
+    message['content-type'] = headers.get('content-type', '')
+    if message.get_content_type() != 'multipart/form-data':
+        raise MultipartError("Content-Type must be multipart/form-data")
+    boundary = message.get_param('boundary')
+    if not boundary:
+        raise MultipartError("multipart sem boundary")
+
+    remaining = headers.get('content-length')
+    remaining = int(remaining) if remaining else None
+
+    def read_chunk():
+        nonlocal remaining
+        size = READ_CHUNK_BYTES if remaining is None else min(READ_CHUNK_BYTES, remaining)
+        if size <= 0: return b''
+        chunk = stream.read(size)
+        if remaining is not None: remaining -= len(chunk)
+        return chunk
+
+    # The first boundary has no leading CRLF: add one so every delimiter looks the same
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    buffer = b'\r\n'
+    form = MultipartForm()
+
+    try:
+        # Preamble
+        while True:
+            position = buffer.find(delimiter)
+            if position >= 0:
+                buffer = buffer[position + len(delimiter):]
+                break
+            buffer = buffer[-len(delimiter):]
+            chunk = read_chunk()
+            if not chunk: raise MultipartError("multipart sem partes")
+            buffer += chunk
+
+        while True:
+            # After a delimiter: "--" closes the body, otherwise CRLF + part headers
+            while len(buffer) < 2:
+                chunk = read_chunk()
+                if not chunk: raise MultipartError("multipart incompleto")
+                buffer += chunk
+            if buffer.startswith(b'--'):
+                break
+
+            while b'\r\n\r\n' not in buffer:
+                if len(buffer) > MAX_HEADER_BYTES: raise MultipartError("cabecalho de parte grande demais")
+                chunk = read_chunk()
+                if not chunk: raise MultipartError("multipart incompleto")
+                buffer += chunk
+            header_end = buffer.index(b'\r\n\r\n')
+            # Line end of the delimiter (transport padding allowed before it)
+            line_end = buffer.index(b'\r\n')
+            name, filename = _parse_part_headers(buffer[line_end + 2:header_end])
+            buffer = buffer[header_end + 4:]
+
+            if filename is not None:
+                if name in form.files: os.remove(form.files.pop(name).path) # Repeated field: the last one wins
+                fd, path = tempfile.mkstemp(suffix=".upload", dir=spool_dir)
+                sink = os.fdopen(fd, 'wb')
+                upload = form.files[name] = UploadedFile(filename, path)
+            else:
+                sink, value = None, bytearray()
+
+            try:
+                # Part body: everything up to the next delimiter. The tail that could be
+                # the start of a delimiter split across chunks stays in the buffer.
+                while True:
+                    position = buffer.find(delimiter)
+                    data = buffer[:position] if position >= 0 else buffer[:max(0, len(buffer) - len(delimiter) + 1)]
+                    if sink:
+                        sink.write(data)
+                        upload.size += len(data)
+                    else:
+                        value += data
+                        if len(value) > MAX_FIELD_BYTES: raise MultipartError(f"campo '{name}' grande demais")
+                    buffer = buffer[len(data):]
+                    if position >= 0:
+                        buffer = buffer[len(delimiter):]
+                        break
+                    chunk = read_chunk()
+                    if not chunk: raise MultipartError("multipart incompleto")
+                    buffer += chunk
+            finally:
+                if sink: sink.close()
+
+            if sink is None:
+                form.fields[name] = value.decode('utf-8', 'replace')
+    except Exception:
+        form.cleanup()
+        raise
+    return form
@@ -0,0 +1,368 @@
+"""
+Text extraction of the Correios extratos (PDF) for the audit.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+The audit only searches unitizer codes in the text, so every PDF is reduced to
+one string without whitespace, upper case. Pages are extracted in ranges on a
+process pool (pdfminer is pure Python: threads would share one core), with the
+ranges of every file of the request on the same pool, so Postal and Densa are
+extracted at the same time. The texts are joined back in page order.
+Files are passed by path (the uploads are spooled to disk): each worker reads
+only the pages it extracts, and the PDF is never copied into every process.
+
+Where the pool cannot be created (a single CPU, or serverless runtimes without
+/dev/shm such as AWS Lambda) the pages are extracted in this process.
+
+The same extrato is often uploaded again (after fixing a price or month), so
+the texts are cached by SHA-256 of the file, extractor version and mode
+(cache_key). extract_texts takes a list of caches, fastest first: a hit skips
+the extraction and is copied into the faster caches.
+DiskTextCache is the local one; audit_pdf adds a Firestore one behind it.
+
+PDF_TEXT_MODE:
+- "layout" (default): pdfplumber's extract_text (characters sorted into lines);
+- "stream": the strings in content stream order, without building the
+  character objects. Several times faster, and the same text for extratos that
+  draw their lines top to bottom; a PDF that draws out of reading order can
+  split a code that "layout" would keep together.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+TEXT_MODES = ("layout", "stream")
+MIN_PAGES_PER_TASK = 8 # Smaller ranges cost more in process hand-off than they save
+EXTRACTOR_VERSION = 1 # Bump when the extracted text changes: older cache entries stop matching
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HASH_BLOCK_BYTES = 1024 * 1024
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    return _whitespace.sub('', text).upper()
+
+
+def _stream_device_class():
+    from pdfminer.pdfdevice import PDFDevice
+
+    class StreamTextDevice(PDFDevice):
+        """Collects the decoded strings of the page, ignoring positions and font metrics."""
+        def __init__(self, rsrcmgr):
+            super().__init__(rsrcmgr)
+            self.parts = []
+
+        def render_string(self, textstate, seq, ncs, graphicstate):
+            font = textstate.font
+            for obj in seq:
+                if isinstance(obj, str):
+                    obj = obj.encode('latin-1')
+                if not isinstance(obj, bytes): continue # Kerning adjustments
+                for cid in font.decode(obj):
+                    try:
+                        self.parts.append(font.to_unichr(cid))
+                    except Exception:
+                        pass # No unicode mapping: pdfplumber shows "(cid:N)", useless for codes
+
+    return StreamTextDevice
+
+
+def _page_texts(path, start, stop, mode):
+    """Texts of pages [start, stop) of the PDF at path (runs in the pool workers)."""
+    if mode == "stream":
+        from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+        from pdfminer.pdfpage import PDFPage
+
+        rsrcmgr = PDFResourceManager(caching=True)
+        device = _stream_device_class()(rsrcmgr)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        texts = []
+        with open(path, 'rb') as f:
+            for number, page in enumerate(PDFPage.get_pages(f)):
+                if number >= stop: break
+                if number < start: continue
+                device.parts = []
+                interpreter.process_page(page)
+                texts.append("".join(device.parts))
+        return texts
+
+    import pdfplumber
+    with pdfplumber.open(path, pages=list(range(start + 1, stop + 1))) as pdf:
+        return [page.extract_text() or "" for page in pdf.pages]
+
+
+def _page_count(path):
+    from pdfminer.pdfpage import PDFPage
+    with open(path, 'rb') as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
+
+
+def _worker_count():
+    workers = os.environ.get('PDF_EXTRACT_WORKERS')
+    return int(workers) if workers else (os.cpu_count() or 1)
+
+
+def _ranges(page_count, workers):
+    size = max(MIN_PAGES_PER_TASK, -(-page_count // workers))
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def cache_key(path, mode):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+    return f"{digest.hexdigest()}-v{EXTRACTOR_VERSION}-{mode}"
+
+
+class DiskTextCache:
+    """
+    One file per text in PDF_TEXT_CACHE_DIR (default: <tmp>/pdf_text_cache).
+    Reads refresh the file's mtime; writes evict the least recently used files
+    above PDF_TEXT_CACHE_MAX_MB.
+    """
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or os.environ.get('PDF_TEXT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), "pdf_text_cache")
+        if max_bytes is None:
+            max_mb = os.environ.get('PDF_TEXT_CACHE_MAX_MB')
+            max_bytes = int(max_mb) * 1024 * 1024 if max_mb else DISK_CACHE_MAX_BYTES
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".txt")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return text
+
+    def put(self, key, text):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, path) # Readers never see a partial file
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".txt"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # Evicted by another process
+            total -= size
+
+
+def _cached_texts(keys, caches):
+    """{ file index: text } found in the caches; hits are copied into the faster caches."""
+    found = {}
+    for index, key in enumerate(keys):
+        for level, cache in enumerate(caches):
+            try:
+                text = cache.get(key)
+            except Exception as e:
+                print(f"Aviso: cache de texto de PDF indisponivel ({e})")
+                continue
+            if text is None: continue
+            found[index] = text
+            _store(key, text, caches[:level])
+            break
+    return found
+
+
+def _store(key, text, caches):
+    for cache in caches:
+        try:
+            cache.put(key, text)
+        except Exception as e:
+            print(f"Aviso: cache de texto de PDF indisponivel ({e})")
+
+
+def _create_pool(workers):
+    try:
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError, ImportError) as e:
+        print(f"Aviso: extracao de PDF sem paralelismo ({e})")
+        return None
+
+
+def _text_mode(mode):
+    mode = mode or os.environ.get('PDF_TEXT_MODE') or "layout"
+    if mode not in TEXT_MODES:
+        raise ValueError(f"PDF_TEXT_MODE invalido: {mode}")
+    return mode
+
+
+def _range_texts(paths, indexes, mode, pages_per_range=None, first_pages=None):
+    """
+    Yields (file index, page texts of one range, error, last range of the file) for the
+    files at `indexes`, in file and page order. Every range is submitted to the pool up
+    front, so files are extracted concurrently; an error ends its file.
+    Closing the generator early cancels the ranges not started yet.
+    pages_per_range: None splits each file evenly across the workers.
+    first_pages: { file index: first page to read } (a resumed scan), 0 for the others.
+    """
+    workers = _worker_count()
+    tasks = {} # { file index: [(start, stop)] or the error reading the file }
+    for index in indexes:
+        try:
+            page_count = _page_count(paths[index])
+        except Exception as e:
+            tasks[index] = e
+            continue
+        size = pages_per_range or max(MIN_PAGES_PER_TASK, -(-page_count // workers))
+        first_page = (first_pages or {}).get(index, 0)
+        tasks[index] = [(start, min(start + size, page_count)) for start in range(first_page, page_count, size)]
+
+    pool = None
+    if workers > 1 and sum(len(ranges) for ranges in tasks.values() if isinstance(ranges, list)) > 1:
+        pool = _create_pool(workers)
+
+    futures = {}
+    try:
+        if pool:
+            try:
+                for index, ranges in tasks.items():
+                    if isinstance(ranges, list):
+                        futures[index] = [pool.submit(_page_texts, paths[index], start, stop, mode)
+                                          for start, stop in ranges]
+            except (OSError, BrokenProcessPool) as e:
+                print(f"Aviso: extracao de PDF sem paralelismo ({e})")
+                futures = {}
+
+        for index, ranges in tasks.items():
+            if isinstance(ranges, Exception):
+                yield index, None, ranges, True
+                continue
+            if not ranges:
+                yield index, [], None, True # No pages
+                continue
+            for number, (start, stop) in enumerate(ranges):
+                try:
+                    texts = None
+                    if index in futures:
+                        try:
+                            texts = futures[index][number].result()
+                        except BrokenProcessPool as e:
+                            print(f"Aviso: extracao de PDF sem paralelismo ({e})")
+                            futures = {} # The other ranges are lost too
+                    if texts is None:
+                        texts = _page_texts(paths[index], start, stop, mode)
+                except Exception as e:
+                    yield index, None, e, True
+                    break
+                yield index, texts, None, number == len(ranges) - 1
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def extract_texts(paths, mode=None, caches=()):
+    """
+    Normalized text of each PDF file in paths (same order).
+    A PDF that cannot be read gives "" (the audit then finds none of its codes); it is not cached.
+    """
+    mode = _text_mode(mode)
+    keys = [cache_key(path, mode) for path in paths]
+    cached = _cached_texts(keys, caches)
+
+    texts = [cached.get(index, "") for index in range(len(paths))]
+    parts = {}
+    failed = set()
+    for index, page_texts, error, _ in _range_texts(paths, [i for i in range(len(paths)) if i not in cached], mode):
+        if error:
+            print(f"Erro ao ler PDF: {error}")
+            failed.add(index)
+        else:
+            parts.setdefault(index, []).extend(page_texts)
+
+    for index, page_texts in parts.items():
+        if index in failed: continue
+        texts[index] = normalize_text("\n".join(page_texts))
+        _store(keys[index], texts[index], caches)
+    return texts
+
+
+def scan_texts(paths, matcher, codes, mode=None, caches=(), on_progress=None, resume=None, stop=None, on_position=None):
+    """
+    Searches the codes in the PDFs in paths order, range by range, and stops extracting
+    as soon as every code has been found. A code is attributed to the first file that has it.
+    matcher: AhoCorasick over (at least) the codes.
+    Returns ({ code: file index }, pages read, position).
+    Only files read to the end in one scan go to the caches.
+    on_progress(pages read, codes found) is called after every range.
+
+    The scan can be split across processes. After every range, on_position(position) gets
+    the point reached, { "file", "page", "tail", "found", "pages_read" }, and stop() is
+    polled: once it returns True the scan ends early and returns that position (None when
+    the scan ended on its own). Passing a position back as resume continues from there,
+    without reading those pages again.
+    """
+    mode = _text_mode(mode)
+    keys = [cache_key(path, mode) for path in paths]
+    cached = _cached_texts(keys, caches)
+
+    found = dict(resume['found']) if resume else {}
+    pending = set(codes) - found.keys()
+    overlap = max(map(len, pending), default=1) - 1 # A code can straddle two ranges
+    pages_read = resume['pages_read'] if resume else 0
+    first_file = resume['file'] if resume else 0
+    first_page = resume['page'] if resume else 0
+
+    def search(index, text):
+        for code in matcher.find(text) & pending:
+            found[code] = index
+        pending.difference_update(found)
+
+    ranges = _range_texts(paths, [i for i in range(first_file, len(paths)) if i not in cached],
+                          mode, pages_per_range=MIN_PAGES_PER_TASK, first_pages={first_file: first_page})
+    try:
+        for index in range(first_file, len(paths)):
+            if not pending: break
+            if index in cached:
+                search(index, cached[index])
+                continue
+
+            resumed = index == first_file and first_page > 0
+            page = first_page if resumed else 0
+            parts = []
+            tail = resume['tail'] if resumed else ""
+            while True:
+                _, page_texts, error, last = next(ranges) # Ranges come in file order
+                if error:
+                    print(f"Erro ao ler PDF: {error}")
+                    break
+                pages_read += len(page_texts)
+                page += len(page_texts)
+                text = normalize_text("\n".join(page_texts))
+                search(index, tail + text)
+                if on_progress: on_progress(pages_read, len(found))
+                tail = (tail + text)[max(0, len(tail) + len(text) - overlap):]
+                parts.append(text)
+                if last:
+                    # A file resumed mid-way was not read whole here: its text is not cached
+                    if not resumed: _store(keys[index], "".join(parts), caches)
+                    break
+                if not pending: break
+                position = {"file": index, "page": page, "tail": tail, "found": found, "pages_read": pages_read}
+                if on_position: on_position(position)
+                if stop and stop(): return found, pages_read, position
+    finally:
+        ranges.close()
+    return found, pages_read, None
@@ -0,0 +1,76 @@
+"""
+Entry (Recebimento) vs exit (Devolução) reconciliation of a nota's unitizers, used by sync_emails.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+reconcile() indexes both sides by unitizer code once, so a consolidated nota with
+hundreds of unitizers is checked in linear time. It returns structured records:
+    { "code", "kind", "entry_weight", "exit_weight" }
+kind: "weight" (both sides, weights differ by more than WEIGHT_TOLERANCE),
+"missing_exit" (entry only) or "missing_entry" (exit only); the weight of the
+missing side is None. divergence_text() joins them into the nota's `divergencia`.
+
+The side whose e-mail is being merged ("entrada" or "saida") drives the check:
+its items come first, in their order, then the counterpart's items it lacks.
+The wording of the missing kinds also follows the driving side, as the notas
+have always been written.
+"""
+WEIGHT_TOLERANCE = 0.1 # kg
+
+MISSING_MESSAGES = {
+    ("entrada", "missing_exit"): "Não consta na devolução",
+    ("entrada", "missing_entry"): "Faltou na entrada",
+    ("saida", "missing_entry"): "Não consta na entrada",
+    ("saida", "missing_exit"): "Faltou na devolução",
+}
+
+
+def _weights(items):
+    """{ code: weight } of items; empty codes skipped, a repeated code keeps its last item (as merge_item_lists)."""
+    weights = {}
+    for item in items:
+        code = item.get('unitizador', '').strip()
+        if code: weights[code] = item.get('peso', 0.0)
+    return weights
+
+
+def reconcile(entry_items, exit_items, driver):
+    """
+    Divergence records between the entry and exit items of one nota.
+    driver: "entrada" (a Recebimento was merged) or "saida" (a Devolução was merged).
+    """
+    entry = _weights(entry_items)
+    exit_ = _weights(exit_items)
+    driving, counterpart = (entry, exit_) if driver == "entrada" else (exit_, entry)
+    missing_counterpart = "missing_exit" if driver == "entrada" else "missing_entry"
+    missing_driving = "missing_entry" if driver == "entrada" else "missing_exit"
+
+    records = []
+    for code, weight in driving.items():
+        other = counterpart.get(code)
+        if other is None:
+            records.append({"code": code, "kind": missing_counterpart,
+                            "entry_weight": weight if driver == "entrada" else None,
+                            "exit_weight": None if driver == "entrada" else weight})
+            continue
+        entry_weight, exit_weight = (weight, other) if driver == "entrada" else (other, weight)
+        if abs(entry_weight - exit_weight) > WEIGHT_TOLERANCE:
+            records.append({"code": code, "kind": "weight", "entry_weight": entry_weight, "exit_weight": exit_weight})
+
+    for code, weight in counterpart.items():
+        if code not in driving:
+            records.append({"code": code, "kind": missing_driving,
+                            "entry_weight": None if driver == "entrada" else weight,
+                            "exit_weight": weight if driver == "entrada" else None})
+    return records
+
+
+def divergence_message(record, driver):
+    if record['kind'] == "weight":
+        return f"Unit {record['code']}: Peso Entrada {record['entry_weight']} != Saida {record['exit_weight']}"
+    return f"Unit {record['code']}: {MISSING_MESSAGES[(driver, record['kind'])]}"
+
+
+def divergence_text(records, driver):
+    """The nota's `divergencia` string; None when there is no divergence."""
+    if not records: return None
+    return "; ".join(divergence_message(record, driver) for record in records)
@@ -0,0 +1,149 @@
+"""
+Sharded index of the unitizers still waiting for an extrato match.
+(Files starting with "_" are not exposed by Vercel as functions.)
+
+tb_unitizadores_index/shard_NN documents hold a "codes" map:
+    { normalized code: { nota id: { "item_index", "data_ocorrencia_iso" } } }
+(a code can be pending in more than one nota).
+- sync_emails adds an entry for every item it writes into a nota's `itens`
+  (a merge that rewrites the whole array drops the items' correios_* fields, so they are
+  pending again; one that only appends unitizers indexes just the appended ones);
+- audit_pdf removes the codes it matches, so the index only grows with what is pending.
+The "_meta" document marks the index as complete once a full audit scan has rebuilt it;
+until then the audit keeps scanning every nota. Notas written outside the sync are not
+indexed: the frontend clears "complete" after adding or rewriting items, and any other
+writer (scripts, the console) is caught up by the next rebuild, as the index is only
+trusted for INDEX_MAX_AGE_DAYS after one (index_status). A rebuild rewrites each shard on condition
+that it is still the version read at the start of the scan; a shard a sync changed meanwhile
+is read again and rewritten with the entries that sync added.
+"""
+import os
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from _firestore_codec import encode_value, decode_fields, parse_timestamp, as_int, as_str
+
+INDEX_COLLECTION = "tb_unitizadores_index"
+INDEX_SHARDS = 32 # Keeps each shard document far below Firestore's 1 MiB limit
+INDEX_MAP_FIELD = "codes"
+INDEX_META_DOC = "_meta"
+INDEX_MAX_AGE_DAYS = int(os.environ.get('INDEX_MAX_AGE_DAYS', 7)) # Older than this, the audit scans every nota again
+
+
+def index_status(meta, now=None):
+    """
+    "current" (the audit reads the index), "stale" or "incomplete" (it scans every nota and
+    rebuilds it) from the _meta document's fields ({ "complete", "rebuilt_at" }).
+    """
+    if meta.get('complete') is not True: return "incomplete"
+    try:
+        rebuilt_at = parse_timestamp(meta['rebuilt_at'])
+    except (KeyError, TypeError, AttributeError, ValueError): # Missing or not an ISO string
+        return "stale"
+    if rebuilt_at < (now or datetime.now(timezone.utc)) - timedelta(days=INDEX_MAX_AGE_DAYS): return "stale"
+    return "current"
+
+
+def normalize_code(code):
+    """Same normalization as the audit: no spaces, upper case."""
+    return code.strip().replace(" ", "").upper()
+
+
+def shard_id(code):
+    # crc32 (not hash()) so every process maps a code to the same shard
+    return f"shard_{zlib.crc32(code.encode('utf-8')) % INDEX_SHARDS:02d}"
+
+
+def _quote(segment):
+    # Backtick-quoted field path segment: codes and nota ids may start with digits
+    return "`" + segment.replace('\\', '\\\\').replace('`', '\\`') + "`"
+
+
+def entry_field_path(code, nota_id):
+    return f"{INDEX_MAP_FIELD}.{_quote(code)}.{_quote(nota_id)}"
+
+
+def entry_value(item_index, data_iso):
+    """Firestore mapValue of one index entry."""
+    return encode_value({"item_index": item_index, "data_ocorrencia_iso": data_iso or None})
+
+
+def pending_items(itens, first_index=0):
+    """(item index, code) of the items still waiting for a match (no correios_match)."""
+    for idx, item in enumerate(itens, first_index):
+        code = normalize_code(item.get('unitizador', ''))
+        if code and not item.get('correios_match'):
+            yield idx, code
+
+
+def entries_by_shard(nota_id, itens, data_iso, first_index=0):
+    """
+    { shard id: { (code, nota id): entry value } } for the pending items (no correios_match) of one nota.
+    first_index: position of itens[0] in the nota (items appended after the stored ones).
+    """
+    shards = {}
+    for idx, code in pending_items(itens, first_index):
+        shards.setdefault(shard_id(code), {})[(code, nota_id)] = entry_value(idx, data_iso)
+    return shards
+
+
+def plain_shards(doc_itens, doc_dates):
+    """
+    Index contents as plain dicts, for clients that write python values (google-cloud-firestore, memory):
+    { shard id: { code: { nota id: { "item_index", "data_ocorrencia_iso" } } } } over every shard.
+    """
+    shards = {f"shard_{n:02d}": {} for n in range(INDEX_SHARDS)}
+    for nota_id, itens in doc_itens.items():
+        for idx, code in pending_items(itens):
+            shards[shard_id(code)].setdefault(code, {})[nota_id] = {
+                "item_index": idx, "data_ocorrencia_iso": doc_dates.get(nota_id)
+            }
+    return shards
+
+
+def add_entries(fields, entries, field_paths=None):
+    """
+    Writes { (code, nota id): entry value } into the "codes" map of a shard's Firestore fields.
+    With field_paths (an updateMask list) the path of every new entry is appended,
+    so a commit only touches those entries.
+    """
+    codes = fields.setdefault(INDEX_MAP_FIELD, {"mapValue": {"fields": {}}})['mapValue']['fields']
+    for (code, nota_id), value in entries.items():
+        notas = codes.setdefault(code, {"mapValue": {"fields": {}}})['mapValue']['fields']
+        if field_paths is not None and nota_id not in notas:
+            field_paths.append(entry_field_path(code, nota_id))
+        notas[nota_id] = value
+
+
+def concurrent_entries(loaded, current):
+    """
+    { (code, nota id): entry } of a shard written since it was loaded: in current but not in loaded
+    (both as read_entries / read_plain_entries). A rebuild keeps them: they come from notas
+    synced after the audit scan read them.
+    """
+    return {(code, nota_id): entry
+            for code, notas in current.items() for nota_id, entry in notas.items()
+            if loaded.get(code, {}).get(nota_id) != entry}
+
+
+def read_plain_entries(shard_maps):
+    """read_entries for shards read as plain dicts ({ "codes": { code: { nota id: entry } } })."""
+    entries = {}
+    for shard in shard_maps:
+        for code, notas in (shard.get(INDEX_MAP_FIELD) or {}).items():
+            entries.setdefault(code, {}).update(notas)
+    return entries
+
+
+def read_entries(shard_docs):
+    """{ code: { nota id: { "item_index", "data_ocorrencia_iso" } } } from shard documents."""
+    entries = {}
+    for doc in shard_docs:
+        codes = decode_fields(doc.get('fields', {})).get(INDEX_MAP_FIELD) or {}
+        for code, notas in codes.items():
+            entries.setdefault(code, {}).update(
+                (nota_id, {"item_index": as_int(entry.get('item_index')),
+                           "data_ocorrencia_iso": as_str(entry.get('data_ocorrencia_iso'), None)})
+                for nota_id, entry in notas.items()
+            )
+    return entries
@@ -1,16 +1,47 @@
 from http.server import BaseHTTPRequestHandler
 import os
+import sys
 import json
-import cgi
-import re
+import time
+import zlib
+from urllib.parse import urlparse, parse_qs
 from datetime import datetime
-import io
 
 # Third-party imports moved inside functions to allow error catching
-# import pdfplumber
-# import requests
+# import pdfplumber (api/_pdf_text.py)
 # from google.oauth2 import service_account
 # from google.auth.transport.requests import Request
+# from _http_client import AuthHeaders, authorized_request, iter_json_array (pooled session + retry)
+
+# Shared helpers live next to the handlers (api/_*.py are not exposed as routes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _audit_engine import run_audit
+from _pdf_text import DiskTextCache
+from _multipart import parse_multipart, MultipartError
+from _bulk_writer import BulkWriter
+from _firestore_codec import encode_fields, encode_value, decode_fields, decode_value, decode_records, as_str
+from _audit_jobs import (FirestoreJobStore, StorageUploads, ProgressReporter, CheckpointSaver, STORAGE_PREFIX,
+                         JOB_MAX_DURATION_SECONDS, JOB_STEP_MARGIN_SECONDS, new_job_id, job_status)
+from _unitizer_index import (INDEX_COLLECTION, INDEX_SHARDS, INDEX_META_DOC,
+                             shard_id, entry_field_path, entry_value, entries_by_shard, add_entries, read_entries,
+                             concurrent_entries)
+
+COLLECTION_NAME = "tb_despachos_conferencia"
+RUN_QUERY_PAGE_SIZE = 300 # Documents per runQuery page (cursor pagination)
+BATCH_GET_CHUNK_SIZE = 100
+COMMIT_CHUNK_SIZE = 500 # Firestore limit of writes per commit
+INDEX_REBUILD_ATTEMPTS = 3 # Commits of the index shards a concurrent sync keeps changing
+# Projection: Firestore cannot select sub-fields of array elements
+AUDIT_ITEM_FIELDS = ["itens", "data_ocorrencia_iso"]
+AUDIT_ITEM_SCHEMA = {
+    "unitizador": "", "lacre": "", "peso": 0.0, "conferido": False,
+    # Preserve existing correios check if needed, or overwrite?
+    # Plan: overwrite if found in current PDF, preserve otherwise.
+    "correios_match": False, "correios_ref_month": "", "correios_type": "", "correios_value": 0.0
+}
+PDF_CACHE_COLLECTION = "tb_pdf_text_cache"
+PDF_CACHE_MAX_DOCS = 24 # About two years of monthly Postal + Densa extratos
+PDF_CACHE_MAX_DOC_BYTES = 1000 * 1000 # Compressed text; Firestore documents are limited to 1 MiB
 
 # -------------------------------------------------------------------------
 # FIRESTORE CLIENT (Simplified from sync_emails.py)
@@ -18,305 +49,483 @@ import io
 class FirestoreClient:
     def __init__(self, service_account_info):
         self.project_id = service_account_info.get("project_id")
-        self.base_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents"
+        self.documents_path = f"projects/{self.project_id}/databases/(default)/documents"
+        self.base_url = f"https://firestore.googleapis.com/v1/{self.documents_path}"
         self.creds = service_account.Credentials.from_service_account_info(
             service_account_info,
-            scopes=["https://www.googleapis.com/auth/datastore"]
+            scopes=["https://www.googleapis.com/auth/datastore",
+                    "https://www.googleapis.com/auth/devstorage.read_write"] # Job uploads (Firebase Storage)
         )
+        self.auth = AuthHeaders(self.creds, Request)
 
-    def _get_token(self):
-        if not self.creds.valid:
-            self.creds.refresh(Request())
-        return self.creds.token
-
-    def _headers(self):
-        return {
-            "Authorization": f"Bearer {self._get_token()}",
-            "Content-Type": "application/json"
-        }
+    def _request(self, method, url, **kwargs):
+        """Pooled keep-alive request with retry/backoff and cached auth headers."""
+        return authorized_request(self.auth, method, url, **kwargs)
 
-    def run_query(self, collection):
-        """Fetches ALL documents from a collection (simplified)"""
+    def run_query(self, collection, fields=None, where=None, order_by=None, page_size=RUN_QUERY_PAGE_SIZE):
+        """
+        Yields the documents of a collection, one runQuery page at a time (cursor pagination).
+        Each page is decoded as it streams in, so only one document is held at a time.
+        fields: projection (field paths); where: Firestore filter; order_by: field of the range filter, if any.
+        """
         url = f"{self.base_url}:runQuery"
-        # Query to select all documents
+        order_fields = ([order_by] if order_by else []) + ["__name__"]
         query = {
-            "structuredQuery": {
-                "from": [{"collectionId": collection}]
-            }
+            "from": [{"collectionId": collection}],
+            "orderBy": [{"field": {"fieldPath": f}, "direction": "ASCENDING"} for f in order_fields],
+            "limit": page_size
         }
-        response = requests.post(url, headers=self._headers(), json=query)
-        if response.status_code == 200:
-            return response.json()
-        raise Exception(f"Firestore Query Error {response.status_code}")
-
-    def update_document(self, collection, doc_id, data):
-        """Updates specific fields (merge behavior)"""
-        # Convert simple dict to Firestore JSON
-        fields = {}
-        for k, v in data.items():
-            if isinstance(v, str): fields[k] = {"stringValue": v}
-            elif isinstance(v, bool): fields[k] = {"booleanValue": v}
-            elif isinstance(v, (int, float)): fields[k] = {"doubleValue": float(v)}
-            elif isinstance(v, list): 
-                # Basic support for array of objects update NOT implemented here for brevity
-                # We typically update the whole 'itens' array
-                pass 
-                
-        # For 'itens', we need to construct the complex arrayValue
-        if 'itens' in data:
-            array_values = []
-            for item in data['itens']:
-                item_fields = {}
-                for ik, iv in item.items():
-                    if isinstance(iv, str): item_fields[ik] = {"stringValue": iv}
-                    elif isinstance(iv, bool): item_fields[ik] = {"booleanValue": iv}
-                    elif isinstance(iv, (int, float)): item_fields[ik] = {"doubleValue": float(iv)}
-                array_values.append({"mapValue": {"fields": item_fields}})
-            fields['itens'] = {"arrayValue": {"values": array_values}}
-
-        # Construct patch URL with updateMask
-        params = [f"updateMask.fieldPaths={k}" for k in fields.keys()]
-        query_string = "&".join(params)
-        url = f"{self.base_url}/{collection}/{doc_id}?{query_string}"
-        
-        body = {"fields": fields}
-        requests.patch(url, headers=self._headers(), json=body)
+        if fields is not None:
+            # The cursor needs the order_by value of the last document
+            selected = list(fields) + ([order_by] if order_by and order_by not in fields else [])
+            query["select"] = {"fields": [{"fieldPath": f} for f in selected]}
+        if where:
+            query["where"] = where
+
+        while True:
+            response = self._request('POST', url, json={"structuredQuery": query}, stream=True)
+            count, last = 0, None
+            try:
+                if response.status_code != 200:
+                    raise Exception(f"Firestore Query Error {response.status_code}")
+                for result in iter_json_array(response):
+                    if 'document' not in result: continue
+                    last = result['document']
+                    count += 1
+                    yield last
+            finally:
+                response.close()
+
+            if count < page_size: return
+            cursor = [last['fields'][order_by]] if order_by else []
+            cursor.append({"referenceValue": last['name']})
+            query["startAt"] = {"values": cursor, "before": False}
+
+    def batch_get(self, collection, doc_ids):
+        """
+        Fetches many documents through documents:batchGet (BATCH_GET_CHUNK_SIZE per call).
+        Returns: { doc_id: document or None (not found) }
+        """
+        doc_ids = list(dict.fromkeys(doc_ids))
+        url = f"{self.base_url}:batchGet"
+        results = {}
+
+        for start in range(0, len(doc_ids), BATCH_GET_CHUNK_SIZE):
+            chunk = doc_ids[start:start + BATCH_GET_CHUNK_SIZE]
+            body = {"documents": [f"{self.documents_path}/{collection}/{doc_id}" for doc_id in chunk]}
+            response = self._request('POST', url, json=body)
+            if response.status_code != 200:
+                raise Exception(f"Firestore BATCHGET Error {response.status_code}")
+
+            for entry in response.json():
+                if 'found' in entry:
+                    results[entry['found']['name'].split('/')[-1]] = entry['found']
+                elif 'missing' in entry:
+                    results[entry['missing'].split('/')[-1]] = None
+        return results
+
+    def commit(self, writes):
+        """
+        Applies raw Firestore writes through documents:commit, COMMIT_CHUNK_SIZE per call.
+        A rejected chunk is retried write by write. Returns the writes that failed.
+        """
+        url = f"{self.base_url}:commit"
+        failed = []
+        for start in range(0, len(writes), COMMIT_CHUNK_SIZE):
+            chunk = writes[start:start + COMMIT_CHUNK_SIZE]
+            if self._request('POST', url, json={"writes": chunk}).status_code == 200: continue
+            for write in chunk:
+                if len(chunk) == 1 or self._request('POST', url, json={"writes": [write]}).status_code != 200:
+                    failed.append(write)
+        return failed
+
+    def bulk_write(self, writes, on_progress=None):
+        """Many document writes, batched and in parallel (api/_bulk_writer.py). Returns the failures."""
+        return BulkWriter(self._request, self.base_url).write(writes, on_progress)
+
+    def update_write(self, collection, doc_id, data, update_time=None):
+        """
+        Field merge (updateMask of data's keys) as a write object (for commit / bulk_write).
+        update_time: the version read; the write then fails (FAILED_PRECONDITION) if the document changed.
+        """
+        fields = encode_fields(data)
+        write = {
+            "update": {"name": f"{self.documents_path}/{collection}/{doc_id}", "fields": fields},
+            "updateMask": {"fieldPaths": list(fields.keys())}
+        }
+        if update_time: write['currentDocument'] = {"updateTime": update_time}
+        return write
+
+def doc_items(doc):
+    """Items of a nota (fields the audit reads and writes back)."""
+    return decode_records(doc.get('fields', {}).get('itens', {}), AUDIT_ITEM_SCHEMA)
 
 # -------------------------------------------------------------------------
-# PDF TEXT EXTRACTION
+# UNITIZER INDEX (api/_unitizer_index.py)
 # -------------------------------------------------------------------------
-def extract_text_from_pdf(file_bytes):
-    text_content = ""
-    try:
-        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text:
-                    text_content += text + "\n"
-        
-        # Normalize: Remove all whitespace and uppercase
-        normalized = re.sub(r'\s+', '', text_content).upper()
-        return normalized
-    except Exception as e:
-        print(f"Erro ao ler PDF: {e}")
-        return ""
+def index_removal_writes(db, code_notas, shard_docs):
+    """
+    Deletes the entries { code: [doc_ids] } from their shards;
+    each write is conditioned on the shard version that was read.
+    """
+    by_shard = {}
+    for code, doc_ids in code_notas.items():
+        by_shard.setdefault(shard_id(code), []).extend(entry_field_path(code, doc_id) for doc_id in doc_ids)
+
+    writes = []
+    for shard, paths in by_shard.items():
+        write = {
+            "update": {"name": f"{db.documents_path}/{INDEX_COLLECTION}/{shard}", "fields": {}},
+            "updateMask": {"fieldPaths": paths} # Paths missing from "fields" are deleted
+        }
+        if shard in shard_docs:
+            write['currentDocument'] = {"updateTime": shard_docs[shard]['updateTime']}
+        writes.append(write)
+    return writes
+
+def index_rebuild_entries(doc_itens, doc_dates):
+    """{ shard id: { (code, nota id): entry value } } of the pending items of the scanned notas, over every shard."""
+    shards = {f"shard_{n:02d}": {} for n in range(INDEX_SHARDS)}
+    for doc_id, items in doc_itens.items():
+        for shard, entries in entries_by_shard(doc_id, items, doc_dates.get(doc_id)).items():
+            shards[shard].update(entries)
+    return shards
+
+def index_rebuild_write(db, shard, entries, shard_doc):
+    """Overwrites a shard with entries, on condition that it is still shard_doc (the version read; None if missing)."""
+    fields = {}
+    add_entries(fields, entries)
+    return {
+        "update": {"name": f"{db.documents_path}/{INDEX_COLLECTION}/{shard}", "fields": fields},
+        "currentDocument": {"updateTime": shard_doc['updateTime']} if shard_doc else {"exists": False}
+    }
+
+def index_complete_write(db):
+    return {"update": {"name": f"{db.documents_path}/{INDEX_COLLECTION}/{INDEX_META_DOC}", "fields": encode_fields({
+        "complete": True,
+        "rebuilt_at": datetime.utcnow().isoformat() + "Z"
+    })}}
+
+# -------------------------------------------------------------------------
+# PDF TEXT CACHE (shared by every instance, behind the local DiskTextCache)
+# -------------------------------------------------------------------------
+class FirestoreTextCache:
+    """Extracted PDF texts as zlib-compressed documents, least recently used evicted above PDF_CACHE_MAX_DOCS."""
+    def __init__(self, db):
+        self.db = db
+
+    def _name(self, key):
+        return f"{self.db.documents_path}/{PDF_CACHE_COLLECTION}/{key}"
+
+    def _last_used(self):
+        return encode_value(datetime.utcnow().isoformat() + "Z")
+
+    def get(self, key):
+        doc = self.db.batch_get(PDF_CACHE_COLLECTION, [key]).get(key)
+        if not doc: return None
+        self.db.commit([{
+            "update": {"name": self._name(key), "fields": {"last_used": self._last_used()}},
+            "updateMask": {"fieldPaths": ["last_used"]}
+        }])
+        return zlib.decompress(decode_value(doc['fields']['text'])).decode('utf-8')
+
+    def put(self, key, text):
+        data = zlib.compress(text.encode('utf-8'), 6)
+        if len(data) > PDF_CACHE_MAX_DOC_BYTES:
+            print(f"Aviso: texto do PDF grande demais para o cache ({len(data)} bytes)")
+            return
+        self.db.commit([{"update": {"name": self._name(key), "fields": {
+            "text": encode_value(data),
+            "last_used": self._last_used()
+        }}}])
+
+        entries = sorted(
+            (as_str(decode_value(doc.get('fields', {}).get('last_used', {}))), doc['name'])
+            for doc in self.db.run_query(PDF_CACHE_COLLECTION, fields=["last_used"])
+        )
+        evicted = [{"delete": name} for _, name in entries[:max(0, len(entries) - PDF_CACHE_MAX_DOCS)]]
+        if evicted:
+            self.db.commit(evicted)
+
+# -------------------------------------------------------------------------
+# AUDIT DATE WINDOW
+# -------------------------------------------------------------------------
+def audit_date_window(bounds):
+    """Firestore filter for _audit_engine.audit_date_bounds()."""
+    def bound(op, value):
+        return {"fieldFilter": {
+            "field": {"fieldPath": "data_ocorrencia_iso"},
+            "op": op,
+            "value": encode_value(value)
+        }}
+    return {"compositeFilter": {"op": "AND", "filters": [
+        bound("GREATER_THAN_OR_EQUAL", bounds[0]),
+        bound("LESS_THAN", bounds[1])
+    ]}}
+
+# -------------------------------------------------------------------------
+# AUDIT BACKEND (api/_audit_engine.py)
+# -------------------------------------------------------------------------
+class FirestoreRestBackend:
+    """Audit engine storage over the Firestore REST API (FirestoreClient)."""
+    def __init__(self, db):
+        self.db = db
+        self.shard_docs = {} # Index shards as read: their updateTime guards the removals
+        self.versions = {} # { nota id: updateTime as read } - guards the itens writes
+
+    def text_caches(self):
+        # This instance's /tmp, then the copy shared by every instance
+        return [DiskTextCache(), FirestoreTextCache(self.db)]
+
+    def load_index(self):
+        self.shard_docs = {doc['name'].split('/')[-1]: doc for doc in self.db.run_query(INDEX_COLLECTION)}
+        index_meta = decode_fields(self.shard_docs.pop(INDEX_META_DOC, {}).get('fields', {}))
+        return index_meta, read_entries(self.shard_docs.values())
+
+    def iter_notas(self, bounds):
+        # Page by page, only the fields the audit reads
+        documents = self.db.run_query(COLLECTION_NAME, fields=AUDIT_ITEM_FIELDS,
+                                      where=audit_date_window(bounds) if bounds else None,
+                                      order_by="data_ocorrencia_iso" if bounds else None)
+        for doc in documents:
+            doc_id = doc['name'].split('/')[-1]
+            data_iso = as_str(decode_value(doc.get('fields', {}).get('data_ocorrencia_iso', {})), None)
+            self.versions[doc_id] = doc.get('updateTime')
+            yield doc_id, data_iso, doc_items(doc)
+
+    def get_notas(self, doc_ids):
+        notas = {}
+        for doc_id, doc in self.db.batch_get(COLLECTION_NAME, doc_ids).items():
+            if not doc: continue
+            self.versions[doc_id] = doc.get('updateTime')
+            notas[doc_id] = doc_items(doc)
+        return notas
+
+    def write_itens(self, itens_by_nota, on_progress=None):
+        # Written in batchWrite calls, several in flight (a failed nota is retried on its own);
+        # a nota changed since it was read fails its updateTime precondition
+        writes = [self.db.update_write(COLLECTION_NAME, doc_id, {"itens": items}, self.versions.get(doc_id))
+                  for doc_id, items in itens_by_nota.items()]
+        failed = set()
+        for failure in self.db.bulk_write(writes, on_progress=on_progress):
+            print(f"Aviso: nota {failure['name'].split('/')[-1]} nao atualizada ({failure['error']})")
+            failed.add(failure['name'].split('/')[-1])
+        return failed
+
+    def remove_index_entries(self, code_notas):
+        # A shard changed by a concurrent sync is skipped: its stale entries only cost a batchGet on the next audit
+        self._commit_index(index_removal_writes(self.db, code_notas, self.shard_docs))
+
+    def rebuild_index(self, doc_itens, doc_dates):
+        # Each shard is replaced on condition of the version load_index read; one a sync changed
+        # meanwhile is read again, keeps what that sync added and is retried on its new version
+        shards = index_rebuild_entries(doc_itens, doc_dates)
+        loaded = {shard: read_entries([doc]) for shard, doc in self.shard_docs.items()}
+        versions = dict(self.shard_docs)
+        pending = list(shards)
+        for _ in range(INDEX_REBUILD_ATTEMPTS):
+            failed = self.db.commit([index_rebuild_write(self.db, shard, shards[shard], versions.get(shard))
+                                     for shard in pending])
+            pending = [write['update']['name'].split('/')[-1] for write in failed]
+            if not pending: break
+            for shard, doc in self.db.batch_get(INDEX_COLLECTION, pending).items():
+                versions[shard] = doc
+                for key, entry in concurrent_entries(loaded.get(shard, {}), read_entries([doc] if doc else [])).items():
+                    shards[shard][key] = entry_value(entry['item_index'], entry['data_ocorrencia_iso'])
+
+        if pending:
+            # Not marked complete: the next full scan rebuilds it again
+            print(f"Aviso: indice de unitizadores nao reconstruido ({len(pending)} shards alterados durante a auditoria)")
+            return
+        self._commit_index([index_complete_write(self.db)])
+
+    def _commit_index(self, writes):
+        if writes and self.db.commit(writes):
+            print("Aviso: indice de unitizadores nao foi totalmente atualizado")
 
 # -------------------------------------------------------------------------
 # HANDLER
 # -------------------------------------------------------------------------
+def load_dependencies():
+    """Lazy Import to catch deployment errors (bound as module globals so FirestoreClient can use them)"""
+    global service_account, Request, AuthHeaders, authorized_request, iter_json_array
+    import pdfplumber # Used by _pdf_text
+    from google.oauth2 import service_account
+    from google.auth.transport.requests import Request
+    from _http_client import AuthHeaders, authorized_request, iter_json_array
+
+def setup_firestore():
+    firebase_creds = json.loads(os.environ.get('FIREBASE_SERVICE_ACCOUNT'))
+    return FirestoreClient(firebase_creds)
+
+def job_uploads(db):
+    bucket = os.environ.get('FIREBASE_STORAGE_BUCKET') or f"{db.project_id}.firebasestorage.app"
+    return StorageUploads(db.auth, bucket)
+
+def run_job(db, job_id):
+    """
+    Job worker: claims the job, downloads its extratos and runs one step of the audit, reporting
+    progress. A step stops JOB_STEP_MARGIN_SECONDS before the function's maxDuration; the job is
+    then "paused" with its checkpoint, and the next trigger of the same URL resumes it.
+    Returns the job status, or None if the job is missing or another worker holds it.
+    """
+    step_deadline = time.monotonic() + JOB_MAX_DURATION_SECONDS - JOB_STEP_MARGIN_SECONDS
+    store = FirestoreJobStore(db)
+    job = store.claim(job_id, worker_id=new_job_id())
+    if not job: return None
+
+    uploads = job_uploads(db)
+    paths = []
+    try:
+        files_to_process = []
+        for file_info in job['files']:
+            paths.append(uploads.get(file_info['object']))
+            files_to_process.append({**file_info, 'path': paths[-1]})
+
+        params = job['params']
+        result = run_audit(FirestoreRestBackend(db), files_to_process,
+                           ref_months=params.get('ref_months', []),
+                           date_margin_days=params.get('date_margin_days'),
+                           rebuild_index=params.get('rebuild_index', False),
+                           progress=ProgressReporter(lambda phase, counters: store.progress(job_id, phase, counters)),
+                           checkpoint=store.checkpoint(job_id, job),
+                           pause=lambda: time.monotonic() > step_deadline,
+                           on_checkpoint=CheckpointSaver(lambda checkpoint: store.save_checkpoint(job_id, checkpoint)))
+        if result['status'] == "paused":
+            store.pause(job_id, result['checkpoint']) # The extratos stay in Storage for the next step
+        else:
+            store.finish(job_id, result)
+            for file_info in job['files']:
+                uploads.delete(file_info['object'])
+    except Exception as e:
+        print(f"Erro no job {job_id}: {e}")
+        store.fail(job_id, e)
+    finally:
+        for path in paths:
+            os.remove(path)
+    return job_status(job_id, store.get(job_id)[0])
+
 class handler(BaseHTTPRequestHandler):
     
+    def send_json(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode('utf-8'))
+
+    def do_GET(self):
+        """Job status: ?job=<id>; result pages of a finished job: ?job=<id>&page=<n> (from 0)."""
+        try:
+            load_dependencies()
+            query = parse_qs(urlparse(self.path).query)
+            job_id = query.get('job', [None])[0]
+            if not job_id:
+                self.send_error(400, "Parametro 'job' obrigatorio")
+                return
+
+            store = FirestoreJobStore(setup_firestore())
+            job, _ = store.get(job_id)
+            if not job:
+                self.send_error(404, "Job nao encontrado")
+                return
+            if 'page' in query:
+                page = query['page'][0]
+                if not page.isdigit():
+                    self.send_error(400, "Parametro 'page' deve ser um numero >= 0")
+                    return
+                if job['phase'] != "done":
+                    self.send_json(409, job_status(job_id, job))
+                    return
+                self.send_json(200, store.result_page(job_id, int(page)))
+            else:
+                self.send_json(200, job_status(job_id, job))
+
+        except Exception as e:
+            print(f"Error: {e}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+
     def do_POST(self):
+        """
+        Audit upload (multipart). With the form field mode=job the extratos are stored and
+        a job id is returned at once (202); the audit then runs on POST ?job=<id>&action=run,
+        one step per call: while the status answers "paused", the client calls it again.
+        """
+        form = None
         try:
-            # Lazy Import to catch deployment errors
-            import pdfplumber
-            import requests
-            from google.oauth2 import service_account
-            from google.auth.transport.requests import Request
-            
-            # 1. Parse Multipart Form Data
-            ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
-            if ctype != 'multipart/form-data':
-                self.send_error(400, "Content-Type must be multipart/form-data")
+            load_dependencies()
+
+            # Job worker
+            query = parse_qs(urlparse(self.path).query)
+            if query.get('action', [None])[0] == "run" and query.get('job'):
+                status = run_job(setup_firestore(), query['job'][0])
+                if status is None:
+                    self.send_error(409, "Job inexistente, concluido ou em execucao")
+                    return
+                self.send_json(200, status)
+                return
+
+            # 1. Parse Multipart Form Data (the PDFs are spooled to temp files, removed in `finally`)
+            try:
+                form = parse_multipart(self.rfile, self.headers)
+            except MultipartError as e:
+                self.send_error(400, str(e))
                 return
-            
-            pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
-            form = cgi.FieldStorage(
-                fp=self.rfile, 
-                headers=self.headers,
-                environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']}
-            )
 
             # 2. Setup Firestore
-            firebase_creds = json.loads(os.environ.get('FIREBASE_SERVICE_ACCOUNT'))
-            db = FirestoreClient(firebase_creds)
-            
-            # 3. Fetch Existing Data (All Dispatch Notes)
-            # Optimization: In real prod, we might want to filter, but here we need to cross-check everything
-            query_results = db.run_query("tb_despachos_conferencia")
-            
-            # Index Unitizers: { "UNIT_CODE": { "doc_id": "...", "item_index": 0, "current_data": {...} } }
-            unitizer_map = {}
+            db = setup_firestore()
             
-            for doc_wrapper in query_results:
-                if 'document' not in doc_wrapper: continue
-                
-                doc = doc_wrapper['document']
-                doc_id = doc.name.split('/')[-1]
-                fields = doc.get('fields', {})
-                
-                # Extract 'itens' array
-                itens_array = fields.get('itens', {}).get('arrayValue', {}).get('values', [])
-                
-                for idx, item_wrapper in enumerate(itens_array):
-                    item_fields = item_wrapper.get('mapValue', {}).get('fields', {})
-                    
-                    code = item_fields.get('unitizador', {}).get('stringValue', '').strip()
-                    if not code: continue
-                    
-                    # Store current state
-                    unitizer_map[code.replace(" ", "").upper()] = {
-                        "doc_id": doc_id,
-                        "item_index": idx,
-                        "data": {
-                            "unitizador": item_fields.get('unitizador', {}).get('stringValue', ''),
-                            "lacre": item_fields.get('lacre', {}).get('stringValue', ''),
-                            "peso": float(item_fields.get('peso', {}).get('doubleValue', 0)),
-                            "conferido": item_fields.get('conferido', {}).get('booleanValue', False),
-                            # Preserve existing correios check if needed, or overwrite? 
-                            # Plan: overwrite if found in current PDF, preserve otherwise.
-                            "correios_match": item_fields.get('correios_match', {}).get('booleanValue', False),
-                            "correios_ref_month": item_fields.get('correios_ref_month', {}).get('stringValue', ''),
-                            "correios_type": item_fields.get('correios_type', {}).get('stringValue', ''),
-                            "correios_value": float(item_fields.get('correios_value', {}).get('doubleValue', 0)),
-                        }
-                    }
-
             # 4. Process Files
             files_to_process = []
             
-            if 'file_postal' in form:
+            if 'file_postal' in form.files:
                 files_to_process.append({
                     'type': 'Postal',
-                    'bytes': form['file_postal'].file.read(),
+                    'path': form.files['file_postal'].path,
                     'month': form.getvalue('month_postal'),
                     'price': float(form.getvalue('price_postal', 2.89))
                 })
                 
-            if 'file_densa' in form:
+            if 'file_densa' in form.files:
                 files_to_process.append({
                     'type': 'Densa',
-                    'bytes': form['file_densa'].file.read(),
+                    'path': form.files['file_densa'].path,
                     'month': form.getvalue('month_densa'),
                     'price': float(form.getvalue('price_densa', 0.39))
                 })
 
-            total_found = 0
-            missing_codes = []
-            updates_by_doc = {} # { "doc_id": [modified_items_list] }
-
-            # Pre-load all known codes to "missing" list, remove as found
-            # Actually, user wants "Unitizadores que não foram encontrados nos PDFs INDICADOS"
-            # This implies we scan the PDF for unitizers? Or we scan the DB unitizers against the PDF?
-            # "compararemos os unitizadores extraídos dos e-mails com os extratos" -> 
-            # Source of truth = DB (emails). Target = PDF.
-            # IF DB item IN PDF -> Found. IF DB item NOT IN PDF -> Missing.
-            
-            # Let's collect ALL DB codes first
-            all_db_codes = set(unitizer_map.keys())
-            found_codes = set()
-            
-            # 5. Audit Logic
-            for file_info in files_to_process:
-                pdf_text = extract_text_from_pdf(file_info['bytes'])
-                
-                # Check each DB unitizer against this PDF
-                for code, info in unitizer_map.items():
-                    if code in pdf_text:
-                        found_codes.add(code)
-                        
-                        # Prepare Update
-                        item_data = info['data']
-                        item_data['correios_match'] = True
-                        item_data['correios_ref_month'] = file_info['month']
-                        item_data['correios_type'] = file_info['type']
-                        item_data['correios_value'] = file_info['price']
-                        
-                        doc_id = info['doc_id']
-                        if doc_id not in updates_by_doc:
-                            # Need to reconstruct the FULL items list for this doc to update it safely
-                            # This is tricky without full doc context.
-                            # Better approach: We have the full `query_results`.
-                            updates_by_doc[doc_id] = {} # Placeholder
-                        
-            # 6. Apply Updates
-            # We need to iterate over `updates_by_doc` and commit changes.
-            # Since we need to update the WHOLE `itens` array to avoid index shifting issues (though indices should be stable),
-            # let's map back to the original docs.
-            
-            batch_updates = 0
-            
-            # Re-iterate documents to build final payloads
-            for doc_wrapper in query_results:
-                if 'document' not in doc_wrapper: continue
-                doc_id = doc_wrapper['document'].name.split('/')[-1]
-                
-                # Check if this doc has any found items
-                doc_needs_update = False
-                
-                fields = doc_wrapper['document'].get('fields', {})
-                current_itens = []
-                
-                # Re-parse items from this doc
-                raw_itens = fields.get('itens', {}).get('arrayValue', {}).get('values', [])
-                
-                for raw_item in raw_itens:
-                    i_fields = raw_item.get('mapValue', {}).get('fields', {})
-                    
-                    # Reconstruct item dict
-                    item_dict = {
-                        "unitizador": i_fields.get('unitizador', {}).get('stringValue', ''),
-                        "lacre": i_fields.get('lacre', {}).get('stringValue', ''),
-                        "peso": float(i_fields.get('peso', {}).get('doubleValue', 0)),
-                        "conferido": i_fields.get('conferido', {}).get('booleanValue', False),
-                        "correios_match": i_fields.get('correios_match', {}).get('booleanValue', False),
-                        "correios_ref_month": i_fields.get('correios_ref_month', {}).get('stringValue', ''),
-                        "correios_type": i_fields.get('correios_type', {}).get('stringValue', ''),
-                        "correios_value": float(i_fields.get('correios_value', {}).get('doubleValue', 0)),
-                    }
-                    
-                    code = item_dict['unitizador'].replace(" ", "").upper()
-                    
-                    # Update logic
-                    if code in found_codes:
-                        # Find which file matched it (optimization: we just know it was found in *one of them*)
-                        # Retrieve the specific match details from our unitizer_map loop?
-                        # Actually, our unitizer_map loop above updated the 'data' dict.
-                        # Let's use that.
-                        updated_data = unitizer_map.get(code, {}).get('data')
-                        if updated_data and updated_data.get('correios_match'):
-                            if item_dict['correios_match'] != True: # Only update if changed
-                                item_dict = updated_data
-                                doc_needs_update = True
-                            # If already true, maybe update metadata if different? 
-                            # For simplicity, assume if match true, checking again updates metadata.
-                            if item_dict['correios_ref_month'] != updated_data['correios_ref_month']:
-                                item_dict = updated_data
-                                doc_needs_update = True
-                    
-                    current_itens.append(item_dict)
-
-                if doc_needs_update:
-                    db.update_document("tb_despachos_conferencia", doc_id, {"itens": current_itens})
-                    batch_updates += 1
-
-            # 7. Calculate Missing
-            missing_list = list(all_db_codes - found_codes)
-            
-            # Response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response_data = {
-                "status": "success",
-                "found_count": len(found_codes),
-                "missing_count": len(missing_list),
-                "total_processed": len(all_db_codes),
-                "docs_updated": batch_updates,
-                "missing_codes": sorted(missing_list)
+            params = {
+                "ref_months": [form.getvalue('month_postal'), form.getvalue('month_densa')],
+                "date_margin_days": form.getvalue('date_margin_days'),
+                "rebuild_index": bool(form.getvalue('rebuild_index'))
             }
-            
-            self.wfile.write(json.dumps(response_data).encode('utf-8'))
+
+            if form.getvalue('mode') == "job":
+                # Store the extratos and answer right away; a worker runs the audit
+                job_id = new_job_id()
+                uploads = job_uploads(db)
+                job_files = []
+                for file_info in files_to_process:
+                    name = f"{STORAGE_PREFIX}/{job_id}/{file_info['type'].lower()}.pdf"
+                    uploads.put(name, file_info['path'])
+                    job_files.append({k: v for k, v in file_info.items() if k != 'path'} | {"object": name})
+                FirestoreJobStore(db).create(job_id, params, job_files)
+                self.send_json(202, {"job_id": job_id, "phase": "queued",
+                                     "status_url": f"/api/audit_pdf?job={job_id}",
+                                     "run_url": f"/api/audit_pdf?job={job_id}&action=run"})
+                return
+
+            self.send_json(200, run_audit(FirestoreRestBackend(db), files_to_process, **params))
 
         except Exception as e:
             print(f"Error: {e}")
             self.send_error(500, f"Internal Server Error: {str(e)}")
+        finally:
+            if form: form.cleanup()
 
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
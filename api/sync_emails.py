@@ -1,35 +1,81 @@
 from http.server import BaseHTTPRequestHandler
 import os
+import sys
 import json
 import base64
+import random
 import re
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
-import requests
+
+# Shared helpers live next to the handlers (api/_*.py are not exposed as routes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _http_client import AuthHeaders, authorized_request
+from _email_table import parse_tables, UnsupportedMarkup, LIST_SEPARATOR
+from _unitizer_index import INDEX_COLLECTION, entries_by_shard, add_entries
+from _reconciliation import reconcile, divergence_text
+from _firestore_codec import encode_fields, encode_value, decode_value, decode_records, as_str, as_int, as_list
 
 # Third-party libraries
+import httplib2
 from bs4 import BeautifulSoup
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 
 # -------------------------------------------------------------------------
 # CONSTANTS & CONFIGURATION
 # -------------------------------------------------------------------------
-MAX_EMAILS_PER_RUN = 50
+MAX_EMAILS_PER_RUN = 500 # Hard cap; the time budget below decides how many actually run
+SYNC_MAX_DURATION_SECONDS = int(os.environ.get('SYNC_MAX_DURATION_SECONDS', 60)) # maxDuration of api/sync_emails.py (vercel.json)
+SYNC_STARTUP_MARGIN_SECONDS = 10 # Cold start (imports, clients) before start_time, and the response
+# The run must end before the function is killed at maxDuration (the env var overrides it for local runs)
+SYNC_TIME_BUDGET_SECONDS = float(os.environ.get('SYNC_TIME_BUDGET_SECONDS',
+                                                SYNC_MAX_DURATION_SECONDS - SYNC_STARTUP_MARGIN_SECONDS))
+SYNC_SAFETY_MARGIN_SECONDS = 8 # Kept free for the final commit, label swap and metadata
+INITIAL_EMAIL_COST_SECONDS = 0.5 # Estimate until the first chunk has been measured
+GMAIL_BATCH_SIZE = 50 # Gmail recommends at most 50 calls per batch request
+GMAIL_BATCH_RETRIES = 5 # Rounds of a batch fetch; each one only sends again the calls rate limited or failed with 5xx
+GMAIL_BACKOFF_BASE_SECONDS = 1.0 # Wait before a retry round: random up to base * 2^round (full jitter)
+GMAIL_BACKOFF_MAX_SECONDS = 16.0
+GMAIL_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded") # 403 reasons that are rate limits
+SYNC_FETCH_WORKERS = 4 # Concurrent Gmail batch round-trips (also used for nota prefetches)
+SYNC_PIPELINE_DEPTH = 8 # Max chunks in flight between the fetch, parse and persist stages
+# Two-tier fetch: every message is screened from its Subject/Date headers, only the
+# recognized ones are downloaded again with their MIME parts (body data only)
+GMAIL_METADATA_HEADERS = ["Subject", "Date"]
+GMAIL_METADATA_FIELDS = "id,labelIds,internalDate,payload/headers"
+GMAIL_MIME_DEPTH = 5 # Nesting levels of MIME parts searched for the HTML (mixed > related > alternative > ...)
+ENTRADA_SUBJECTS = ("Recebimento de Carga", "Recebimento de carga")
+SAIDA_SUBJECTS = ("Devolução de carga", "Devolução de Carga")
 LABEL_NAME = "ROBO_TIM"
 LABEL_PROCESSED = "PROCESSADO"
 COLLECTION_NAME = "tb_despachos_conferencia"
+BATCH_GET_CHUNK_SIZE = 100
+COMMIT_CHUNK_SIZE = 500 # Firestore limit of writes per commit
+STORED_ITEM_SCHEMA = {"unitizador": "", "lacre": "", "peso": 0.0, "conferido": False} # Item fields the merge keeps
+# "delta": a merge that only adds unitizers appends them to the stored array (appendMissingElements);
+# "full": every merge rewrites the whole itens / itens_conferencia array
+SYNC_ITEM_WRITES = os.environ.get('SYNC_ITEM_WRITES', 'delta')
+RUNTIME_CACHE_TTL_SECONDS = 30 * 60
 
 # -------------------------------------------------------------------------
 # FIRESTORE REST API HELPERS
 # -------------------------------------------------------------------------
+NO_PRECONDITION = object() # queue_* default: write without a currentDocument precondition
+
 class FirestoreClient:
     def __init__(self, service_account_info):
         self.project_id = service_account_info.get("project_id")
-        self.base_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents"
+        self.documents_path = f"projects/{self.project_id}/databases/(default)/documents"
+        self.base_url = f"https://firestore.googleapis.com/v1/{self.documents_path}"
         
         # Authenticate using service account
         self.creds = service_account.Credentials.from_service_account_info(
@@ -37,81 +83,172 @@ class FirestoreClient:
             scopes=["https://www.googleapis.com/auth/datastore"]
         )
 
-    def _get_token(self):
-        if not self.creds.valid:
-            self.creds.refresh(Request())
-        return self.creds.token
+        self.auth = AuthHeaders(self.creds, Request)
 
-    def _headers(self):
-        return {
-            "Authorization": f"Bearer {self._get_token()}",
-            "Content-Type": "application/json"
-        }
+        # Write buffer flushed by flush_writes(): { doc_name: write }, { doc_name: set(tags) }
+        self.pending_writes = {}
+        self.pending_tags = {}
+
+    def _request(self, method, url, **kwargs):
+        """Pooled keep-alive request with retry/backoff and cached auth headers."""
+        return authorized_request(self.auth, method, url, **kwargs)
+
+    def discard_writes(self):
+        """Drops anything left in the write buffer (e.g. by a failed warm invocation)."""
+        self.pending_writes = {}
+        self.pending_tags = {}
 
     def get_document(self, collection, doc_id):
         url = f"{self.base_url}/{collection}/{doc_id}"
-        response = requests.get(url, headers=self._headers())
+        response = self._request('GET', url)
         if response.status_code == 200:
             return response.json()
         if response.status_code == 404:
             return None
         raise Exception(f"Firestore GET Error {response.status_code}: {response.text}")
 
-    def create_document(self, collection, doc_id, data):
-        """Creates or overwrites a document (set/upsert behavior)"""
-        firestore_data = self._to_firestore_json(data)
-        url = f"{self.base_url}/{collection}/{doc_id}"
-        response = requests.patch(url, headers=self._headers(), json=firestore_data)
-        
-        if response.status_code != 200:
-             raise Exception(f"Firestore SET Error {response.status_code}: {response.text}")
-        return response.json()
+    def batch_get(self, collection, doc_ids):
+        """
+        Fetches many documents through documents:batchGet (BATCH_GET_CHUNK_SIZE per call).
+        Returns: { doc_id: document or None (not found) }
+        """
+        doc_ids = list(dict.fromkeys(doc_ids)) # Dedupe, keep order
+        url = f"{self.base_url}:batchGet"
+        results = {}
 
-    def update_document(self, collection, doc_id, data):
-        """Updates specific fields (merge behavior)"""
-        firestore_data = self._to_firestore_json(data)
-        
-        params = []
-        for key in data.keys():
-            params.append(f"updateMask.fieldPaths={key}")
-        
-        query_string = "&".join(params)
-        url = f"{self.base_url}/{collection}/{doc_id}?{query_string}"
-        
-        response = requests.patch(url, headers=self._headers(), json=firestore_data)
-        if response.status_code != 200:
-             raise Exception(f"Firestore UPDATE Error {response.status_code}: {response.text}")
-        return response.json()
+        for start in range(0, len(doc_ids), BATCH_GET_CHUNK_SIZE):
+            chunk = doc_ids[start:start + BATCH_GET_CHUNK_SIZE]
+            body = {"documents": [f"{self.documents_path}/{collection}/{doc_id}" for doc_id in chunk]}
+            response = self._request('POST', url, json=body)
+            if response.status_code != 200:
+                raise Exception(f"Firestore BATCHGET Error {response.status_code}: {response.text}")
+
+            for entry in response.json():
+                if 'found' in entry:
+                    results[entry['found']['name'].split('/')[-1]] = entry['found']
+                elif 'missing' in entry:
+                    results[entry['missing'].split('/')[-1]] = None
+        return results
+
+    def queue_create(self, collection, doc_id, data, current_doc=NO_PRECONDITION, tags=()):
+        """
+        Buffers a create/overwrite (set/upsert) for the next flush_writes().
+        current_doc=None adds an "exists: false" precondition (document must still be missing).
+        tags: ids reported with the write if it fails (the e-mails behind it).
+        Returns the document as it will look after the flush.
+        """
+        name = f"{self.documents_path}/{collection}/{doc_id}"
+        fields = self._to_firestore_json(data)["fields"]
+        write = self.pending_writes.get(name)
+
+        if write:
+            write['update']['fields'] = fields
+            write.pop('updateMask', None)
+        else:
+            write = {"update": {"name": name, "fields": fields}}
+            if current_doc is None:
+                write['currentDocument'] = {"exists": False}
+            self.pending_writes[name] = write
+
+        return self._track(name, tags, fields)
+
+    def queue_update(self, collection, doc_id, data, current_doc=NO_PRECONDITION, tags=(), appends=None):
+        """
+        Buffers a field merge (only the fields in data) for the next flush_writes().
+        The write carries an updateMask and, when current_doc is the prefetched
+        document, an updateTime precondition so concurrent edits are detected.
+        appends: { array field: [values] } added with an appendMissingElements transform
+        (only the new elements travel; they are not part of the returned projection).
+        Returns the document as it will look after the flush.
+        """
+        name = f"{self.documents_path}/{collection}/{doc_id}"
+        fields = self._to_firestore_json(data)["fields"]
+        prefetched = current_doc if current_doc is not NO_PRECONDITION else None
+        write = self.pending_writes.get(name)
+
+        if write:
+            # Coalesce with the write already buffered for this document
+            write['update']['fields'].update(fields)
+            if 'updateMask' in write:
+                paths = write['updateMask']['fieldPaths']
+                paths.extend(k for k in fields if k not in paths)
+        else:
+            write = {
+                "update": {"name": name, "fields": dict(fields)},
+                "updateMask": {"fieldPaths": list(fields.keys())}
+            }
+            if prefetched and prefetched.get('updateTime'):
+                write['currentDocument'] = {"updateTime": prefetched['updateTime']}
+            self.pending_writes[name] = write
+
+        for field, values in (appends or {}).items():
+            transforms = write.setdefault('updateTransforms', [])
+            transform = next((t for t in transforms if t['fieldPath'] == field), None)
+            if transform is None:
+                transform = {"fieldPath": field, "appendMissingElements": {"values": []}}
+                transforms.append(transform)
+            transform['appendMissingElements']['values'].extend(encode_value(list(values))['arrayValue']['values'])
+
+        projected = self._track(name, tags, {**(prefetched or {}).get('fields', {}), **fields})
+        if prefetched and prefetched.get('updateTime'):
+            projected['updateTime'] = prefetched['updateTime']
+        return projected
+
+    def queue_index_entries(self, collection, doc_id, entries, tags=()):
+        """
+        Buffers unitizer index entries ({ (code, nota id): value }, see api/_unitizer_index.py)
+        into one shard document: only those entries are written, the rest of the shard is left alone.
+        """
+        name = f"{self.documents_path}/{collection}/{doc_id}"
+        write = self.pending_writes.get(name)
+        if not write:
+            write = {"update": {"name": name, "fields": {}}, "updateMask": {"fieldPaths": []}}
+            self.pending_writes[name] = write
+
+        add_entries(write['update']['fields'], entries, write['updateMask']['fieldPaths'])
+        self._track(name, tags, {})
+
+    def _track(self, name, tags, fields):
+        if tags:
+            self.pending_tags.setdefault(name, set()).update(tags)
+        return {"name": name, "fields": fields}
+
+    def flush_writes(self):
+        """
+        Commits buffered writes through documents:commit, COMMIT_CHUNK_SIZE per call.
+        A rejected chunk (e.g. a failed precondition) is retried write by write,
+        so one conflicting document does not block the rest.
+        Returns: list of failures [{ "name", "tags", "error" }]
+        """
+        url = f"{self.base_url}:commit"
+        names = list(self.pending_writes.keys())
+        failures = []
+
+        def commit(chunk):
+            body = {"writes": [self.pending_writes[n] for n in chunk]}
+            return self._request('POST', url, json=body)
+
+        for start in range(0, len(names), COMMIT_CHUNK_SIZE):
+            chunk = names[start:start + COMMIT_CHUNK_SIZE]
+            response = commit(chunk)
+            if response.status_code == 200: continue
+
+            for name in chunk:
+                single = response if len(chunk) == 1 else commit([name])
+                if single.status_code != 200:
+                    failures.append({
+                        "name": name,
+                        "tags": self.pending_tags.get(name, set()),
+                        "error": f"Firestore COMMIT Error {single.status_code}: {single.text}"
+                    })
+
+        self.pending_writes = {}
+        self.pending_tags = {}
+        return failures
 
     def _to_firestore_json(self, data):
-        """Converts simple python dict to Firestore JSON format"""
-        fields = {}
-        for key, value in data.items():
-            if value is None:
-                fields[key] = {"nullValue": None}
-            elif isinstance(value, bool):
-                fields[key] = {"booleanValue": value}
-            elif isinstance(value, int):
-                fields[key] = {"integerValue": str(value)}
-            elif isinstance(value, float):
-                fields[key] = {"doubleValue": value}
-            elif isinstance(value, str):
-                fields[key] = {"stringValue": value}
-            elif isinstance(value, list):
-                array_values = []
-                for item in value:
-                     if isinstance(item, dict):
-                         array_values.append({"mapValue": {"fields": self._to_firestore_json(item)["fields"]}})
-                     else:
-                         pass 
-                fields[key] = {"arrayValue": {"values": array_values}}
-            elif isinstance(value, dict):
-                if value == "SERVER_TIMESTAMP": 
-                     fields[key] = {"timestampValue": datetime.utcnow().isoformat() + "Z"}
-                else:
-                    fields[key] = {"mapValue": {"fields": self._to_firestore_json(value)["fields"]}}
-        
-        return {"fields": fields}
+        """Converts simple python dict to Firestore JSON format (api/_firestore_codec.py)"""
+        return {"fields": encode_fields(data)}
 
 # -------------------------------------------------------------------------
 # MERGE HELPER
@@ -142,16 +279,46 @@ def merge_item_lists(existing_items, new_items):
             
     return list(merged_map.values())
 
+def stored_items(fields, name):
+    """Items of a stored nota's array field (itens / itens_conferencia), in the shape the merge writes."""
+    items = decode_records(fields.get(name, {}), STORED_ITEM_SCHEMA)
+    for item in items:
+        item['unitizador'] = item['unitizador'].strip()
+    return items
+
 # -------------------------------------------------------------------------
 # PARSING HELPERS
 # -------------------------------------------------------------------------
+_TAG_RE = re.compile(r'<[^>]+>')
+_SPACES_RE = re.compile(r'\s+')
+
 def limpar_html(texto):
     if not texto: return ""
-    texto = re.sub(r'<[^>]+>', ' ', texto) 
+    texto = _TAG_RE.sub(' ', texto) 
     texto = texto.replace('&nbsp;', ' ').replace('=', '').strip()
-    texto = re.sub(r'\s+', ' ', texto)
+    texto = _SPACES_RE.sub(' ', texto)
     return texto
 
+def data_ocorrencia_iso(data_ocorrencia):
+    """'dd/mm/yyyy hh:mm' -> 'yyyy-mm-ddThh:mm' (sortable copy used by date-window queries), None if unparsable"""
+    if not data_ocorrencia: return None
+    for fmt in ("%d/%m/%Y %H:%M", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(data_ocorrencia.strip(), fmt).strftime("%Y-%m-%dT%H:%M")
+        except ValueError:
+            pass
+    return None
+
+_CITY_ACCENTS = str.maketrans({
+    'Á': 'A', 'À': 'A', 'Ã': 'A', 'Â': 'A',
+    'É': 'E', 'Ê': 'E',
+    'Í': 'I',
+    'Ó': 'O', 'Õ': 'O', 'Ô': 'O',
+    'Ú': 'U',
+    'Ç': 'C',
+    'Ü': 'U'
+})
+
 def clean_city_name(name):
     if not name: return "DESCONHECIDA"
     
@@ -159,145 +326,147 @@ def clean_city_name(name):
     name = name.strip().upper()
     
     # 2. Remove Accents
-    replacements = {
-        'Á': 'A', 'À': 'A', 'Ã': 'A', 'Â': 'A',
-        'É': 'E', 'Ê': 'E',
-        'Í': 'I',
-        'Ó': 'O', 'Õ': 'O', 'Ô': 'O',
-        'Ú': 'U',
-        'Ç': 'C',
-        'Ü': 'U'
-    }
-    for k, v in replacements.items():
-        name = name.replace(k, v)
+    name = name.translate(_CITY_ACCENTS)
         
     # 3. Preserve Prefixes (AC, CDD, etc.) - DO NOT REMOVE
     # User requirement: Keep "CDD SANTAREM", "AC OBIDOS", etc.
     
     return name
 
+class Bs4Cell:
+    """A bs4 td / th with the interface of api/_email_table.py's cells (unusual markup)."""
+    def __init__(self, tag):
+        self.tag = tag
+
+    def __str__(self):
+        return str(self.tag)
+
+    def list_text(self):
+        for br in self.tag.find_all('br'): br.replace_with(LIST_SEPARATOR)
+        return self.tag.get_text(separator=' ', strip=True)
+
+def table_rows(html_content):
+    """td / th cells of every table row: api/_email_table.py, or BeautifulSoup's html.parser tree for unusual markup."""
+    try:
+        return parse_tables(html_content).table_rows()
+    except UnsupportedMarkup:
+        soup = BeautifulSoup(html_content, 'html.parser')
+        return ([Bs4Cell(col) for col in row.find_all(['td', 'th'])] for table in soup.find_all('table') for row in table.find_all('tr'))
+
 def parse_email_html(html_content):
     parsed_results = []
     
     if not html_content: return []
 
     try:
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
         # Extract Table Items
-        tables = soup.find_all('table')
-        for table in tables:
-            rows = table.find_all('tr')
-            for row in rows:
-                cols = row.find_all(['td', 'th'])
+        for cols in table_rows(html_content):
+            # Minimum columns validation
+            if len(cols) < 7: continue
+            
+            # Check for "Header" row (skip)
+            raw_nota = limpar_html(str(cols[0]))
+            col0_text = raw_nota.lower()
+            if 'nota de despacho' in col0_text or 'origem' in col0_text:
+                continue
+            
+            # Check for Data Row (Must have "NN" in first column)
+            # Col 0: Nota
+            if "NN" not in raw_nota:
+                continue
                 
-                # Minimum columns validation
-                if len(cols) < 7: continue
+            # Setup specific indexes for standard TIM emails
+            idx_nota = 0
+            idx_origem = 1
+            idx_destino = 2
+            idx_data = 3
+            idx_qtde = 4
+            idx_peso_total = 5
+            idx_list_unit = 6
+            idx_list_lacre = 7
+            idx_list_peso = 8
+            
+            # Create Note Object
+            dados = {
+                "nota": None,
+                "itens": [],
+                "origem": "DESCONHECIDA",
+                "destino": "DESCONHECIDO",
+                "data_ocorrencia": None,
+                "qtde_unitizadores": 0,
+                "peso_total_declarado": 0.0,
+                "peso_total_calculado": 0.0,
+                "tipo_movimento": "DESCONHECIDO" # Will be set by Subject later
+            }
+            
+            # Extract Metadata
+            match_nota = re.search(r'(NN\d+)', raw_nota)
+            if match_nota:
+                dados["nota"] = match_nota.group(1)
+            else:
+                continue # Valid row must have NN
                 
-                # Check for "Header" row (skip)
-                col0_text = limpar_html(str(cols[0])).lower() if cols else ""
-                if 'nota de despacho' in col0_text or 'origem' in col0_text:
-                    continue
+            dados["origem"] = clean_city_name(limpar_html(str(cols[idx_origem])))
+            dados["destino"] = clean_city_name(limpar_html(str(cols[idx_destino])))
+            dados["data_ocorrencia"] = limpar_html(str(cols[idx_data]))
+            
+            try:
+                raw_qtde = limpar_html(str(cols[idx_qtde]))
+                match_int = re.search(r'(\d+)', raw_qtde)
+                if match_int: dados["qtde_unitizadores"] = int(match_int.group(1))
+            except: pass
+            
+            try:
+                # "1.500,50 Kg"
+                p_str = limpar_html(str(cols[idx_peso_total])).replace('.', '').replace(',', '.').replace('Kg', '').strip()
+                dados["peso_total_declarado"] = float(p_str)
+            except: pass
+
+            # Extract Lists (Unitizers, Lacres, Pesos)
+            # Helper to split by <br> or whitespace
+            def get_clean_list(col):
+                # <br> replaced by an explicit separator to ensure splitting
+                text = col.list_text()
+                text = text.replace('&nbsp;', ' ').replace('=', '').replace('?', '')
+                # Split by our separator or whitespace
+                if '|||' in text:
+                    return [x.strip() for x in text.split('|||') if x.strip()]
+                return text.split()
+
+            raw_units = get_clean_list(cols[idx_list_unit])
+            raw_lacres = get_clean_list(cols[idx_list_lacre]) if len(cols) > idx_list_lacre else []
+            raw_pesos = get_clean_list(cols[idx_list_peso]) if len(cols) > idx_list_peso else []
+            
+            max_len = max(len(raw_units), len(raw_lacres), len(raw_pesos))
+            
+            for i in range(max_len):
+                unit_val = raw_units[i] if i < len(raw_units) else ""
                 
-                # Check for Data Row (Must have "NN" in first column)
-                # Col 0: Nota
-                raw_nota = limpar_html(str(cols[0]))
-                if "NN" not in raw_nota:
+                # Filter noise
+                if len(unit_val) < 4 or unit_val.lower() in ['unitizador', 'lacre', 'objeto']:
                     continue
-                    
-                # Setup specific indexes for standard TIM emails
-                idx_nota = 0
-                idx_origem = 1
-                idx_destino = 2
-                idx_data = 3
-                idx_qtde = 4
-                idx_peso_total = 5
-                idx_list_unit = 6
-                idx_list_lacre = 7
-                idx_list_peso = 8
-                
-                # Create Note Object
-                dados = {
-                    "nota": None,
-                    "itens": [],
-                    "origem": "DESCONHECIDA",
-                    "destino": "DESCONHECIDO",
-                    "data_ocorrencia": None,
-                    "qtde_unitizadores": 0,
-                    "peso_total_declarado": 0.0,
-                    "peso_total_calculado": 0.0,
-                    "tipo_movimento": "DESCONHECIDO" # Will be set by Subject later
-                }
                 
-                # Extract Metadata
-                match_nota = re.search(r'(NN\d+)', raw_nota)
-                if match_nota:
-                    dados["nota"] = match_nota.group(1)
-                else:
-                    continue # Valid row must have NN
-                    
-                dados["origem"] = clean_city_name(limpar_html(str(cols[idx_origem])))
-                dados["destino"] = clean_city_name(limpar_html(str(cols[idx_destino])))
-                dados["data_ocorrencia"] = limpar_html(str(cols[idx_data]))
-                
-                try:
-                    raw_qtde = limpar_html(str(cols[idx_qtde]))
-                    match_int = re.search(r'(\d+)', raw_qtde)
-                    if match_int: dados["qtde_unitizadores"] = int(match_int.group(1))
-                except: pass
+                lacre_val = raw_lacres[i] if i < len(raw_lacres) else ""
+                peso_str = raw_pesos[i] if i < len(raw_pesos) else "0"
                 
+                peso_val = 0.0
                 try:
-                    # "1.500,50 Kg"
-                    p_str = limpar_html(str(cols[idx_peso_total])).replace('.', '').replace(',', '.').replace('Kg', '').strip()
-                    dados["peso_total_declarado"] = float(p_str)
+                    cl_peso = peso_str.replace('.', '').replace(',', '.').replace('Kg', '').strip()
+                    peso_val = float(cl_peso)
                 except: pass
 
-                # Extract Lists (Unitizers, Lacres, Pesos)
-                # Helper to split by <br> or whitespace
-                def get_clean_list(col):
-                    # Replace <br> with explicit separator to ensure splitting
-                    for br in col.find_all('br'): br.replace_with(' ||| ')
-                    text = col.get_text(separator=' ', strip=True)
-                    text = text.replace('&nbsp;', ' ').replace('=', '').replace('?', '')
-                    # Split by our separator or whitespace
-                    if '|||' in text:
-                        return [x.strip() for x in text.split('|||') if x.strip()]
-                    return text.split()
-
-                raw_units = get_clean_list(cols[idx_list_unit])
-                raw_lacres = get_clean_list(cols[idx_list_lacre]) if len(cols) > idx_list_lacre else []
-                raw_pesos = get_clean_list(cols[idx_list_peso]) if len(cols) > idx_list_peso else []
+                item = {
+                    "unitizador": unit_val,
+                    "lacre": lacre_val,
+                    "peso": peso_val,
+                    "conferido": False
+                }
+                dados["itens"].append(item)
                 
-                max_len = max(len(raw_units), len(raw_lacres), len(raw_pesos))
+            if dados["itens"]:
+                dados["peso_total_calculado"] = sum(item["peso"] for item in dados["itens"])
                 
-                for i in range(max_len):
-                    unit_val = raw_units[i] if i < len(raw_units) else ""
-                    
-                    # Filter noise
-                    if len(unit_val) < 4 or unit_val.lower() in ['unitizador', 'lacre', 'objeto']:
-                        continue
-                    
-                    lacre_val = raw_lacres[i] if i < len(raw_lacres) else ""
-                    peso_str = raw_pesos[i] if i < len(raw_pesos) else "0"
-                    
-                    peso_val = 0.0
-                    try:
-                        cl_peso = peso_str.replace('.', '').replace(',', '.').replace('Kg', '').strip()
-                        peso_val = float(cl_peso)
-                    except: pass
-
-                    item = {
-                        "unitizador": unit_val,
-                        "lacre": lacre_val,
-                        "peso": peso_val,
-                        "conferido": False
-                    }
-                    dados["itens"].append(item)
-                    
-                if dados["itens"]:
-                    dados["peso_total_calculado"] = sum(item["peso"] for item in dados["itens"])
-                    
-                parsed_results.append(dados)
+            parsed_results.append(dados)
 
     except Exception as e:
         print(f"Erro no parsing HTML: {e}")
@@ -305,6 +474,782 @@ def parse_email_html(html_content):
         
     return parsed_results
 
+# -------------------------------------------------------------------------
+# WARM-START RUNTIME CACHE
+# -------------------------------------------------------------------------
+# Module globals survive between invocations served by the same warm container,
+# so authorized clients, the built Gmail service and label IDs are reused.
+_runtime_cache = {} # { key: (value, expires_at) }
+
+def runtime_get(key, factory=None, ttl=RUNTIME_CACHE_TTL_SECONDS):
+    entry = _runtime_cache.get(key)
+    if entry and entry[1] > time.time():
+        return entry[0]
+    if factory is None:
+        return None
+    value = factory()
+    runtime_set(key, value, ttl)
+    return value
+
+def runtime_set(key, value, ttl=RUNTIME_CACHE_TTL_SECONDS):
+    _runtime_cache[key] = (value, time.time() + ttl)
+
+def runtime_invalidate(*keys):
+    for key in keys:
+        _runtime_cache.pop(key, None)
+
+def load_firebase_service_account():
+    firebase_creds_str = os.environ.get('FIREBASE_SERVICE_ACCOUNT')
+    if not firebase_creds_str:
+        raise Exception("FIREBASE_SERVICE_ACCOUNT not configured")
+    
+    try:
+        return json.loads(firebase_creds_str)
+    except json.JSONDecodeError:
+        try:
+            return json.loads(firebase_creds_str.replace('\\n', '\n'))
+        except:
+            clean_str = "".join(ch for ch in firebase_creds_str if getattr(ch, 'isprintable', lambda: True)())
+            return json.loads(clean_str)
+
+def build_gmail_service():
+    gmail_creds = Credentials(
+        None,
+        refresh_token=os.environ.get('GOOGLE_REFRESH_TOKEN'),
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.environ.get('GOOGLE_CLIENT_ID'),
+        client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
+    )
+    
+    if not gmail_creds.valid:
+        gmail_creds.refresh(Request())
+
+    # The service refreshes the token by itself once it expires
+    return build('gmail', 'v1', credentials=gmail_creds)
+
+# -------------------------------------------------------------------------
+# GMAIL HELPERS
+# -------------------------------------------------------------------------
+def gmail_error_status(exception):
+    status = getattr(getattr(exception, 'resp', None), 'status', None)
+    return int(status) if status is not None else None
+
+def list_label_messages(service, label_id):
+    """Full listing: every message id under label_id (all pages), oldest first."""
+    message_ids = []
+    page_token = None
+    while True:
+        results = service.users().messages().list(
+            userId='me', labelIds=[label_id], maxResults=500, pageToken=page_token
+        ).execute()
+        message_ids.extend(m['id'] for m in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token: break
+
+    # API returns newest first
+    message_ids.reverse()
+    return message_ids
+
+def list_label_history(service, start_history_id, label_id):
+    """
+    Incremental listing: replays users.history since start_history_id.
+    Returns (ids that gained label_id and still have it, in chronological order, latest historyId).
+    Raises the Gmail HttpError (404) when the checkpoint has expired.
+    """
+    pending = {} # Ordered set
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        results = service.users().history().list(
+            userId='me', startHistoryId=start_history_id, labelId=label_id,
+            historyTypes=['messageAdded', 'labelAdded', 'labelRemoved', 'messageDeleted'],
+            maxResults=500, pageToken=page_token
+        ).execute()
+
+        for record in results.get('history', []):
+            for entry in record.get('messagesAdded', []):
+                if label_id in entry['message'].get('labelIds', []):
+                    pending[entry['message']['id']] = True
+            for entry in record.get('labelsAdded', []):
+                if label_id in entry.get('labelIds', []):
+                    pending[entry['message']['id']] = True
+            for entry in record.get('labelsRemoved', []):
+                if label_id in entry.get('labelIds', []):
+                    pending.pop(entry['message']['id'], None)
+            for entry in record.get('messagesDeleted', []):
+                pending.pop(entry['message']['id'], None)
+
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token: break
+
+    return list(pending), latest_history_id
+
+def _parts_fields(depth):
+    """Partial-response mask of a MIME part tree: mime types and body data only, `depth` levels deep."""
+    fields = "mimeType,body/data"
+    for _ in range(depth):
+        fields = f"mimeType,body/data,parts({fields})"
+    return fields
+
+GMAIL_HTML_FIELDS = f"id,payload({_parts_fields(GMAIL_MIME_DEPTH)})"
+
+def movement_type(subject):
+    """"RECEBIMENTO" (entrada), "ENTREGA" (Devolução) or None, from the e-mail subject."""
+    if any(s in subject for s in ENTRADA_SUBJECTS): return "RECEBIMENTO"
+    if any(s in subject for s in SAIDA_SUBJECTS): return "ENTREGA"
+    return None
+
+def message_headers(msg_detail):
+    """(subject, date) headers of a fetched message."""
+    headers = msg_detail.get('payload', {}).get('headers', [])
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "")
+    date_header = next((h['value'] for h in headers if h['name'] == 'Date'), "")
+    return subject, date_header
+
+def get_html_part(payload):
+    if payload['mimeType'] == 'text/html':
+        return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+    parts = payload.get('parts', [])
+    for part in parts:
+        result = get_html_part(part)
+        if result: return result
+    return None
+
+def gmail_error_reason(exception):
+    """First reason of a Gmail HttpError ('rateLimitExceeded', ...), None if it has none."""
+    try:
+        errors = json.loads(exception.content)['error'].get('errors') or [{}]
+        return errors[0].get('reason')
+    except Exception:
+        return None
+
+def _is_retryable_gmail_error(exception):
+    status = gmail_error_status(exception)
+    if status == 403: return gmail_error_reason(exception) in GMAIL_RATE_LIMIT_REASONS
+    return status == 429 or (status is not None and status >= 500)
+
+class GmailBackoff:
+    """
+    Backoff shared by the fetch workers of a run: a retry round pushes back the next Gmail batch
+    of every worker, not only its own, so the workers stop adding to a per-user rate limit
+    together. Delays are random up to an exponential cap (the workers do not retry in lockstep),
+    at least the Retry-After of the failed calls. A wait that would end past `deadline` (epoch
+    seconds) is not taken: the calls keep their error and go back to the backlog.
+    """
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, retry_round, errors=()):
+        delay = random.uniform(0, min(GMAIL_BACKOFF_MAX_SECONDS, GMAIL_BACKOFF_BASE_SECONDS * (2 ** retry_round)))
+        for error in errors:
+            try:
+                delay = max(delay, min(GMAIL_BACKOFF_MAX_SECONDS, float(error.resp.get('retry-after'))))
+            except (AttributeError, TypeError, ValueError):
+                pass
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + delay)
+
+    def wait(self):
+        """Sleeps until the shared resume time. False, without sleeping, if it is past the deadline."""
+        with self.lock:
+            resume_at = self.resume_at
+        if self.deadline is not None and resume_at > self.deadline: return False
+        delay = resume_at - time.time()
+        if delay > 0: time.sleep(delay)
+        return True
+
+def new_gmail_http(service):
+    """
+    httplib2.Http is not thread-safe: every fetch worker gets its own connection,
+    authorized with the service credentials (None = the service's own Http).
+    """
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    return AuthorizedHttp(credentials, http=httplib2.Http())
+
+def fetch_messages_batch(service, message_ids, msg_format='full', http=None, metadata_headers=None, fields=None, backoff=None):
+    """
+    Fetches message details through Gmail batch HTTP requests
+    (GMAIL_BATCH_SIZE calls per round-trip instead of one per e-mail).
+    Calls rate limited (429, 403 rateLimitExceeded) or failed with 5xx - alone or as a whole
+    batch - are queued again for the next round, after the shared backoff (see GmailBackoff).
+    http: connection to use (see new_gmail_http) when called from a worker thread.
+    metadata_headers / fields: headers of a 'metadata' fetch, partial-response mask.
+    Returns: { msg_id: message_detail or Exception } (the last error of a call still failing)
+    """
+    options = {"format": msg_format}
+    if metadata_headers: options['metadataHeaders'] = metadata_headers
+    if fields: options['fields'] = fields
+    backoff = backoff or GmailBackoff()
+
+    results = {}
+    pending = list(message_ids)
+
+    for attempt in range(GMAIL_BATCH_RETRIES):
+        if not pending: break
+        if not backoff.wait() and attempt: break # No time left to wait: the calls keep their error
+
+        failed = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                results[request_id] = exception
+                if _is_retryable_gmail_error(exception):
+                    failed.append(request_id)
+            else:
+                results[request_id] = response
+
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            batch_ids = pending[start:start + GMAIL_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in batch_ids:
+                batch.add(
+                    service.users().messages().get(userId='me', id=msg_id, **options),
+                    request_id=msg_id
+                )
+            try:
+                batch.execute(http=http)
+            except HttpError as e:
+                # The whole round-trip was refused: its calls are queued again like failed parts
+                if not _is_retryable_gmail_error(e): raise
+                results.update(dict.fromkeys(batch_ids, e))
+                failed.extend(batch_ids)
+
+        if failed and attempt + 1 < GMAIL_BATCH_RETRIES:
+            backoff.pause(attempt, [results[m] for m in failed])
+        pending = failed
+
+    return results
+
+# -------------------------------------------------------------------------
+# SYNC STAGES
+# -------------------------------------------------------------------------
+class SyncDeadline:
+    """
+    Time budget of one run. Measures the cost per e-mail as chunks complete and
+    only lets a new chunk start while its projected finish stays before
+    budget - safety margin (the margin is kept for commit, label swap and metadata).
+    """
+    def __init__(self, start_time, budget_seconds=SYNC_TIME_BUDGET_SECONDS, margin_seconds=SYNC_SAFETY_MARGIN_SECONDS):
+        # Small budgets (e.g. local tests) keep at most a quarter as margin
+        self.deadline = start_time + budget_seconds - min(margin_seconds, budget_seconds / 4)
+        self.emails = 0
+        self.seconds = 0.0
+
+    def cost_per_email(self):
+        if not self.emails: return INITIAL_EMAIL_COST_SECONDS
+        return self.seconds / self.emails
+
+    def record(self, emails, seconds):
+        self.emails += emails
+        self.seconds += seconds
+
+    def affordable(self, wanted, in_flight=0):
+        """How many of the next `wanted` e-mails can still be started (besides `in_flight` ones)."""
+        remaining = self.deadline - time.time()
+        if remaining <= 0: return 0
+        return max(0, min(wanted, int(remaining / self.cost_per_email()) - in_flight))
+
+def _fetched(msg_detail):
+    """The fetched message, None if it was deleted since it was listed; raises on a failed fetch."""
+    if isinstance(msg_detail, Exception):
+        if gmail_error_status(msg_detail) == 404:
+            return None # Deleted since it was listed
+        raise msg_detail
+    if msg_detail is None:
+        raise Exception("Mensagem não retornada pelo batch do Gmail.")
+    return msg_detail
+
+def screen_messages(metadata, label_robo_id):
+    """
+    First tier of the fetch: ids of the messages (fetched as metadata) whose body is worth
+    downloading - still under ROBO_TIM and with a recognized subject. Failed fetches are
+    left to parse_message, which reports them.
+    """
+    wanted = []
+    for msg_id, msg_meta in metadata.items():
+        if not isinstance(msg_meta, dict): continue
+        if label_robo_id not in msg_meta.get('labelIds', [label_robo_id]): continue
+        if movement_type(message_headers(msg_meta)[0]): wanted.append(msg_id)
+    return wanted
+
+def parse_message(msg_id, msg_meta, msg_body, label_robo_id, debug_logs):
+    """
+    Turns one Gmail message into a parsed e-mail dict, or None when there is nothing to persist.
+    msg_meta: the message fetched as metadata (Subject/Date headers);
+    msg_body: its MIME parts (GMAIL_HTML_FIELDS), only fetched for a recognized subject.
+    A message no subject rule recognizes comes back without notas (it is only marked processed).
+    Raises on unexpected errors (retried next run).
+    """
+    msg_meta = _fetched(msg_meta)
+    if msg_meta is None: return None
+    if label_robo_id not in msg_meta.get('labelIds', [label_robo_id]):
+        return None # Already processed (label removed since it was listed)
+
+    subject, date_header = message_headers(msg_meta)
+
+    debug_logs.append(f"Analisando: {subject[:50]}...")
+
+    parsed_email = {
+        "id": msg_id,
+        "subject": subject,
+        "date_header": date_header,
+        "internal_date": int(msg_meta.get('internalDate', 0)),
+        "notas": []
+    }
+    if not movement_type(subject):
+        debug_logs.append(f" - [PULADO] Tipo (Subject) não reconhecido.")
+        return parsed_email
+
+    msg_body = _fetched(msg_body)
+    if msg_body is None: return None
+
+    html_body = get_html_part(msg_body['payload'])
+    if not html_body:
+        debug_logs.append(f" - [ERRO] HTML não encontrado.")
+        return None
+
+    parsed_data_list = parse_email_html(html_body)
+
+    if not parsed_data_list:
+         debug_logs.append(f" - [PULADO] Nenhuma nota encontrada ou erro no parse.")
+         return None
+
+    debug_logs.append(f" - [OK] {len(parsed_data_list)} notas identificadas.")
+    parsed_email['notas'] = parsed_data_list
+    return parsed_email
+
+def queue_unitizer_index(db_client, nota_id, itens, data_iso, tags, first_index=0):
+    """Buffers the nota's items as pending in the unitizer index (api/_unitizer_index.py)."""
+    shards = entries_by_shard(nota_id, itens, data_iso, first_index)
+    for shard, entries in shards.items():
+        db_client.queue_index_entries(INDEX_COLLECTION, shard, entries, tags=tags)
+
+def nota_state(doc):
+    """Fields of a stored nota as python values; itens / itens_conferencia as the merges read them."""
+    fields = doc.get('fields', {})
+    state = {key: decode_value(value) for key, value in fields.items() if key not in ("itens", "itens_conferencia")}
+    for key in ("itens", "itens_conferencia"):
+        if key in fields: state[key] = stored_items(fields, key)
+    return state
+
+def stored_match_flags(doc):
+    """unitizador and correios_match of a stored nota's entry itens (stored_items leaves the flag out)."""
+    return decode_records(doc.get('fields', {}).get('itens', {}), {"unitizador": "", "correios_match": False})
+
+class NotaFold:
+    """
+    In-run fold of the notas touched by a sync. Every e-mail of the run that mentions a nota
+    is merged into its in-memory state, in chronological order: the prefetched document is
+    decoded once, each merge reads the state left by the previous one, and queue_writes()
+    buffers one write per nota (one create, or one field merge with the union of the fields)
+    tagged with every e-mail behind it. With SYNC_ITEM_WRITES = "delta" the field merge only
+    carries the unitizers the run added to the stored arrays (see item_deltas).
+    """
+    def __init__(self):
+        self.notas = {} # { nota id: { "doc", "state", "stored", "payload", "create", "tags", "index_tags" } }
+
+    def add_document(self, nota_id, doc):
+        """Prefetched document (None: missing); a nota already folded keeps its state."""
+        if nota_id not in self.notas:
+            self.notas[nota_id] = {"doc": doc, "state": None, "stored": {}, "payload": {}, "create": doc is None,
+                                   "tags": [], "index_tags": []}
+
+    def current(self, nota_id):
+        """The nota's fields after the e-mails folded so far (python values); None if it does not exist yet."""
+        nota = self.notas.setdefault(nota_id, {"doc": None, "state": None, "stored": {}, "payload": {}, "create": True,
+                                                "tags": [], "index_tags": []})
+        if nota['state'] is None and nota['doc'] is not None:
+            nota['state'] = nota_state(nota['doc'])
+            nota['stored'] = dict(nota['state']) # As read: the base of the item deltas
+        return nota['state']
+
+    def apply(self, nota_id, payload, msg_id, index=False):
+        """
+        Folds one e-mail's payload into the nota.
+        index: the payload changed the entry itens (their pending unitizers go to the index).
+        """
+        nota = self.notas[nota_id]
+        nota['state'] = {**(nota['state'] or {}), **payload}
+        nota['payload'].update(payload)
+        if msg_id not in nota['tags']: nota['tags'].append(msg_id)
+        if index and msg_id not in nota['index_tags']: nota['index_tags'].append(msg_id)
+
+    @staticmethod
+    def item_deltas(nota):
+        """
+        (payload, appends) of an existing nota for SYNC_ITEM_WRITES = "delta": an item array whose
+        stored items are all kept unchanged, in order, leaves the payload and only its new items are
+        appended ({ field: items }); an array where a stored unitizer changed is still rewritten whole.
+        """
+        payload, appends = dict(nota['payload']), {}
+        for key in ("itens", "itens_conferencia"):
+            if key not in payload: continue
+            stored = nota['stored'].get(key, [])
+            items = payload[key]
+            if items[:len(stored)] != stored: continue
+            del payload[key]
+            if len(items) > len(stored): appends[key] = items[len(stored):]
+        return payload, appends
+
+    def queue_writes(self, db_client):
+        """Buffers one write per changed nota (and its index entries) on db_client. Returns the count."""
+        count = 0
+        for nota_id, nota in self.notas.items():
+            if not nota['payload']: continue
+            state = nota['state']
+            index_items, first_index = state.get('itens', []), 0
+            if nota['create']:
+                db_client.queue_create(COLLECTION_NAME, nota_id, nota['payload'], current_doc=None, tags=nota['tags'])
+            else:
+                payload, appends = nota['payload'], {}
+                if SYNC_ITEM_WRITES == 'delta':
+                    payload, appends = self.item_deltas(nota)
+                    stored = nota['stored']
+                    if 'itens' in payload:
+                        pass # Rewritten whole: every item is pending again
+                    elif state.get('data_ocorrencia_iso') == stored.get('data_ocorrencia_iso'):
+                        # Stored items keep their entries (and correios_* fields): index the appended ones
+                        index_items, first_index = appends.get('itens', []), len(stored.get('itens', []))
+                    else:
+                        # New date on every entry: the stored items that are still pending, then the appended ones
+                        index_items = stored_match_flags(nota['doc']) + appends.get('itens', [])
+                db_client.queue_update(COLLECTION_NAME, nota_id, payload, current_doc=nota['doc'], tags=nota['tags'],
+                                       appends=appends)
+            if nota['index_tags']:
+                queue_unitizer_index(db_client, nota_id, index_items, state.get('data_ocorrencia_iso'),
+                                     nota['index_tags'], first_index)
+            count += 1
+        return count
+
+def persist_email(fold, parsed_email, debug_logs):
+    """
+    Merges every nota of one parsed e-mail into the run's NotaFold (prefetched documents
+    plus the e-mails already merged). Raises on unexpected errors.
+    """
+    msg_id = parsed_email['id']
+    subject = parsed_email['subject']
+    date_header = parsed_email['date_header']
+    parsed_data_list = parsed_email['notas']
+
+    if not parsed_data_list: return # Subject not recognized: nothing to merge
+    debug_logs.append(f"Gravando: {subject[:50]}...")
+
+    # Determine Movement Type based on Subject (Global for the email)
+    tipo_movimento = movement_type(subject)
+    is_entrada = tipo_movimento == "RECEBIMENTO"
+    is_saida = tipo_movimento == "ENTREGA"
+
+    for parsed_data in parsed_data_list:
+        nota_id = parsed_data['nota']
+        debug_logs.append(f"   > Processando Nota: {nota_id}")
+
+        if is_entrada:
+            parsed_data["tipo_movimento"] = "RECEBIMENTO"
+            existing = fold.current(nota_id)
+
+            if existing is None:
+                # Payload for New Note
+                payload = {
+                    "nota_despacho": nota_id,
+                    "status": "RECEBIDO", 
+                    "data_email": date_header,
+                    "data_ocorrencia": parsed_data['data_ocorrencia'], 
+                    "data_ocorrencia_iso": data_ocorrencia_iso(parsed_data['data_ocorrencia']),
+                    "origem": parsed_data['origem'],
+                    "destino": parsed_data['destino'],
+                    "qtde_unitizadores": parsed_data['qtde_unitizadores'],
+                    "peso_total_declarado": parsed_data['peso_total_declarado'],
+                    "peso_total_calculado": parsed_data['peso_total_calculado'],
+                    "itens": parsed_data['itens'],
+                    "criado_em": "SERVER_TIMESTAMP",
+                    "divergencia": None, 
+                    "created_by": "ROBO",
+                    "msgs_entrada": 1,
+                    "msgs_saida": 0
+                }
+                fold.apply(nota_id, payload, msg_id, index=True)
+                debug_logs.append(f"     -> [SALVO] Criado com {len(parsed_data['itens'])} itens.")
+            else:
+                # Update Existing Note (MERGE)
+                # 1. Existing ITENS (stored, or merged by an earlier e-mail of this run)
+                existing_itens = existing.get('itens', [])
+
+                # 2. Merge New Items (parsed_data['itens']) with Existing
+                merged_itens = merge_item_lists(existing_itens, parsed_data['itens'])
+
+                # Calculate new totals from MERGED items
+                new_total_weight = sum(i['peso'] for i in merged_itens)
+
+                # Increment Message Count
+                current_count = as_int(existing.get('msgs_entrada'), 1) # 1 if field missing
+
+                new_msg_count = current_count + 1
+
+                payload = {
+                    "nota_despacho": nota_id,
+                    "data_email": date_header,
+                    "data_ocorrencia": parsed_data['data_ocorrencia'], 
+                    "data_ocorrencia_iso": data_ocorrencia_iso(parsed_data['data_ocorrencia']),
+                    "origem": parsed_data['origem'],
+                    "destino": parsed_data['destino'],
+                    "qtde_unitizadores": len(merged_itens), 
+                    "peso_total_declarado": new_total_weight, 
+                    "peso_total_calculado": new_total_weight, 
+                    "itens": merged_itens,
+                    "last_updated": "SERVER_TIMESTAMP",
+                    "msgs_entrada": new_msg_count # Save Count
+                }
+
+                # Check Recalculation logic if Exit data exists
+                if 'itens_conferencia' in existing:
+                    # Reconciliation Logic
+                    # Merged entry items vs the stored exit items (api/_reconciliation.py)
+                    divergences = reconcile(merged_itens, existing['itens_conferencia'], "entrada")
+                    payload['status'] = "DIVERGENTE" if divergences else "CONCLUIDO"
+                    payload['divergencia'] = divergence_text(divergences, "entrada")
+                else:
+                    doc_status = as_str(existing.get('status'), None)
+                    if doc_status == 'DEVOLVED_ORPHAN':
+                        payload['divergencia'] = None
+                        payload['status'] = 'RECEBIDO'
+
+                fold.apply(nota_id, payload, msg_id, index=True)
+                debug_logs.append(f"     -> [ATUALIZADO] Dados de Entrada mesclados e vinculados ({new_msg_count} e-mails).")
+
+        elif is_saida:
+            parsed_data["tipo_movimento"] = "ENTREGA"
+            existing = fold.current(nota_id)
+
+            if existing is not None:
+                # 1. Existing EXIT Items (itens_conferencia)
+                existing_exit_items = existing.get('itens_conferencia', [])
+
+                # 2. Merge New Exit Items with Existing
+                merged_exit_items = merge_item_lists(existing_exit_items, parsed_data['itens'])
+
+                # 3. ENTRY Items to compare
+                entry_items = existing.get('itens', [])
+
+                # Compare Merged Exit Data vs Entry Data (api/_reconciliation.py)
+                # Only reconciled if we HAVE entry items (otherwise it's just orphan)
+                divergences = reconcile(entry_items, merged_exit_items, "saida") if entry_items else []
+
+                # Determine Status
+                new_status = "CONCLUIDO" if not divergences else "DIVERGENTE"
+                if not entry_items: new_status = "DEVOLVED_ORPHAN" # Or keep existing if it was orphan
+
+                # Calculate totals
+                new_total_weight = sum(i['peso'] for i in merged_exit_items)
+
+                # Increment Message Count (Exit)
+                if 'msgs_saida' in existing:
+                    current_count = as_int(existing['msgs_saida'], 0)
+                else:
+                    # If field missing, assume 1 if exiting items exist, strictly 0 if not?
+                    # Assume 0 or 1. Let's assume 1 if we are updating an existing exit note.
+                    # If existing_exit_items is empty, likely 0.
+                    current_count = 1 if existing_exit_items else 0
+
+                new_msg_count = current_count + 1
+
+                payload = {
+                    "status": new_status,
+                    "data_entrega": parsed_data['data_ocorrencia'] or date_header,
+                    "divergencia": divergence_text(divergences, "saida"),
+                    "itens_conferencia": merged_exit_items, # Save MERGED items
+                    "qtde_unitizadores": len(merged_exit_items),
+                    "peso_total_declarado": new_total_weight, 
+                    "peso_total_calculado": new_total_weight, 
+                    "last_updated": "SERVER_TIMESTAMP",
+                    "msgs_saida": new_msg_count
+                }
+
+                fold.apply(nota_id, payload, msg_id)
+                debug_logs.append(f"     -> [ATUALIZADO] Saída mesclada ({new_msg_count} e-mails). Status: {new_status}")
+
+            else:
+                # Orphan Note (Devolved without Receipt)
+                payload = {
+                    "nota_despacho": nota_id,
+                    "status": "DEVOLVED_ORPHAN",
+                    "data_email": date_header,
+                    "data_ocorrencia": parsed_data['data_ocorrencia'], 
+                    "data_ocorrencia_iso": data_ocorrencia_iso(parsed_data['data_ocorrencia']),
+                    "data_entrega": parsed_data['data_ocorrencia'],
+                    "origem": parsed_data['origem'],
+                    "destino": parsed_data['destino'],
+                    "qtde_unitizadores": parsed_data['qtde_unitizadores'],
+                    "peso_total_declarado": parsed_data['peso_total_declarado'],
+                    "peso_total_calculado": parsed_data['peso_total_calculado'],
+                    "itens_conferencia": parsed_data['itens'], # Save as conferência
+                    "itens": [], # Empty entry items
+                    "criado_em": "SERVER_TIMESTAMP",
+                    "divergencia": "Nota de Devolução sem entrada prévia.",
+                    "created_by": "ROBO",
+                    "msgs_entrada": 0,
+                    "msgs_saida": 1
+                }
+                fold.apply(nota_id, payload, msg_id)
+                debug_logs.append(f"     -> [CRIADO-ORFAO] Devolução sem origem.")
+
+        else:
+            debug_logs.append(f"     -> [PULADO] Tipo (Subject) não reconhecido.")
+
+def run_sync_pipeline(service, db_client, message_ids, label_robo_id, deadline, debug_logs):
+    """
+    Fetch -> parse -> persist pipeline over message_ids (oldest first), stages linked by bounded queues:
+    - fetch: SYNC_FETCH_WORKERS threads, each with its own Http; per chunk one Gmail batch of metadata,
+      then one of MIME parts for the messages whose subject is recognized (screen_messages);
+      rate limited calls are retried after a backoff shared by the workers, the ones still
+      failing go back to the msg ids to retry
+    - parse: one thread (CPU bound); it also starts the batch_get of notas not requested yet
+    - persist: the calling thread, applying chunks strictly in listing order, so merges into
+      the same nota keep chronological order (folded in a NotaFold, one buffered write per nota)
+    New chunks are only dispatched while the deadline allows, counting those already in flight.
+    A chunk whose Gmail batch or nota batch_get fails goes back whole to the msg ids to retry;
+    the rest of the run carries on.
+    Returns: (persisted msg ids, msg ids to retry, msg ids never started)
+    """
+    fetch_queue = queue.Queue(SYNC_PIPELINE_DEPTH + SYNC_FETCH_WORKERS) # + stop sentinels
+    parse_queue = queue.Queue(SYNC_PIPELINE_DEPTH + 1)
+    persist_queue = queue.Queue(SYNC_PIPELINE_DEPTH)
+    prefetch_pool = ThreadPoolExecutor(SYNC_FETCH_WORKERS)
+    prefetches = {} # { nota_id: Future of the batch_get that loads it } (parse thread only)
+    backoff = GmailBackoff(deadline.deadline) # Shared by the fetch workers (one per-user rate limit)
+
+    def fetch_worker():
+        http = new_gmail_http(service)
+        while True:
+            job = fetch_queue.get()
+            if job is None: return
+            seq, chunk = job
+            try:
+                # Metadata of every message, MIME parts only for the recognized subjects
+                metadata = fetch_messages_batch(service, chunk, msg_format='metadata', http=http, backoff=backoff,
+                                                metadata_headers=GMAIL_METADATA_HEADERS, fields=GMAIL_METADATA_FIELDS)
+                wanted = screen_messages(metadata, label_robo_id)
+                bodies = fetch_messages_batch(service, wanted, http=http, fields=GMAIL_HTML_FIELDS, backoff=backoff) if wanted else {}
+                parse_queue.put((seq, chunk, (metadata, bodies)))
+            except Exception as e:
+                parse_queue.put((seq, chunk, e))
+
+    def parse_worker():
+        while True:
+            job = parse_queue.get()
+            if job is None: return
+            seq, chunk, msg_details = job
+            try:
+                if isinstance(msg_details, Exception): raise msg_details
+                metadata, bodies = msg_details
+
+                logs, parsed_emails, failed_ids = [], [], []
+                for msg_id in chunk:
+                    try:
+                        parsed_email = parse_message(msg_id, metadata.get(msg_id), bodies.get(msg_id), label_robo_id, logs)
+                        if parsed_email: parsed_emails.append(parsed_email)
+                    except Exception as e:
+                        print(f"Erro ao processar mensagem {msg_id}: {e}")
+                        logs.append(f" - [CRITICO] Erro exceção: {str(e)}")
+                        failed_ids.append(msg_id)
+
+                # Prefetch notas nobody requested yet; chunks may reach this stage out of order
+                needed = list(dict.fromkeys(d['nota'] for e in parsed_emails for d in e['notas']))
+                missing = [n for n in needed if n not in prefetches]
+                if missing:
+                    future = prefetch_pool.submit(db_client.batch_get, COLLECTION_NAME, missing)
+                    for nota_id in missing: prefetches[nota_id] = future
+
+                result = (logs, parsed_emails, failed_ids, {n: prefetches[n] for n in needed})
+            except Exception as e:
+                result = e
+            persist_queue.put((seq, result))
+
+    workers = [threading.Thread(target=fetch_worker, daemon=True) for _ in range(SYNC_FETCH_WORKERS)]
+    parser = threading.Thread(target=parse_worker, daemon=True)
+    for thread in workers + [parser]: thread.start()
+
+    pending_ids = list(message_ids)
+    fold = NotaFold() # Every nota read once, merged e-mail by e-mail, written once
+    processed_msg_ids, retry_ids = [], []
+    in_flight = {} # { seq: msg ids of the chunk }
+    ready = {} # Parsed chunks waiting for their turn: { seq: result }
+    dispatched = next_seq = 0
+    last_persisted = time.time()
+
+    try:
+        while True:
+            # Keep the pipeline full while the time budget allows
+            while pending_ids and len(in_flight) < SYNC_PIPELINE_DEPTH:
+                chunk_size = deadline.affordable(min(GMAIL_BATCH_SIZE, len(pending_ids)), sum(map(len, in_flight.values())))
+                if not chunk_size: break
+                chunk, pending_ids = pending_ids[:chunk_size], pending_ids[chunk_size:]
+                in_flight[dispatched] = chunk
+                fetch_queue.put((dispatched, chunk))
+                dispatched += 1
+
+            if not in_flight: break
+
+            seq, result = persist_queue.get()
+            ready[seq] = result
+
+            while next_seq in ready:
+                result = ready.pop(next_seq)
+                chunk = in_flight.pop(next_seq)
+                logs, parsed_emails, failed_ids, documents = [], [], [], {}
+                try:
+                    # A failed Gmail batch or nota batch_get only sends its own chunk back to the backlog
+                    if isinstance(result, Exception): raise result
+                    logs, parsed_emails, failed_ids, prefetched = result
+                    documents = {nota_id: future.result().get(nota_id) for nota_id, future in prefetched.items()}
+                except Exception as e:
+                    print(f"Erro no lote de {len(chunk)} e-mails: {e}")
+                    logs = logs + [f" - [CRITICO] Lote de {len(chunk)} e-mails não processado, fica para a próxima execução: {str(e)}"]
+                    parsed_emails, failed_ids = [], list(chunk)
+
+                debug_logs.extend(logs)
+                retry_ids.extend(failed_ids)
+
+                # Notas already touched in this run keep their folded state
+                for nota_id, doc in documents.items():
+                    fold.add_document(nota_id, doc)
+                debug_logs.append(f"Pré-carregadas {len(fold.notas)} notas.")
+
+                # Chronological order regardless of the listing source
+                parsed_emails.sort(key=lambda e: e['internal_date'])
+                for parsed_email in parsed_emails:
+                    try:
+                        persist_email(fold, parsed_email, debug_logs)
+                        processed_msg_ids.append(parsed_email['id'])
+                    except Exception as e:
+                        print(f"Erro ao processar mensagem {parsed_email['id']}: {e}")
+                        debug_logs.append(f" - [CRITICO] Erro exceção: {str(e)}")
+                        retry_ids.append(parsed_email['id'])
+
+                # Pipeline throughput: time between consecutive persisted chunks
+                now = time.time()
+                deadline.record(len(chunk), now - last_persisted)
+                last_persisted = now
+                next_seq += 1
+    finally:
+        for _ in workers: fetch_queue.put(None)
+        for thread in workers: thread.join()
+        parse_queue.put(None)
+        parser.join()
+        prefetch_pool.shutdown(wait=True)
+
+    if pending_ids:
+        debug_logs.append(f"[PRAZO] Orçamento de tempo atingido, {len(pending_ids)} e-mails ficam para a próxima execução.")
+
+    # One write per nota, whatever the number of e-mails folded into it
+    written = fold.queue_writes(db_client)
+    debug_logs.append(f"Notas a gravar: {written} ({len(processed_msg_ids)} e-mails).")
+    return processed_msg_ids, retry_ids, pending_ids
+
 # -------------------------------------------------------------------------
 # MAIN HANDLER (VERCEL)
 # -------------------------------------------------------------------------
@@ -316,10 +1261,11 @@ class handler(BaseHTTPRequestHandler):
     def do_POST(self):
         self.process_request()
 
-    def _get_or_create_label(self, service, label_name):
+    def _get_or_create_label(self, service, label_name, labels=None):
         try:
-            results = service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
+            if labels is None:
+                results = service.users().labels().list(userId='me').execute()
+                labels = results.get('labels', [])
             existing = next((l for l in labels if l['name'] == label_name), None)
             
             if existing:
@@ -337,6 +1283,49 @@ class handler(BaseHTTPRequestHandler):
             print(f"Erro ao criar label {label_name}: {e}")
             return None
 
+    def _get_label_ids(self, service):
+        """(ROBO_TIM id, PROCESSADO id) from a single labels.list, cached across warm starts."""
+        label_ids = runtime_get('label_ids')
+        if label_ids:
+            return label_ids
+
+        results = service.users().labels().list(userId='me').execute()
+        labels = results.get('labels', [])
+        label_robo_id = next((l['id'] for l in labels if l['name'] == LABEL_NAME), None)
+        if not label_robo_id:
+            return None, None
+
+        # Find/Create Destination Label
+        label_processed_id = self._get_or_create_label(service, LABEL_PROCESSED, labels)
+        if label_processed_id:
+            runtime_set('label_ids', (label_robo_id, label_processed_id))
+        return label_robo_id, label_processed_id
+
+    def _swap_labels(self, service, msg_ids, label_robo_id, label_processed_id, debug_logs):
+        """
+        Moves committed e-mails from ROBO_TIM to PROCESSADO (batchModify, 1000 ids per call, retried).
+        Returns the ids left unlabeled; they are kept in the sync metadata and relabeled by the next run,
+        never merged again.
+        """
+        if not label_processed_id:
+            debug_logs.append(f"   -> [ERRO-LABEL] ID de PROCESSADO não disponível.")
+            return list(msg_ids)
+
+        unlabeled = []
+        for start in range(0, len(msg_ids), 1000):
+            mods = {
+                'ids': msg_ids[start:start + 1000],
+                'removeLabelIds': [label_robo_id],
+                'addLabelIds': [label_processed_id]
+            }
+            try:
+                service.users().messages().batchModify(userId='me', body=mods).execute(num_retries=GMAIL_BATCH_RETRIES)
+            except Exception as e:
+                print(f"Erro ao trocar labels: {e}")
+                debug_logs.append(f" - [ERRO-LABEL] Falha ao trocar labels de {len(mods['ids'])} e-mails, nova tentativa na próxima execução: {e}")
+                unlabeled.extend(mods['ids'])
+        return unlabeled
+
     def process_request(self):
         start_time = time.time()
 
@@ -359,398 +1348,138 @@ class handler(BaseHTTPRequestHandler):
             return
 
         try:
-            # 1. Initialize Firestore
-            firebase_creds_str = os.environ.get('FIREBASE_SERVICE_ACCOUNT')
-            if not firebase_creds_str:
-                raise Exception("FIREBASE_SERVICE_ACCOUNT not configured")
-            
-            try:
-                firebase_creds_dict = json.loads(firebase_creds_str)
-            except json.JSONDecodeError:
+            # 1. Initialize Firestore (client reused across warm starts)
+            db_client = runtime_get('db_client', lambda: FirestoreClient(load_firebase_service_account()))
+            db_client.discard_writes()
+
+            # Incremental sync checkpoint (historyId + leftover backlog) from the last run
+            meta_doc_id = f"{os.environ.get('FIREBASE_APP_ID', 'default')}_sync_metadata"
+            meta_fields = (db_client.get_document("artifacts", meta_doc_id) or {}).get('fields', {})
+            checkpoint_id = as_str(decode_value(meta_fields.get('history_id', {})), None)
+            backlog_ids = [v for v in as_list(decode_value(meta_fields.get('backlog_ids', {}))) if v and isinstance(v, str)]
+            # Committed by an earlier run whose label swap failed: relabeled, not merged again
+            unlabeled_ids = [v for v in as_list(decode_value(meta_fields.get('unlabeled_ids', {}))) if v and isinstance(v, str)]
+            force_full = query.get('mode', [None])[0] == 'full'
+
+            debug_logs = []
+
+            for attempt in range(2):
                 try:
-                    firebase_creds_dict = json.loads(firebase_creds_str.replace('\\n', '\n'))
-                except:
-                    clean_str = "".join(ch for ch in firebase_creds_str if getattr(ch, 'isprintable', lambda: True)())
-                    firebase_creds_dict = json.loads(clean_str)
-
-            db_client = FirestoreClient(firebase_creds_dict)
-
-            # 2. Gmail Connection
-            gmail_creds = Credentials(
-                None,
-                refresh_token=os.environ.get('GOOGLE_REFRESH_TOKEN'),
-                token_uri="https://oauth2.googleapis.com/token",
-                client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-                client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
-            )
-            
-            if not gmail_creds.valid:
-                gmail_creds.refresh(Request())
+                    # 2. Gmail Connection (service reused across warm starts)
+                    service = runtime_get('gmail_service', build_gmail_service)
 
-            service = build('gmail', 'v1', credentials=gmail_creds)
+                    # 3. Handle Labels
+                    label_robo_id, label_processed_id = self._get_label_ids(service)
 
-            # 3. Handle Labels
-            # Find Source Label
-            results = service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
-            label_robo_id = next((l['id'] for l in labels if l['name'] == LABEL_NAME), None)
+                    if not label_robo_id:
+                        self.respond_success("Label ROBO_TIM não encontrada.", start_time)
+                        return
 
-            if not label_robo_id:
-                self.respond_success("Label ROBO_TIM não encontrada.", start_time)
-                return
+                    if not label_processed_id:
+                        print("AVISO: Não foi possível obter ID da label PROCESSADO.")
 
-            # Find/Create Destination Label
-            label_processed_id = self._get_or_create_label(service, LABEL_PROCESSED)
-            if not label_processed_id:
-                print("AVISO: Não foi possível obter ID da label PROCESSADO.")
-
-            # 4. Fetch Emails
-            # Fetch larger batch (50) to find older emails, then take the last N (Oldest)
-            results = service.users().messages().list(
-                userId='me', labelIds=[label_robo_id], maxResults=500
-            ).execute()
-            all_messages = results.get('messages', [])
-            
-            # Take the last MAX_EMAILS_PER_RUN (The oldest in this batch)
-            messages = all_messages[-MAX_EMAILS_PER_RUN:]
-            
-            # Process Oldest First (Chronological Order)
-            messages.reverse()
+                    # 4. Select Emails
+                    # Incremental: only messages labeled since the checkpoint (+ leftover backlog).
+                    # Full paginated listing only without a checkpoint or once it has expired.
+                    candidate_ids = None
+                    sync_mode = "INCREMENTAL"
+                    if checkpoint_id and not force_full:
+                        try:
+                            new_ids, history_id = list_label_history(service, checkpoint_id, label_robo_id)
+                            candidate_ids = list(dict.fromkeys(backlog_ids + new_ids))
+                        except Exception as e:
+                            if gmail_error_status(e) != 404: raise
+                            debug_logs.append("Checkpoint historyId expirado, usando listagem completa.")
+
+                    if candidate_ids is None:
+                        sync_mode = "FULL"
+                        # Capture the historyId BEFORE listing so nothing labeled meanwhile is lost
+                        history_id = service.users().getProfile(userId='me').execute()['historyId']
+                        candidate_ids = list_label_messages(service, label_robo_id)
+                    break
+                except Exception as e:
+                    # Revoked token or deleted label cached by a previous invocation: rebuild once
+                    if attempt == 0 and gmail_error_status(e) in (401, 404):
+                        runtime_invalidate('gmail_service', 'label_ids')
+                        continue
+                    raise
 
+            relabel_ids = unlabeled_ids
+            if relabel_ids:
+                unlabeled_ids = self._swap_labels(service, relabel_ids, label_robo_id, label_processed_id, debug_logs)
+                debug_logs.append(f"   -> [LABEL] Pendentes da execução anterior: {len(relabel_ids) - len(unlabeled_ids)} de {len(relabel_ids)} trocados.")
+                committed_before = set(relabel_ids)
+                candidate_ids = [m for m in candidate_ids if m not in committed_before]
 
-            debug_logs = []
-            debug_logs.append(f"Iniciando sincronização. Label ID: {label_robo_id}")
+            # Oldest first (Chronological Order); whatever does not fit stays in the backlog
+            messages = [{'id': msg_id} for msg_id in candidate_ids[:MAX_EMAILS_PER_RUN]]
+            retry_ids = candidate_ids[MAX_EMAILS_PER_RUN:]
+
+            debug_logs.append(f"Iniciando sincronização ({sync_mode}). Label ID: {label_robo_id}")
 
             processed_count = 0
             if not messages:
                 debug_logs.append("Nenhuma mensagem encontrada na busca da API.")
+                if str(history_id) != str(checkpoint_id) or relabel_ids:
+                    # Advance the checkpoint so the next history replay stays short
+                    db_client.queue_update("artifacts", meta_doc_id, {"history_id": str(history_id), "backlog_ids": [],
+                                                                      "unlabeled_ids": unlabeled_ids})
+                    db_client.flush_writes()
                 self.respond_success("Nenhum e-mail pendente.", start_time, debug_logs)
                 return
 
             print(f"Encontrados {len(messages)} e-mails.")
 
-            def get_html_part(payload):
-                if payload['mimeType'] == 'text/html':
-                    return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-                parts = payload.get('parts', [])
-                for part in parts:
-                    result = get_html_part(part)
-                    if result: return result
-                return None
+            # 5-7. Fetch, parse and persist through the staged pipeline while the time budget allows
+            deadline = SyncDeadline(start_time)
+            processed_msg_ids, failed_ids, pending_ids = run_sync_pipeline(
+                service, db_client, [m['id'] for m in messages], label_robo_id, deadline, debug_logs
+            )
+            retry_ids.extend(failed_ids)
 
-            debug_logs = []
-            
-            # 5. Process Emails
-            for msg in messages:
-                try:
-                    msg_detail = service.users().messages().get(
-                        userId='me', id=msg['id'], format='full'
-                    ).execute()
-                    
-                    headers = msg_detail['payload']['headers']
-                    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "")
-                    date_header = next((h['value'] for h in headers if h['name'] == 'Date'), "")
-                    
-                    debug_logs.append(f"Analisando: {subject[:50]}...")
-                    
-                    html_body = get_html_part(msg_detail['payload'])
-                    if not html_body:
-                        debug_logs.append(f" - [ERRO] HTML não encontrado.")
-                        continue
+            # Messages not started stay ahead of the rest of the backlog
+            retry_ids = pending_ids + retry_ids
 
-                    parsed_data_list = parse_email_html(html_body)
-                    
-                    if not parsed_data_list:
-                         debug_logs.append(f" - [PULADO] Nenhuma nota encontrada ou erro no parse.")
-                         continue
-                    
-                    debug_logs.append(f" - [OK] {len(parsed_data_list)} notas identificadas.")
-
-                    # Determine Movement Type based on Subject (Global for the email)
-                    is_entrada = "Recebimento de Carga" in subject or "Recebimento de carga" in subject
-                    is_saida = "Devolução de carga" in subject or "Devolução de Carga" in subject
-
-                    for parsed_data in parsed_data_list:
-                        nota_id = parsed_data['nota']
-                        debug_logs.append(f"   > Processando Nota: {nota_id}")
-
-                        if is_entrada:
-                            parsed_data["tipo_movimento"] = "RECEBIMENTO"
-                            existing_doc = db_client.get_document(COLLECTION_NAME, nota_id)
-                            
-                            if not existing_doc:
-                                # Payload for New Note
-                                payload = {
-                                    "nota_despacho": nota_id,
-                                    "status": "RECEBIDO", 
-                                    "data_email": date_header,
-                                    "data_ocorrencia": parsed_data['data_ocorrencia'], 
-                                    "origem": parsed_data['origem'],
-                                    "destino": parsed_data['destino'],
-                                    "qtde_unitizadores": parsed_data['qtde_unitizadores'],
-                                    "peso_total_declarado": parsed_data['peso_total_declarado'],
-                                    "peso_total_calculado": parsed_data['peso_total_calculado'],
-                                    "itens": parsed_data['itens'],
-                                    "criado_em": "SERVER_TIMESTAMP",
-                                    "divergencia": None, 
-                                    "created_by": "ROBO",
-                                    "msgs_entrada": 1,
-                                    "msgs_saida": 0
-                                }
-                                db_client.create_document(COLLECTION_NAME, nota_id, payload)
-                                debug_logs.append(f"     -> [SALVO] Criado com {len(parsed_data['itens'])} itens.")
-                            else:
-                                # Update Existing Note (MERGE)
-                                existing_fields = existing_doc.get('fields', {})
-                                
-                                # 1. Extract Existing ITENS
-                                existing_itens = []
-                                try:
-                                    vals = existing_fields.get('itens', {}).get('arrayValue', {}).get('values', [])
-                                    for v in vals:
-                                        fdata = v.get('mapValue', {}).get('fields', {})
-                                        existing_itens.append({
-                                            "unitizador": fdata.get('unitizador', {}).get('stringValue', '').strip(),
-                                            "lacre": fdata.get('lacre', {}).get('stringValue', ''),
-                                            "peso": float(fdata.get('peso', {}).get('doubleValue', 0)),
-                                            "conferido": fdata.get('conferido', {}).get('booleanValue', False)
-                                        })
-                                except: pass
-                                
-                                # 2. Merge New Items (parsed_data['itens']) with Existing
-                                merged_itens = merge_item_lists(existing_itens, parsed_data['itens'])
-                                
-                                # Calculate new totals from MERGED items
-                                new_total_weight = sum(i['peso'] for i in merged_itens)
-                                
-                                # Increment Message Count
-                                current_count = 1
-                                try:
-                                    if 'msgs_entrada' in existing_fields:
-                                        current_count = int(existing_fields['msgs_entrada'].get('integerValue', 1))
-                                    else:
-                                        current_count = 1 # Default if field missing
-                                except: pass
-                                
-                                new_msg_count = current_count + 1
-
-                                payload = {
-                                    "nota_despacho": nota_id,
-                                    "data_email": date_header,
-                                    "data_ocorrencia": parsed_data['data_ocorrencia'], 
-                                    "origem": parsed_data['origem'],
-                                    "destino": parsed_data['destino'],
-                                    "qtde_unitizadores": len(merged_itens), 
-                                    "peso_total_declarado": new_total_weight, 
-                                    "peso_total_calculado": new_total_weight, 
-                                    "itens": merged_itens,
-                                    "last_updated": "SERVER_TIMESTAMP",
-                                    "msgs_entrada": new_msg_count # Save Count
-                                }
-                                
-                                # Check Recalculation logic if Exit data exists
-                                itens_conferencia_field = existing_fields.get('itens_conferencia')
-                                
-                                if itens_conferencia_field:
-                                    # Reconciliation Logic
-                                    stored_units = {}
-                                    try:
-                                        vals = itens_conferencia_field.get('arrayValue', {}).get('values', [])
-                                        for v in vals:
-                                            fdata = v.get('mapValue', {}).get('fields', {})
-                                            uid = fdata.get('unitizador', {}).get('stringValue', '').strip()
-                                            w = float(fdata.get('peso', {}).get('doubleValue', 0))
-                                            if uid: stored_units[uid] = w
-                                    except: pass
-
-                                    entry_items = merged_itens # Use Merged List
-                                    divergences = []
-                                    
-                                    for item in entry_items:
-                                        uid = item['unitizador'].strip()
-                                        w_entry = item['peso']
-                                        if uid in stored_units:
-                                            w_exit = stored_units[uid]
-                                            if abs(w_entry - w_exit) > 0.1:
-                                                divergences.append(f"Unit {uid}: Peso Entrada {w_entry} != Saida {w_exit}")
-                                        else:
-                                            divergences.append(f"Unit {uid}: Não consta na devolução")
-                                    
-                                    entry_uids = set(i['unitizador'].strip() for i in entry_items)
-                                    for uid in stored_units:
-                                        if uid not in entry_uids:
-                                            divergences.append(f"Unit {uid}: Faltou na entrada")
-
-                                    if divergences:
-                                        payload['status'] = "DIVERGENTE"
-                                        payload['divergencia'] = "; ".join(divergences)
-                                    else:
-                                        payload['status'] = "CONCLUIDO"
-                                        payload['divergencia'] = None
-                                else:
-                                    doc_status = existing_fields.get('status', {}).get('stringValue')
-                                    if doc_status == 'DEVOLVED_ORPHAN':
-                                        payload['divergencia'] = None
-                                        payload['status'] = 'RECEBIDO'
-                                
-                                db_client.update_document(COLLECTION_NAME, nota_id, payload)
-                                debug_logs.append(f"     -> [ATUALIZADO] Dados de Entrada mesclados e vinculados ({new_msg_count} e-mails).")
-
-                        elif is_saida:
-                            parsed_data["tipo_movimento"] = "ENTREGA"
-                            existing_doc = db_client.get_document(COLLECTION_NAME, nota_id)
-
-                            if existing_doc:
-                                doc_data = existing_doc.get('fields', {})
-                                
-                                # 1. Extract Existing EXIT Items (itens_conferencia)
-                                existing_exit_items = []
-                                try:
-                                    vals = doc_data.get('itens_conferencia', {}).get('arrayValue', {}).get('values', [])
-                                    for v in vals:
-                                        fdata = v.get('mapValue', {}).get('fields', {})
-                                        existing_exit_items.append({
-                                            "unitizador": fdata.get('unitizador', {}).get('stringValue', '').strip(),
-                                            "lacre": fdata.get('lacre', {}).get('stringValue', ''),
-                                            "peso": float(fdata.get('peso', {}).get('doubleValue', 0)),
-                                            "conferido": fdata.get('conferido', {}).get('booleanValue', False)
-                                        })
-                                except: pass
-                                
-                                # 2. Merge New Exit Items with Existing
-                                merged_exit_items = merge_item_lists(existing_exit_items, parsed_data['itens'])
-                                stored_units = {i['unitizador']: i['peso'] for i in merged_exit_items}
-
-                                # 3. Extract ENTRY Items to compare
-                                entry_items = []
-                                try:
-                                    f_itens = doc_data.get('itens', {}).get('arrayValue', {}).get('values', [])
-                                    for v in f_itens:
-                                        fdata = v.get('mapValue', {}).get('fields', {})
-                                        entry_items.append({
-                                            "unitizador": fdata.get('unitizador', {}).get('stringValue', '').strip(),
-                                            "peso": float(fdata.get('peso', {}).get('doubleValue', 0))
-                                        })
-                                except: pass
-
-                                divergences = []
-                                
-                                # Compare Merged Exit Data vs Entry Data
-                                for item in merged_exit_items:
-                                    uid = item['unitizador'].strip()
-                                    w_exit = item['peso']
-                                    
-                                    # Find matching Entry item
-                                    w_entry = next((i['peso'] for i in entry_items if i['unitizador'] == uid), None)
-                                    
-                                    if w_entry is not None:
-                                        if abs(w_entry - w_exit) > 0.1:
-                                            divergences.append(f"Unit {uid}: Peso Entrada {w_entry} != Saida {w_exit}")
-                                    else:
-                                        # Only flag as missing if we HAVE entry items (otherwise it's just orphan)
-                                        if entry_items:
-                                            divergences.append(f"Unit {uid}: Não consta na entrada")
-                                
-                                # Reverse check (Missing in Exit)
-                                if entry_items:
-                                    exit_uids = set(i['unitizador'].strip() for i in merged_exit_items)
-                                    for i in entry_items:
-                                        if i['unitizador'] not in exit_uids:
-                                            divergences.append(f"Unit {i['unitizador']}: Faltou na devolução")
-
-                                # Determine Status
-                                new_status = "CONCLUIDO" if not divergences else "DIVERGENTE"
-                                if not entry_items: new_status = "DEVOLVED_ORPHAN" # Or keep existing if it was orphan
-                                
-                                # Calculate totals
-                                new_total_weight = sum(i['peso'] for i in merged_exit_items)
-                                
-                                # Increment Message Count (Exit)
-                                current_count = 0
-                                try:
-                                    if 'msgs_saida' in doc_data:
-                                        current_count = int(doc_data['msgs_saida'].get('integerValue', 0))
-                                    else:
-                                        # If field missing, assume 1 if exiting items exist, strictly 0 if not?
-                                        # Assume 0 or 1. Let's assume 1 if we are updating an existing exit note.
-                                        # If existing_exit_items is empty, likely 0.
-                                        current_count = 1 if existing_exit_items else 0
-                                except: pass
-                                
-                                new_msg_count = current_count + 1
-                                
-                                payload = {
-                                    "status": new_status,
-                                    "data_entrega": parsed_data['data_ocorrencia'] or date_header,
-                                    "divergencia": "; ".join(divergences) if divergences else None,
-                                    "itens_conferencia": merged_exit_items, # Save MERGED items
-                                    "qtde_unitizadores": len(merged_exit_items),
-                                    "peso_total_declarado": new_total_weight, 
-                                    "peso_total_calculado": new_total_weight, 
-                                    "last_updated": "SERVER_TIMESTAMP",
-                                    "msgs_saida": new_msg_count
-                                }
-                                
-                                db_client.update_document(COLLECTION_NAME, nota_id, payload)
-                                debug_logs.append(f"     -> [ATUALIZADO] Saída mesclada ({new_msg_count} e-mails). Status: {new_status}")
-                                
-                            else:
-                                # Orphan Note (Devolved without Receipt)
-                                payload = {
-                                    "nota_despacho": nota_id,
-                                    "status": "DEVOLVED_ORPHAN",
-                                    "data_email": date_header,
-                                    "data_ocorrencia": parsed_data['data_ocorrencia'], 
-                                    "data_entrega": parsed_data['data_ocorrencia'],
-                                    "origem": parsed_data['origem'],
-                                    "destino": parsed_data['destino'],
-                                    "qtde_unitizadores": parsed_data['qtde_unitizadores'],
-                                    "peso_total_declarado": parsed_data['peso_total_declarado'],
-                                    "peso_total_calculado": parsed_data['peso_total_calculado'],
-                                    "itens_conferencia": parsed_data['itens'], # Save as conferência
-                                    "itens": [], # Empty entry items
-                                    "criado_em": "SERVER_TIMESTAMP",
-                                    "divergencia": "Nota de Devolução sem entrada prévia.",
-                                    "created_by": "ROBO",
-                                    "msgs_entrada": 0,
-                                    "msgs_saida": 1
-                                }
-                                db_client.create_document(COLLECTION_NAME, nota_id, payload)
-                                debug_logs.append(f"     -> [CRIADO-ORFAO] Devolução sem origem.")
-
-                        else:
-                            debug_logs.append(f"     -> [PULADO] Tipo (Subject) não reconhecido.")
-
-                    # Swap Label (Once per email, after all notes processed)
-                    if label_processed_id:
-                        mods = {
-                            'ids': [msg['id']],
-                            'removeLabelIds': [label_robo_id],
-                            'addLabelIds': [label_processed_id]
-                        }
-                        service.users().messages().batchModify(userId='me', body=mods).execute()
-                        debug_logs.append(f"   -> [LABEL] Trocado ROBO_TIM por PROCESSADO.")
-                    else:
-                        debug_logs.append(f"   -> [ERRO-LABEL] ID de PROCESSADO não disponível.")
+            # 8. Commit buffered writes (documents:commit, atomic chunks)
+            failed_msg_ids = set()
+            for failure in db_client.flush_writes():
+                failed_msg_ids.update(failure['tags'])
+                debug_logs.append(f" - [CONFLITO] {failure['name'].split('/')[-1]} não gravada, e-mail(s) serão reprocessados: {failure['error'][:200]}")
 
-                    processed_count += 1
+            committed_msg_ids = [m for m in processed_msg_ids if m not in failed_msg_ids]
+            processed_count = len(committed_msg_ids)
+            retry_ids.extend(m for m in processed_msg_ids if m in failed_msg_ids)
 
-                except Exception as e:
-                    print(f"Erro ao processar mensagem {msg['id']}: {e}")
-                    debug_logs.append(f" - [CRITICO] Erro exceção: {str(e)}")
+            # 9. Swap Labels (only for e-mails whose writes were committed)
+            # A failed swap does not stop the metadata save: those e-mails are only relabeled next run
+            failed_labels = self._swap_labels(service, committed_msg_ids, label_robo_id, label_processed_id, debug_logs)
+            unlabeled_ids = list(dict.fromkeys(unlabeled_ids + failed_labels))
+            if label_processed_id:
+                debug_logs.append(f"   -> [LABEL] Trocado ROBO_TIM por PROCESSADO em {processed_count - len(failed_labels)} e-mails.")
 
-            # 6. Save Sync Metadata
+            # 10. Save Sync Metadata
             try:
                 meta_payload = {
                     "last_sync": "SERVER_TIMESTAMP",
                     "status": "SUCCESS",
-                    "processed_count": processed_count
+                    "processed_count": processed_count,
+                    "sync_mode": sync_mode,
+                    "history_id": str(history_id),
+                    "backlog_ids": list(dict.fromkeys(retry_ids)),
+                    "unlabeled_ids": unlabeled_ids
                 }
-                db_client.create_document("artifacts", f"{os.environ.get('FIREBASE_APP_ID', 'default')}_sync_metadata", meta_payload)
+                db_client.queue_create("artifacts", meta_doc_id, meta_payload)
+                for failure in db_client.flush_writes():
+                    raise Exception(failure['error'])
             except Exception as e:
                 debug_logs.append(f" - [ERRO] Falha ao salvar metadata: {e}")
 
-            self.respond_success(f"Processados {processed_count} e-mails.", start_time, debug_logs)
+            backlog_remaining = len(dict.fromkeys(retry_ids))
+            self.respond_success(f"Processados {processed_count} e-mails.", start_time, debug_logs, {
+                "backlog_remaining": backlog_remaining,
+                "time_budget_seconds": SYNC_TIME_BUDGET_SECONDS,
+                "seconds_per_email": round(deadline.cost_per_email(), 3)
+            })
 
 
 
@@ -771,7 +1500,7 @@ class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self._set_headers(200)
 
-    def respond_success(self, message, start_time, debug_logs=None):
+    def respond_success(self, message, start_time, debug_logs=None, extra=None):
         duration = time.time() - start_time
         self._set_headers(200)
         
@@ -780,5 +1509,6 @@ class handler(BaseHTTPRequestHandler):
             "message": message,
             "execution_time_seconds": round(duration, 2)
         }
+        if extra: res.update(extra)
         if debug_logs: res["debug_logs"] = debug_logs
         self.wfile.write(json.dumps(res, ensure_ascii=False).encode('utf-8'))
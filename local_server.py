@@ -1,7 +1,7 @@
 import os
-import re
-import json
-import pdfplumber
+import sys
+import tempfile
+from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from google.oauth2.credentials import Credentials
@@ -9,13 +9,25 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.cloud import firestore
 
+# Helpers shared with the Vercel functions
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+import _audit_engine as audit_engine
+from _pdf_text import DiskTextCache
+from _audit_jobs import LocalJobRunner
+from _bulk_writer import BULK_WRITE_MAX_ATTEMPTS, RETRYABLE_CODES
+from _unitizer_index import (INDEX_COLLECTION, INDEX_META_DOC, INDEX_MAP_FIELD, shard_id,
+                             plain_shards, read_plain_entries, concurrent_entries)
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+jobs = LocalJobRunner() # Audits sent with mode=job run on background threads
 
 # --- CONFIG ---
 TOKEN_FILE = 'firestore_token.json'
 CREDENTIALS_FILE = 'credentials.json'
 SCOPES = ['https://www.googleapis.com/auth/datastore']
+COLLECTION_NAME = 'tb_despachos_conferencia'
+AUDIT_ITEM_FIELDS = ['itens', 'data_ocorrencia_iso']
 
 def get_firestore_client():
     creds = None
@@ -58,18 +70,6 @@ def get_firestore_client():
         print(f"❌ Erro Firestore: {e}")
         return None
 
-def extract_text_from_pdf(file_stream):
-    text_content = ""
-    try:
-        with pdfplumber.open(file_stream) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text: text_content += text + "\n"
-        return re.sub(r'\s+', '', text_content).upper()
-    except Exception as e:
-        print(f"Erro PDF: {e}")
-        return ""
-
 @app.route('/api/audit_pdf', methods=['POST'])
 def audit_pdf():
     print("📥 Recebendo requisição de auditoria...")
@@ -79,37 +79,7 @@ def audit_pdf():
     if not db:
         return jsonify({'error': 'Falha na autenticação do banco de dados'}), 500
 
-    # 2. Get Data from DB
-    print("⏳ Carregando unitizadores do banco...")
-    unitizer_map = {}
-    docs = db.collection('tb_despachos_conferencia').stream()
-    
-    for doc in docs:
-        doc_data = doc.to_dict()
-        doc_id = doc.id
-        itens = doc_data.get('itens', [])
-        
-        for idx, item in enumerate(itens):
-            # Normalizar estrutura do item
-            item_dict = {}
-            if isinstance(item, str):
-                item_dict = {'unitizador': item.split(' - ')[0]}
-            elif isinstance(item, dict):
-                item_dict = item
-            
-            code = item_dict.get('unitizador', '').strip()
-            if code:
-                norm_code = code.replace(" ", "").upper()
-                unitizer_map[norm_code] = {
-                    "doc_id": doc_id,
-                    "item_index": idx,
-                    "data": item_dict 
-                }
-
-    all_db_codes = set(unitizer_map.keys())
-    print(f"✅ {len(all_db_codes)} unitizadores carregados.")
-
-    # 3. Process Files
+    # 2. Process Files
     files_to_process = []
     
     # helper to process allowed files
@@ -120,9 +90,13 @@ def audit_pdf():
         
         if file:
             print(f"📄 Processando {type_label}: {file.filename} ({month})")
+            # Spooled to disk: the extraction reads the PDF by path, page range by page range
+            fd, path = tempfile.mkstemp(suffix=".pdf")
+            with os.fdopen(fd, 'wb') as spool:
+                file.save(spool)
             return {
                 'type': type_label,
-                'content': extract_text_from_pdf(file),
+                'path': path,
                 'month': month,
                 'price': float(price) if price else 0.0
             }
@@ -139,134 +113,160 @@ def audit_pdf():
     if not files_to_process:
         return jsonify({'error': 'Nenhum arquivo enviado'}), 400
 
-    # 4. Cross-Reference & Prepare Updates
-    found_codes = set()
-    updates_by_doc = {} # doc_id -> list of updated items
-    
-    for f_info in files_to_process:
-        pdf_text = f_info['content']
-        
-        for code in all_db_codes:
-            if code in pdf_text:
-                found_codes.add(code)
-                
-                # Prepare Update Data
-                meta = unitizer_map[code]
-                item_data = meta['data']
-                
-                # Check if update is needed
-                needs_update = False
-                if not item_data.get('correios_match'): needs_update = True
-                if item_data.get('correios_ref_month') != f_info['month']: needs_update = True
-                
-                if needs_update:
-                    item_data['correios_match'] = True
-                    item_data['correios_ref_month'] = f_info['month']
-                    item_data['correios_type'] = f_info['type']
-                    item_data['correios_value'] = f_info['price']
-                    
-                    doc_id = meta['doc_id']
-                    if doc_id not in updates_by_doc:
-                        updates_by_doc[doc_id] = []
-                    
-                    # We store the MODIFIED item data
-                    # Wait! Logic issue: If a doc has 10 items, we need the whole array to update it properly via 'update'
-                    # or strictly use array manipulation if we want to be fancy.
-                    # EASIER: Since we loaded ALL data, we can just reconstruct the array for the doc.
-                    pass
+    # Same options as the Vercel function (date window, index rebuild)
+    params = {
+        "ref_months": [request.form.get('month_postal'), request.form.get('month_densa')],
+        "date_margin_days": request.form.get('date_margin_days'),
+        "rebuild_index": bool(request.form.get('rebuild_index'))
+    }
 
-    # 5. Apply Updates (Batching per document)
-    # Re-reading docs that need updates to ensure safety or using loaded data?
-    # Using loaded data is faster but theoretically risky if concurrent edits. 
-    # For local server single user, it's fine.
-    
-    updated_count = 0
-    
-    # Group by Doc to minimize writes
-    # We need to re-fetch the specific docs to ensure we have the full array structure correct before writing back
-    # Or rely on the 'unitizer_map' if it holds reference to mutable objects? No, deepcopy issues.
-    
-    # Better strategy: Loop through the 'updates_by_doc' keys, fetch doc, update metrics, write back.
-    # To do that efficiently, we need to know WHICH docs contain found unitizers.
-    
-    docs_to_update = set()
-    for code in found_codes:
-        docs_to_update.add(unitizer_map[code]['doc_id'])
-    
-    print(f"💾 Atualizando {len(docs_to_update)} documentos no Firestore...")
-    
-    batch = db.batch()
-    batch_count = 0
-    
-    for doc_id in docs_to_update:
-        doc_ref = db.collection('tb_despachos_conferencia').document(doc_id)
-        # We need to read current state to update array
-        snapshot = doc_ref.get()
-        if not snapshot.exists: continue
-        
-        d_data = snapshot.to_dict()
-        d_itens = d_data.get('itens', [])
-        modified = False
-        
-        new_itens = []
-        for item in d_itens:
-            # Normalize item
-            i_dict = item if isinstance(item, dict) else {'unitizador': item.split(' - ')[0]}
-            code = i_dict.get('unitizador', '').strip().replace(" ", "").upper()
-            
-            # Check if this specific item was found in THIS upload session
-            # We need to know WHICH file found it to apply correct metadata
-            
-            # Simple check: is code in found_codes?
-            if code in found_codes:
-                # Find which file info applies (Postal vs Densa priority? or just last one?)
-                # If in both, usually Densa/Postal might duplicate.
-                # Let's verify against the files processed.
-                
-                matched_file = None
-                for f in files_to_process:
-                    if code in f['content']:
-                        matched_file = f
-                        break # Take first match
-                
-                if matched_file:
-                    # Check if changes needed
-                    if i_dict.get('correios_match') != True or \
-                       i_dict.get('correios_ref_month') != matched_file['month']:
-                        
-                        i_dict['correios_match'] = True
-                        i_dict['correios_ref_month'] = matched_file['month']
-                        i_dict['correios_type'] = matched_file['type']
-                        i_dict['correios_value'] = matched_file['price']
-                        modified = True
-            
-            new_itens.append(i_dict)
-            
-        if modified:
-            batch.update(doc_ref, {'itens': new_itens})
-            batch_count += 1
-            updated_count += 1
-            
-            if batch_count >= 400: # Firestore batch limit 500
-                batch.commit()
-                batch = db.batch()
-                batch_count = 0
+    if request.form.get('mode') == 'job':
+        # Same contract as the Vercel function: job id now, status/results polled with GET
+        job_id = jobs.submit(lambda progress: run_audit(db, files_to_process, params, progress))
+        print(f"🕒 Auditoria enviada como job {job_id}")
+        return jsonify({
+            "job_id": job_id,
+            "phase": "queued",
+            "status_url": f"/api/audit_pdf?job={job_id}"
+        }), 202
 
-    if batch_count > 0:
-        batch.commit()
+    return jsonify(run_audit(db, files_to_process, params))
 
-    missing_list = sorted(list(all_db_codes - found_codes))
-    
-    print("✅ Processamento concluído.")
-    
-    return jsonify({
-        "status": "success",
-        "found_count": len(found_codes),
-        "missing_count": len(missing_list),
-        "total_processed": len(all_db_codes),
-        "docs_updated": updated_count,
-        "missing_codes": missing_list
-    })
+@app.route('/api/audit_pdf', methods=['GET'])
+def audit_job():
+    """Status of a local job (?job=<id>), or a page of its missing codes (&page=<n>, from 0)."""
+    job_id = request.args.get('job')
+    status = jobs.status(job_id) if job_id else None
+    if not status:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    if 'page' not in request.args:
+        return jsonify(status)
+    if not request.args['page'].isdigit():
+        return jsonify({'error': "Parametro 'page' deve ser um numero >= 0"}), 400
+    page = jobs.result_page(job_id, int(request.args['page']))
+    if page is None:
+        return jsonify(status), 409 # Not finished yet
+    return jsonify(page)
+
+def run_audit(db, files_to_process, params, progress=None):
+    """Runs the shared audit engine (api/_audit_engine.py); the extratos are temp files, removed here."""
+    try:
+        result = audit_engine.run_audit(CloudFirestoreBackend(db), files_to_process, progress=progress, **params)
+    finally:
+        for f in files_to_process:
+            os.remove(f['path'])
+    print(f"✅ Processamento concluído: {result['found_count']} encontrados, {result['docs_updated']} documentos atualizados.")
+    return result
+
+class CloudFirestoreBackend:
+    """Audit engine storage over google-cloud-firestore (same collections as the Vercel function)."""
+    def __init__(self, db):
+        self.db = db
+        self.shard_versions = {} # { shard id: update_time as read } - guards the index removals
+        self.shard_entries = {} # { shard id: entries as read } - what a rebuild compares a changed shard to
+        self.versions = {} # { nota id: update_time as read } - guards the itens writes
+
+    def text_caches(self):
+        return [DiskTextCache()]
+
+    def load_index(self):
+        print("⏳ Carregando índice de unitizadores...")
+        index_meta = {}
+        shards = []
+        for snapshot in self.db.collection(INDEX_COLLECTION).stream():
+            if snapshot.id == INDEX_META_DOC:
+                index_meta = snapshot.to_dict()
+                continue
+            self.shard_versions[snapshot.id] = snapshot.update_time
+            self.shard_entries[snapshot.id] = read_plain_entries([snapshot.to_dict()])
+            shards.append(snapshot.to_dict())
+        return index_meta, read_plain_entries(shards)
+
+    def iter_notas(self, bounds):
+        print("⏳ Carregando unitizadores do banco...")
+        query = self.db.collection(COLLECTION_NAME).select(AUDIT_ITEM_FIELDS)
+        if bounds:
+            query = query.where('data_ocorrencia_iso', '>=', bounds[0]).where('data_ocorrencia_iso', '<', bounds[1])
+        for snapshot in query.stream():
+            data = snapshot.to_dict()
+            self.versions[snapshot.id] = snapshot.update_time
+            yield snapshot.id, data.get('data_ocorrencia_iso'), normalize_items(data.get('itens', []))
+
+    def get_notas(self, doc_ids):
+        refs = [self.db.collection(COLLECTION_NAME).document(doc_id) for doc_id in doc_ids]
+        notas = {}
+        for snapshot in self.db.get_all(refs, field_paths=['itens']):
+            if not snapshot.exists: continue
+            self.versions[snapshot.id] = snapshot.update_time
+            notas[snapshot.id] = normalize_items(snapshot.to_dict().get('itens', []))
+        return notas
+
+    def write_itens(self, itens_by_nota, on_progress=None):
+        # BulkWriter: batched writes, several in flight, rate-limited (500 ops/s ramp-up);
+        # a transient failure is retried by itself up to BULK_WRITE_MAX_ATTEMPTS times.
+        # A nota changed since it was read fails its last_update_time precondition at once
+        print(f"💾 Atualizando {len(itens_by_nota)} documentos no Firestore...")
+        written_docs = []
+        failed_docs = set()
+
+        def on_write_result(doc_ref, result, bulk_writer):
+            written_docs.append(doc_ref.id)
+            if on_progress: on_progress(len(written_docs))
+
+        def on_write_error(error, bulk_writer):
+            if error.code in RETRYABLE_CODES and error.attempts < BULK_WRITE_MAX_ATTEMPTS: return True
+            print(f"⚠️ Documento {error.operation.reference.id} não atualizado: {error.message}")
+            failed_docs.add(error.operation.reference.id)
+            return False
+
+        bulk_writer = self.db.bulk_writer()
+        bulk_writer.on_write_result(on_write_result)
+        bulk_writer.on_write_error(on_write_error)
+        for doc_id, items in itens_by_nota.items():
+            version = self.versions.get(doc_id)
+            bulk_writer.update(self.db.collection(COLLECTION_NAME).document(doc_id), {'itens': items},
+                               option=self.db.write_option(last_update_time=version) if version else None)
+        bulk_writer.close() # Waits for every write (and retry)
+        return failed_docs
+
+    def remove_index_entries(self, code_notas):
+        by_shard = {}
+        for code, doc_ids in code_notas.items():
+            by_shard.setdefault(shard_id(code), {}).update(
+                {firestore.FieldPath(INDEX_MAP_FIELD, code, doc_id).to_api_repr(): firestore.DELETE_FIELD for doc_id in doc_ids})
+        for shard, deletes in by_shard.items():
+            if shard not in self.shard_versions or not deletes: continue
+            try:
+                # Skipped if a sync changed the shard meanwhile: stale entries only cost a read next time
+                self.db.collection(INDEX_COLLECTION).document(shard).update(
+                    deletes, option=self.db.write_option(last_update_time=self.shard_versions[shard]))
+            except Exception as e:
+                print(f"⚠️ Índice de unitizadores não atualizado ({shard}): {e}")
+
+    def rebuild_index(self, doc_itens, doc_dates):
+        shards = plain_shards(doc_itens, doc_dates)
+        refs = {shard: self.db.collection(INDEX_COLLECTION).document(shard) for shard in shards}
+
+        @firestore.transactional
+        def rewrite(transaction):
+            # A shard a sync changed since load_index keeps what that sync added
+            for snapshot in self.db.get_all(list(refs.values()), transaction=transaction):
+                if not snapshot.exists or snapshot.update_time == self.shard_versions.get(snapshot.id): continue
+                loaded = self.shard_entries.get(snapshot.id, {})
+                for (code, nota_id), entry in concurrent_entries(loaded, read_plain_entries([snapshot.to_dict()])).items():
+                    shards[snapshot.id].setdefault(code, {})[nota_id] = entry
+            for shard, codes in shards.items():
+                transaction.set(refs[shard], {INDEX_MAP_FIELD: codes})
+            transaction.set(self.db.collection(INDEX_COLLECTION).document(INDEX_META_DOC), {
+                'complete': True, 'rebuilt_at': datetime.utcnow().isoformat() + "Z"
+            })
+
+        rewrite(self.db.transaction())
+
+def normalize_items(itens):
+    """Items as dicts (old notas stored "CODE - ..." strings)."""
+    return [item if isinstance(item, dict) else {'unitizador': item.split(' - ')[0]} if isinstance(item, str) else {}
+            for item in itens]
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,8 @@
+// Índice de unitizadores da auditoria (api/_unitizer_index.py)
+import { doc, setDoc } from 'firebase/firestore';
+import { db } from './firebase';
+
+// Notas gravadas fora do sync não entram no índice: a próxima auditoria varre todas as notas e o reconstrói.
+// Chamar depois de gravar, para que uma reconstrução em andamento não marque o índice como completo sem elas.
+export const invalidateUnitizerIndex = () =>
+    setDoc(doc(db, 'tb_unitizadores_index', '_meta'), { complete: false }, { merge: true });
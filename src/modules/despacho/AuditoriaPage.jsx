@@ -3,6 +3,7 @@ import { Button, Card, Input, Select } from '../../components/ui';
 import { Upload, FileText, CheckCircle, AlertCircle, Copy, Search, AlertTriangle, Loader2 } from 'lucide-react';
 import { extractTextFromPDF } from '../../utils/pdfProcessor';
 import { db } from '../../lib/firebase';
+import { invalidateUnitizerIndex } from '../../lib/unitizerIndex';
 import { collection, getDocs, writeBatch, doc } from 'firebase/firestore';
 
 const AuditoriaPage = () => {
@@ -206,6 +207,7 @@ const AuditoriaPage = () => {
                     }
                 }
                 if (batchCount > 0) await batch.commit();
+                await invalidateUnitizerIndex();
             }
 
             // 5. Results
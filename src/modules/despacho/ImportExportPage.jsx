@@ -2,6 +2,7 @@
 import React, { useState } from 'react';
 import * as XLSX from 'xlsx';
 import { db } from '../../lib/firebase';
+import { invalidateUnitizerIndex } from '../../lib/unitizerIndex';
 import { collection, query, where, getDocs, writeBatch, doc } from 'firebase/firestore';
 import { Card, Button } from '../../components/ui';
 import { Upload, FileDown, FileSpreadsheet, Loader2, CheckCircle, AlertCircle, Download } from 'lucide-react';
@@ -254,6 +255,7 @@ const ImportExportPage = () => {
             if (totalOps > 0) {
                 await batchHandler.commit();
             }
+            await invalidateUnitizerIndex();
 
             setImportProgress(100);
             setStats({
@@ -2,6 +2,7 @@ import React, { useState } from 'react';
 import { X, Save, Plus, Trash2 } from 'lucide-react';
 import { collection, addDoc } from 'firebase/firestore';
 import { db } from '../../../lib/firebase';
+import { invalidateUnitizerIndex } from '../../../lib/unitizerIndex';
 import { Button, Input, Select } from '../../../components/ui';
 import { CITIES } from '../../../lib/cities';
 
@@ -91,6 +92,7 @@ const NotaManualModal = ({ isOpen, onClose, onSuccess }) => {
             }
 
             await addDoc(collection(db, 'tb_despachos_conferencia'), dataToSave);
+            await invalidateUnitizerIndex();
 
             if (onSuccess) onSuccess();
             onClose();
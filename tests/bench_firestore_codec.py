@@ -0,0 +1,146 @@
+"""
+Micro-benchmark of api/_firestore_codec.py against the conversions it replaced, on notas with
+hundreds of itens. Not collected by the test runner: python tests/bench_firestore_codec.py [itens ...]
+
+The previous paths are kept below as they were in the handlers:
+- sync_emails.FirestoreClient._to_firestore_json (sync writes);
+- audit_pdf.FirestoreClient._update_fields (audit writes; lossy: ints as doubles, lists dropped);
+- the .get('mapValue', {}).get('fields', {})... chains that read the itens (sync and audit).
+"""
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+from _firestore_codec import encode_fields, decode_records
+
+ROUNDS = 25 # Best of, interleaved so that both sides see the same machine load
+AUDIT_ITEM_SCHEMA = {
+    "unitizador": "", "lacre": "", "peso": 0.0, "conferido": False,
+    "correios_match": False, "correios_ref_month": "", "correios_type": "", "correios_value": 0.0
+}
+
+
+# -------------------------------------------------------------------------
+# PREVIOUS PATHS
+# -------------------------------------------------------------------------
+def previous_sync_encode(data):
+    fields = {}
+    for key, value in data.items():
+        if value is None:
+            fields[key] = {"nullValue": None}
+        elif isinstance(value, bool):
+            fields[key] = {"booleanValue": value}
+        elif isinstance(value, int):
+            fields[key] = {"integerValue": str(value)}
+        elif isinstance(value, float):
+            fields[key] = {"doubleValue": value}
+        elif isinstance(value, str):
+            fields[key] = {"stringValue": value}
+        elif isinstance(value, list):
+            array_values = []
+            for item in value:
+                if isinstance(item, dict):
+                    array_values.append({"mapValue": {"fields": previous_sync_encode(item)["fields"]}})
+                else:
+                    array_values.append(previous_sync_encode({"v": item})["fields"]["v"])
+            fields[key] = {"arrayValue": {"values": array_values}}
+        elif isinstance(value, dict):
+            fields[key] = {"mapValue": {"fields": previous_sync_encode(value)["fields"]}}
+    return {"fields": fields}
+
+
+def previous_audit_encode(data):
+    fields = {}
+    for k, v in data.items():
+        if isinstance(v, str): fields[k] = {"stringValue": v}
+        elif isinstance(v, bool): fields[k] = {"booleanValue": v}
+        elif isinstance(v, (int, float)): fields[k] = {"doubleValue": float(v)}
+    if 'itens' in data:
+        array_values = []
+        for item in data['itens']:
+            item_fields = {}
+            for ik, iv in item.items():
+                if isinstance(iv, str): item_fields[ik] = {"stringValue": iv}
+                elif isinstance(iv, bool): item_fields[ik] = {"booleanValue": iv}
+                elif isinstance(iv, (int, float)): item_fields[ik] = {"doubleValue": float(iv)}
+            array_values.append({"mapValue": {"fields": item_fields}})
+        fields['itens'] = {"arrayValue": {"values": array_values}}
+    return fields
+
+
+def previous_audit_decode(fields):
+    items = []
+    for v in fields.get('itens', {}).get('arrayValue', {}).get('values', []):
+        item_fields = v.get('mapValue', {}).get('fields', {})
+        items.append({
+            "unitizador": item_fields.get('unitizador', {}).get('stringValue', ''),
+            "lacre": item_fields.get('lacre', {}).get('stringValue', ''),
+            "peso": float(item_fields.get('peso', {}).get('doubleValue', 0)),
+            "conferido": item_fields.get('conferido', {}).get('booleanValue', False),
+            "correios_match": item_fields.get('correios_match', {}).get('booleanValue', False),
+            "correios_ref_month": item_fields.get('correios_ref_month', {}).get('stringValue', ''),
+            "correios_type": item_fields.get('correios_type', {}).get('stringValue', ''),
+            "correios_value": float(item_fields.get('correios_value', {}).get('doubleValue', 0)),
+        })
+    return items
+
+
+# -------------------------------------------------------------------------
+# DOCUMENTS
+# -------------------------------------------------------------------------
+def sync_nota(rng, count):
+    """A nota as sync_emails writes it."""
+    itens = [{"unitizador": f"NX{rng.randint(10**8, 10**9 - 1)}BR", "lacre": str(rng.randint(100000, 999999)),
+              "peso": round(rng.uniform(0.5, 80), 2), "conferido": False} for _ in range(count)]
+    return {
+        "nota_despacho": f"NN{rng.randint(10**7, 10**8)}", "origem": "CDD SANTARÉM", "destino": "AC ÓBIDOS",
+        "data_ocorrencia": "01/03/2026 10:00", "data_ocorrencia_iso": "2026-03-01T10:00", "status": "RECEBIDO",
+        "qtde_unitizadores": count, "peso_total_declarado": sum(item["peso"] for item in itens),
+        "msgs_entrada": 1, "itens": itens, "itens_conferencia": itens[:count // 2], "divergencia": None,
+    }
+
+
+def audit_itens(rng, count):
+    """The itens of a nota as the audit writes them back."""
+    return [{"unitizador": f"NX{rng.randint(10**8, 10**9 - 1)}BR", "lacre": str(rng.randint(100000, 999999)),
+             "peso": round(rng.uniform(0.5, 80), 2), "conferido": False, "correios_match": rng.random() < 0.5,
+             "correios_ref_month": "Março/2026", "correios_type": "Postal", "correios_value": 2.89} for _ in range(count)]
+
+
+def best_of(cases, number):
+    """{ name: best microseconds per call } of (name, fn) cases, rounds interleaved."""
+    best = {name: float('inf') for name, _ in cases}
+    for _ in range(ROUNDS):
+        for name, fn in cases:
+            best[name] = min(best[name], timeit.timeit(fn, number=number) / number * 1e6)
+    return best
+
+
+def compare(title, previous, current, number):
+    times = best_of([("previous", previous), ("codec", current)], number)
+    print(f"  {title:<24} {times['previous']:9.1f} us {times['codec']:9.1f} us   {times['previous'] / times['codec']:.2f}x")
+
+
+def main(sizes):
+    rng = random.Random(1)
+    for count in sizes:
+        nota = sync_nota(rng, count)
+        itens = audit_itens(rng, count)
+        wire = json.loads(json.dumps(encode_fields({"itens": itens})))
+        assert decode_records(wire['itens'], AUDIT_ITEM_SCHEMA) == previous_audit_decode(wire)
+        number = max(1, 4000 // count)
+
+        print(f"{count} itens                   previous      codec   speedup")
+        compare("sync nota encode", lambda: previous_sync_encode(nota), lambda: encode_fields(nota), number)
+        compare("audit itens encode", lambda: previous_audit_encode({"itens": itens}),
+                lambda: encode_fields({"itens": itens}), number)
+        compare("audit itens decode", lambda: previous_audit_decode(wire),
+                lambda: decode_records(wire['itens'], AUDIT_ITEM_SCHEMA), number)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [200, 800])
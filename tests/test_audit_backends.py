@@ -0,0 +1,349 @@
+"""
+The audit engine's backend contract (api/_audit_engine.py), run over MemoryBackend and over
+FirestoreRestBackend (api/audit_pdf.py) with an in-memory Firestore REST API: same results,
+index used or rebuilt, writes conditional on the version read. CloudFirestoreBackend
+(local_server.py) over a google-cloud-firestore fake, when its dependencies are installed.
+"""
+import json
+import os
+import re
+import sys
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audit_pdf
+from _audit_engine import run_audit, MemoryBackend
+from _firestore_codec import encode_fields, decode_fields, decode_value
+from _http_client import iter_json_array
+from _unitizer_index import INDEX_COLLECTION, INDEX_META_DOC
+from test_audit_engine import AuditEngineTestCase, item
+
+try:
+    import local_server
+except ImportError: # Flask / google-cloud-firestore not installed
+    local_server = None
+
+FIELD_PATH_SEGMENT = re.compile(r"`((?:[^`\\]|\\.)*)`|([^.`]+)")
+FAILED_PRECONDITION, UNAVAILABLE = 9, 14
+
+
+def split_path(path):
+    return [re.sub(r"\\(.)", r"\1", quoted) if quoted else plain for quoted, plain in FIELD_PATH_SEGMENT.findall(path)]
+
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size):
+        data = self.text.encode()
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class MemoryRestClient(audit_pdf.FirestoreClient):
+    """FirestoreClient over documents kept in memory: runQuery, batchGet, commit and batchWrite."""
+    documents_path = "projects/demo/databases/(default)/documents"
+
+    def __init__(self, notas):
+        self.base_url = f"https://firestore.googleapis.com/v1/{self.documents_path}"
+        self.docs = {} # { name: { "fields", "updateTime" } }
+        self.clock = 0
+        for doc_id, nota in notas.items():
+            self.put(audit_pdf.COLLECTION_NAME, doc_id, encode_fields(nota))
+
+    def name(self, collection, doc_id):
+        return f"{self.documents_path}/{collection}/{doc_id}"
+
+    def put(self, collection, doc_id, fields):
+        """A write from outside the audit (sync, frontend): a new version."""
+        self.clock += 1
+        self.docs[self.name(collection, doc_id)] = {"fields": fields, "updateTime": f"2026-03-10T12:00:{self.clock:06d}Z"}
+
+    def _request(self, method, url, json=None, **kwargs):
+        return getattr(self, 'serve_' + url.rsplit(':', 1)[1])(json)
+
+    def serve_runQuery(self, body):
+        query = body['structuredQuery']
+        collection = query['from'][0]['collectionId']
+        order = [o['field']['fieldPath'] for o in query['orderBy']]
+        key = lambda doc: tuple(doc['name'] if f == "__name__" else decode_value(doc['fields'][f]) for f in order)
+        docs = [{"name": name, **doc} for name, doc in self.docs.items() if name.split('/')[-2] == collection]
+        for bound in query.get('where', {}).get('compositeFilter', {}).get('filters', []):
+            field, value = bound['fieldFilter']['field']['fieldPath'], decode_value(bound['fieldFilter']['value'])
+            test = (lambda v: v >= value) if bound['fieldFilter']['op'] == "GREATER_THAN_OR_EQUAL" else (lambda v: v < value)
+            docs = [doc for doc in docs if field in doc['fields'] and test(decode_value(doc['fields'][field]))]
+        docs.sort(key=key)
+        if 'startAt' in query:
+            cursor = tuple(value.get('referenceValue') or decode_value(value) for value in query['startAt']['values'])
+            docs = [doc for doc in docs if key(doc) > cursor]
+        selected = [f['fieldPath'] for f in query['select']['fields']] if 'select' in query else None
+        results = [{"document": {**doc, "fields": {f: v for f, v in doc['fields'].items() if selected is None or f in selected}}}
+                   for doc in docs[:query['limit']]]
+        return Response(200, results or [{"readTime": "2026-03-10T12:00:00Z"}])
+
+    def serve_batchGet(self, body):
+        return Response(200, [{"found": {"name": name, **self.docs[name]}} if name in self.docs else {"missing": name}
+                              for name in body['documents']])
+
+    def rejected(self, write):
+        precondition = write.get('currentDocument', {})
+        name = write.get('delete') or write['update']['name']
+        if 'updateTime' in precondition:
+            return self.docs.get(name, {}).get('updateTime') != precondition['updateTime']
+        return 'exists' in precondition and (name in self.docs) != precondition['exists']
+
+    def apply(self, write):
+        if 'delete' in write:
+            self.docs.pop(write['delete'], None)
+            return
+        name, fields = write['update']['name'], write['update']['fields']
+        if 'updateMask' not in write:
+            stored = fields
+        else:
+            stored = self.docs.get(name, {}).get('fields', {})
+            for path in write['updateMask']['fieldPaths']:
+                source, target = fields, stored
+                segments = split_path(path)
+                for segment in segments[:-1]:
+                    source = source.get(segment, {}).get('mapValue', {}).get('fields', {})
+                    target = target.setdefault(segment, {"mapValue": {"fields": {}}})['mapValue'].setdefault('fields', {})
+                if segments[-1] in source: target[segments[-1]] = source[segments[-1]]
+                else: target.pop(segments[-1], None) # In the mask, not in the fields: deleted
+        collection, doc_id = name.split('/')[-2:]
+        self.put(collection, doc_id, stored)
+
+    def serve_commit(self, body):
+        if any(self.rejected(write) for write in body['writes']):
+            return Response(400, {"error": {"status": "FAILED_PRECONDITION"}})
+        for write in body['writes']:
+            self.apply(write)
+        return Response(200, {"writeResults": [{} for _ in body['writes']]})
+
+    def serve_batchWrite(self, body):
+        statuses = []
+        for write in body['writes']:
+            if self.rejected(write):
+                statuses.append({"code": FAILED_PRECONDITION, "message": "precondition failed"})
+                continue
+            self.apply(write)
+            statuses.append({})
+        return Response(200, {"writeResults": [{} for _ in statuses], "status": statuses})
+
+
+class BackendContract:
+    """Runs against the backend of make_backend(notas); the subclasses reach into their storage."""
+    def audit(self, backend, **kwargs):
+        return run_audit(backend, self.files, **kwargs)
+
+    def test_full_scan_rebuilds_the_index(self):
+        backend = self.make_backend(self.notas())
+        result = self.audit(backend)
+        self.assertEqual({k: result[k] for k in ("scan_mode", "index_status", "unitizer_index")},
+                         {"scan_mode": "full", "index_status": "incomplete", "unitizer_index": "rebuilt"})
+        self.assertEqual((result['found_count'], result['docs_updated'], result['docs_failed']), (3, 3, 0))
+        self.assertEqual(result['missing_codes'], ["NX000000002BR", "NX000000005BR"])
+        self.assertEqual(self.matched_codes(backend), {
+            "NN1": ["NX000000001BR"], "NN2": ["NX000000003BR"], "NN3": ["NX000000004BR"]})
+
+        # The next audit takes the pending codes from the index and reads only the notas it matches
+        self.add_nota(backend, "NN4", [item("NX000000002BR")]) # The sync indexes its items; this write does not
+        result = self.audit(backend)
+        self.assertEqual({k: result[k] for k in ("scan_mode", "index_status", "unitizer_index")},
+                         {"scan_mode": "index", "index_status": "current", "unitizer_index": "used"})
+        self.assertEqual((result['total_processed'], result['found_count'], result['docs_updated']), (2, 0, 0))
+
+    def test_stale_index_is_not_used(self):
+        backend = self.make_backend(self.notas())
+        self.audit(backend)
+        self.set_rebuilt_at(backend, datetime.utcnow() - timedelta(days=30))
+        result = self.audit(backend)
+        self.assertEqual((result['scan_mode'], result['index_status'], result['unitizer_index']), ("full", "stale", "rebuilt"))
+
+        result = self.audit(backend)
+        self.assertEqual((result['scan_mode'], result['index_status']), ("index", "current"))
+
+    def test_write_conflict_is_read_again(self):
+        backend = self.make_backend(self.notas())
+
+        def sync_appends_an_item(phase, **counters):
+            if phase == "writing" and counters.get('docs_written') == 0:
+                self.add_nota(backend, "NN1", [item("NX000000001BR"), item("NX000000002BR"), item("NX000000006BR")])
+
+        result = self.audit(backend, progress=sync_appends_an_item)
+        self.assertEqual((result['docs_updated'], result['docs_failed']), (3, 0))
+        self.assertEqual(self.matched_codes(backend)["NN1"], ["NX000000001BR"])
+        self.assertEqual(self.codes(backend)["NN1"], ["NX000000001BR", "NX000000002BR", "NX000000006BR"])
+
+
+class MemoryBackendTest(BackendContract, AuditEngineTestCase):
+    def make_backend(self, notas):
+        return MemoryBackend(notas, caches=[self.texts])
+
+    def add_nota(self, backend, doc_id, itens):
+        backend.notas.setdefault(doc_id, {"data_ocorrencia_iso": "2026-03-04T10:00"})['itens'] = itens
+
+    def set_rebuilt_at(self, backend, when):
+        backend.index_meta['rebuilt_at'] = when.isoformat() + "Z"
+
+    def codes(self, backend):
+        return {doc_id: [i['unitizador'] for i in nota['itens']] for doc_id, nota in backend.notas.items()}
+
+    def matched_codes(self, backend):
+        return {doc_id: [i['unitizador'] for i in nota['itens'] if i.get('correios_match')]
+                for doc_id, nota in backend.notas.items()}
+
+
+@mock.patch.object(audit_pdf, 'iter_json_array', iter_json_array, create=True)
+class FirestoreRestBackendTest(BackendContract, AuditEngineTestCase):
+    def make_backend(self, notas):
+        backend = audit_pdf.FirestoreRestBackend(MemoryRestClient(notas))
+        backend.text_caches = lambda: [self.texts]
+        return backend
+
+    def add_nota(self, backend, doc_id, itens):
+        name = backend.db.name(audit_pdf.COLLECTION_NAME, doc_id)
+        fields = backend.db.docs.get(name, {}).get('fields', encode_fields({"data_ocorrencia_iso": "2026-03-04T10:00"}))
+        backend.db.put(audit_pdf.COLLECTION_NAME, doc_id, {**fields, **encode_fields({"itens": itens})})
+
+    def set_rebuilt_at(self, backend, when):
+        meta = backend.db.docs[backend.db.name(INDEX_COLLECTION, INDEX_META_DOC)]['fields']
+        backend.db.put(INDEX_COLLECTION, INDEX_META_DOC, {**meta, **encode_fields({"rebuilt_at": when.isoformat() + "Z"})})
+
+    def notas_stored(self, backend):
+        return {name.split('/')[-1]: decode_fields(doc['fields'])['itens'] for name, doc in backend.db.docs.items()
+                if name.split('/')[-2] == audit_pdf.COLLECTION_NAME}
+
+    def codes(self, backend):
+        return {doc_id: [i['unitizador'] for i in itens] for doc_id, itens in self.notas_stored(backend).items()}
+
+    def matched_codes(self, backend):
+        return {doc_id: [i['unitizador'] for i in itens if i.get('correios_match')]
+                for doc_id, itens in self.notas_stored(backend).items()}
+
+    def test_same_result_as_memory(self):
+        memory = MemoryBackend(self.notas(), caches=[self.texts])
+        rest = self.make_backend(self.notas())
+        self.assertEqual(run_audit(memory, self.files), self.audit(rest))
+        self.assertEqual(MemoryBackendTest.matched_codes(self, memory), self.matched_codes(rest))
+
+
+# -------------------------------------------------------------------------
+# local_server.py
+# -------------------------------------------------------------------------
+class CloudSnapshot:
+    def __init__(self, doc_id, data, update_time):
+        self.id, self.exists, self.update_time = doc_id, data is not None, update_time
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class CloudClient:
+    """The google-cloud-firestore calls CloudFirestoreBackend makes for the notas (one collection)."""
+    def __init__(self, notas):
+        self.notas = {}
+        self.versions = {}
+        self.unavailable_once = set() # Nota ids whose first write attempt fails with UNAVAILABLE
+        self.attempts = {}
+        self.options = {} # { nota id: write option of its last write }
+        for doc_id, nota in notas.items():
+            self.put(doc_id, nota)
+
+    def put(self, doc_id, data):
+        self.notas[doc_id] = data
+        self.versions[doc_id] = datetime.utcnow().isoformat() + f"/{len(self.versions)}/{id(data)}"
+
+    def snapshot(self, doc_id):
+        return CloudSnapshot(doc_id, self.notas.get(doc_id), self.versions.get(doc_id))
+
+    def collection(self, name):
+        return SimpleNamespace(select=lambda fields: SimpleNamespace(stream=lambda: map(self.snapshot, list(self.notas))),
+                               document=lambda doc_id: SimpleNamespace(id=doc_id))
+
+    def get_all(self, refs, field_paths=None):
+        return [self.snapshot(ref.id) for ref in refs]
+
+    def write_option(self, last_update_time):
+        return ("last_update_time", last_update_time)
+
+    def bulk_writer(self):
+        return CloudBulkWriter(self)
+
+
+class CloudBulkWriter:
+    def __init__(self, db):
+        self.db = db
+        self.operations = []
+
+    def on_write_result(self, callback):
+        self.result_callback = callback
+
+    def on_write_error(self, callback):
+        self.error_callback = callback
+
+    def update(self, reference, data, option=None):
+        self.operations.append(SimpleNamespace(reference=reference, data=data, option=option))
+        self.db.options[reference.id] = option
+
+    def close(self):
+        for operation in self.operations:
+            doc_id = operation.reference.id
+            while True:
+                self.db.attempts[doc_id] = attempts = self.db.attempts.get(doc_id, 0) + 1
+                if operation.option and self.db.versions.get(doc_id) != operation.option[1]:
+                    code = FAILED_PRECONDITION
+                elif doc_id in self.db.unavailable_once and attempts == 1:
+                    code = UNAVAILABLE
+                else:
+                    self.db.put(doc_id, {**self.db.notas[doc_id], **operation.data})
+                    self.result_callback(operation.reference, None, self)
+                    break
+                failure = SimpleNamespace(operation=operation, code=code, message="falhou", attempts=attempts)
+                if not self.error_callback(failure, self): break
+
+
+@unittest.skipIf(local_server is None, "local_server dependencies (Flask, google-cloud-firestore) not installed")
+class CloudFirestoreBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.db = CloudClient({"NN1": {"itens": [item("NX000000001BR")]}, "NN2": {"itens": [item("NX000000002BR")]}})
+        self.backend = local_server.CloudFirestoreBackend(self.db)
+        self.read = {doc_id: items for doc_id, _, items in self.backend.iter_notas(None)}
+
+    def test_writes_on_condition_of_the_version_read(self):
+        read_versions = dict(self.db.versions)
+        self.db.put("NN1", {"itens": [item("NX000000001BR"), item("NX000000003BR")]}) # Changed by a sync
+        failed = self.backend.write_itens({"NN1": [item("NX000000001BR", conferido=True)],
+                                           "NN2": [item("NX000000002BR", conferido=True)]})
+        self.assertEqual(failed, {"NN1"})
+        self.assertEqual(self.db.options, {doc_id: ("last_update_time", version) for doc_id, version in read_versions.items()})
+        self.assertEqual(self.db.attempts["NN1"], 1) # A precondition failure is not retried
+        self.assertEqual(len(self.db.notas["NN1"]['itens']), 2)
+        self.assertTrue(self.db.notas["NN2"]['itens'][0]['conferido'])
+
+        # Read again, it is written on its new version
+        self.assertEqual(list(self.backend.get_notas(["NN1"])), ["NN1"])
+        self.assertEqual(self.backend.write_itens({"NN1": [item("NX000000001BR", conferido=True)]}), set())
+
+    def test_transient_errors_are_retried(self):
+        self.db.unavailable_once.add("NN2")
+        self.assertEqual(self.backend.write_itens(self.read), set())
+        self.assertEqual(self.db.attempts["NN2"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+run_audit (api/_audit_engine.py) over MemoryBackend. The extratos' text comes from a text
+cache, so no PDF is read.
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+from _audit_engine import run_audit, MemoryBackend, WRITE_CONFLICT_ATTEMPTS
+
+
+def item(code, **fields):
+    return {"unitizador": code, "lacre": "100001", "peso": 1.5, "conferido": False, **fields}
+
+
+def matched(code, extrato="Postal", price=2.89):
+    return item(code, correios_match=True, correios_ref_month="Março/2026", correios_type=extrato, correios_value=price)
+
+
+class ExtratoTexts:
+    """Text cache with the extratos' normalized text, by file content."""
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+        self.texts = {}
+
+    def extrato(self, extrato, text, price):
+        path = os.path.join(self.directory, f"{extrato}.pdf")
+        with open(path, 'wb') as f:
+            f.write(extrato.encode())
+        self.texts[hashlib.sha256(extrato.encode()).hexdigest()] = text
+        return {"type": extrato, "path": path, "month": "Março/2026", "price": price}
+
+    def get(self, key):
+        return self.texts.get(key.split('-')[0])
+
+    def put(self, key, text):
+        pass
+
+    def close(self):
+        shutil.rmtree(self.directory)
+
+
+class AuditEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.texts = ExtratoTexts()
+        self.addCleanup(self.texts.close)
+        self.files = [self.texts.extrato("Postal", "LINHA:NX000000001BR;NX000000003BR;", 2.89),
+                      self.texts.extrato("Densa", "LINHA:NX000000004BR;", 0.39)]
+
+    def notas(self):
+        return {
+            "NN1": {"data_ocorrencia_iso": "2026-03-01T10:00", "itens": [item("NX000000001BR"), item("NX000000002BR")]},
+            "NN2": {"data_ocorrencia_iso": "2026-03-02T10:00", "itens": [item("NX000000003BR")]},
+            "NN3": {"data_ocorrencia_iso": "2026-03-03T10:00", "itens": [item("NX000000004BR"), item("NX000000005BR")]},
+        }
+
+
+class WriteConflictTest(AuditEngineTestCase):
+    """A nota changed between the audit's read and its write is read again and the matches reapplied."""
+    def test_changed_nota_is_read_again(self):
+        backend = MemoryBackend(self.notas(), caches=[self.texts])
+
+        def sync_appends_an_item(phase, **counters):
+            if phase == "writing" and counters.get('docs_written') == 0:
+                nota = backend.notas["NN1"]
+                nota['itens'] = nota['itens'] + [item("NX000000006BR")]
+
+        result = run_audit(backend, self.files, progress=sync_appends_an_item)
+        self.assertEqual((result['docs_updated'], result['docs_failed']), (3, 0))
+        self.assertEqual(backend.notas["NN1"]['itens'],
+                         [matched("NX000000001BR"), item("NX000000002BR"), item("NX000000006BR")])
+        self.assertEqual(backend.notas["NN3"]['itens'], [matched("NX000000004BR", "Densa", 0.39), item("NX000000005BR")])
+        # The rebuilt index sees the appended item as pending
+        self.assertIn("NN1", backend.load_index()[1]["NX000000006BR"])
+
+    def test_nota_matched_or_deleted_meanwhile(self):
+        backend = MemoryBackend(self.notas(), caches=[self.texts])
+
+        def frontend_writes(phase, **counters):
+            if phase == "writing" and counters.get('docs_written') == 0:
+                backend.notas["NN2"]['itens'] = [matched("NX000000003BR")]
+                del backend.notas["NN3"]
+
+        result = run_audit(backend, self.files, progress=frontend_writes)
+        self.assertEqual((result['docs_updated'], result['docs_failed']), (1, 0)) # Nothing left to write in NN2
+        self.assertEqual(backend.notas["NN2"]['itens'], [matched("NX000000003BR")])
+
+    def test_nota_that_keeps_changing_fails(self):
+        class BusyBackend(MemoryBackend):
+            writes = 0
+
+            def write_itens(self, itens_by_nota, on_progress=None):
+                BusyBackend.writes += 1
+                self.notas["NN1"]['itens'] = list(self.notas["NN1"]['itens']) # Rewritten before every write
+                return super().write_itens(itens_by_nota, on_progress)
+
+        backend = BusyBackend(self.notas(), caches=[self.texts])
+        result = run_audit(backend, self.files)
+        self.assertEqual((result['docs_updated'], result['docs_failed']), (2, 1))
+        self.assertEqual(BusyBackend.writes, 1 + WRITE_CONFLICT_ATTEMPTS)
+        self.assertEqual(backend.notas["NN1"]['itens'], [item("NX000000001BR"), item("NX000000002BR")])
+        # Its code stays pending in the index
+        self.assertIn("NN1", backend.load_index()[1]["NX000000001BR"])
+
+
+if __name__ == '__main__':
+    unittest.main()
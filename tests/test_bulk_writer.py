@@ -0,0 +1,140 @@
+"""
+api/_bulk_writer.py against a scripted documents:batchWrite endpoint: batching, the per-write
+statuses, which failures are retried and what is reported after the last attempt.
+"""
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+import _bulk_writer
+from _bulk_writer import BulkWriter, BULK_WRITE_BATCH_SIZE, BULK_WRITE_MAX_ATTEMPTS
+
+BASE_URL = "https://firestore.googleapis.com/v1/projects/demo/databases/(default)/documents"
+ABORTED, FAILED_PRECONDITION = 10, 9
+
+
+def update(n, size=10):
+    return {"update": {"name": f"{BASE_URL}/tb/doc{n}", "fields": {"x": {"stringValue": "x" * size}}}}
+
+
+class Response:
+    def __init__(self, status_code, body=None, text=""):
+        self.status_code = status_code
+        self.body = body
+        self.text = text
+
+    def json(self):
+        return self.body
+
+
+class BatchWriteEndpoint:
+    """
+    request() for BulkWriter. outcome(doc name, attempt) -> google.rpc code (0: written) or, as a
+    tuple, an HTTP status / exception for the whole call, or "drop" (no status for that write).
+    """
+    def __init__(self, outcome=lambda name, attempt: 0):
+        self.outcome = outcome
+        self.calls = [] # writes of every call
+        self.attempts = {} # { doc name: calls that carried it }
+        self.written = []
+        self.lock = threading.Lock()
+
+    def __call__(self, method, url, json=None, **kwargs):
+        assert method == 'POST' and url == f"{BASE_URL}:batchWrite"
+        with self.lock:
+            self.calls.append(json['writes'])
+            outcomes = []
+            for write in json['writes']:
+                name = write['update']['name']
+                self.attempts[name] = self.attempts.get(name, 0) + 1
+                outcomes.append((name, self.outcome(name, self.attempts[name])))
+        for _, outcome in outcomes:
+            if isinstance(outcome, tuple):
+                if isinstance(outcome[0], Exception): raise outcome[0]
+                return Response(outcome[0], text="erro")
+        statuses = []
+        for name, code in outcomes:
+            if code == "drop": break # The response ends early: no status for this write and the next ones
+            statuses.append({"code": code, "message": "falhou"} if code else {})
+            if not code:
+                with self.lock: self.written.append(name)
+        return Response(200, {"writeResults": [{} for _ in statuses], "status": statuses})
+
+
+@mock.patch.object(_bulk_writer, 'RETRY_BACKOFF_SECONDS', 0)
+class BulkWriterTest(unittest.TestCase):
+    def write(self, endpoint, writes, **kwargs):
+        progress = []
+        failures = BulkWriter(endpoint, BASE_URL, ops_per_second=100000, **kwargs).write(writes, progress.append)
+        return {f['name'].split('/')[-1]: f['error'] for f in failures}, progress
+
+    def test_all_written_in_batches(self):
+        endpoint = BatchWriteEndpoint()
+        writes = [update(n) for n in range(BULK_WRITE_BATCH_SIZE * 2 + 5)]
+        failures, progress = self.write(endpoint, writes)
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(map(len, endpoint.calls)), [5, BULK_WRITE_BATCH_SIZE, BULK_WRITE_BATCH_SIZE])
+        self.assertEqual(sorted(endpoint.written), sorted(w['update']['name'] for w in writes))
+        self.assertEqual(progress[-1], len(writes))
+
+    def test_batches_bounded_by_bytes(self):
+        endpoint = BatchWriteEndpoint()
+        with mock.patch.object(_bulk_writer, 'BULK_WRITE_MAX_BYTES', 2500):
+            failures, _ = self.write(endpoint, [update(n, size=1000) for n in range(5)])
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(map(len, endpoint.calls)), [1, 2, 2])
+
+    def test_transient_codes_are_retried(self):
+        # doc3 is aborted twice, then written; the others go through at once
+        endpoint = BatchWriteEndpoint(lambda name, attempt: ABORTED if name.endswith("doc3") and attempt <= 2 else 0)
+        failures, progress = self.write(endpoint, [update(n) for n in range(10)], workers=1)
+        self.assertEqual(failures, {})
+        self.assertEqual(endpoint.attempts[f"{BASE_URL}/tb/doc3"], 3)
+        self.assertEqual([len(call) for call in endpoint.calls], [10, 1, 1]) # Only the failed write is sent again
+        self.assertEqual(progress, [9, 9, 10])
+
+    def test_permanent_codes_are_reported_once(self):
+        endpoint = BatchWriteEndpoint(lambda name, attempt: FAILED_PRECONDITION if name.endswith("doc1") else 0)
+        failures, _ = self.write(endpoint, [update(n) for n in range(3)])
+        self.assertEqual(list(failures), ["doc1"])
+        self.assertIn("Error 9", failures["doc1"])
+        self.assertEqual(endpoint.attempts[f"{BASE_URL}/tb/doc1"], 1)
+
+    def test_writes_without_status_are_retried(self):
+        # The first response stops after doc1: doc2 and doc3 were not confirmed
+        endpoint = BatchWriteEndpoint(lambda name, attempt: "drop" if name.endswith("doc2") and attempt == 1 else 0)
+        failures, _ = self.write(endpoint, [update(n) for n in range(4)], workers=1)
+        self.assertEqual(failures, {})
+        self.assertEqual(endpoint.calls[1], [update(2), update(3)])
+
+    def test_http_errors(self):
+        # 503 on the first call is retried for the whole batch; a 400 is not
+        endpoint = BatchWriteEndpoint(lambda name, attempt: (503,) if attempt == 1 else 0)
+        failures, _ = self.write(endpoint, [update(n) for n in range(3)])
+        self.assertEqual(failures, {})
+        self.assertEqual(len(endpoint.calls), 2)
+
+        endpoint = BatchWriteEndpoint(lambda name, attempt: (400,))
+        failures, _ = self.write(endpoint, [update(n) for n in range(3)])
+        self.assertEqual(set(failures), {"doc0", "doc1", "doc2"})
+        self.assertIn("Error 400", failures["doc0"])
+        self.assertEqual(len(endpoint.calls), 1)
+
+    def test_connection_errors_are_retried(self):
+        endpoint = BatchWriteEndpoint(lambda name, attempt: (ConnectionError("reset"),) if attempt == 1 else 0)
+        failures, _ = self.write(endpoint, [update(n) for n in range(3)])
+        self.assertEqual(failures, {})
+
+    def test_gives_up_after_the_last_attempt(self):
+        endpoint = BatchWriteEndpoint(lambda name, attempt: ABORTED if name.endswith("doc0") else 0)
+        failures, _ = self.write(endpoint, [update(n) for n in range(2)])
+        self.assertEqual(list(failures), ["doc0"])
+        self.assertEqual(endpoint.attempts[f"{BASE_URL}/tb/doc0"], BULK_WRITE_MAX_ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+"""
+Differential test of api/_email_table.py against BeautifulSoup(markup, 'html.parser').
+
+The corpus is generated like the TIM e-mails the sync reads (Outlook markup, nested
+layout tables, <br>-separated lists, entities, quoted-printable leftovers), plus the
+same e-mails with fragments of unusual markup spliced in at random positions.
+Every document _email_table accepts must give the rows and cells bs4 gives; the others
+must raise UnsupportedMarkup, so that parse_email_html falls back to bs4.
+"""
+import os
+import random
+import re
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+try:
+    from bs4 import BeautifulSoup
+    from _email_table import parse_tables, UnsupportedMarkup
+except ImportError: # bs4 not installed
+    BeautifulSoup = None
+
+try:
+    import sync_emails
+except ImportError: # Google client libraries not installed
+    sync_emails = None
+
+MAILBOXES = 10
+EMAILS_PER_MAILBOX = 60
+FUZZED_EMAILS = 1000
+
+CITIES = ["Belém", "CDD SANTARÉM", "AC ÓBIDOS", "Marabá", "Castanhal", "AC Conceição do Araguaia",
+          "Tucuruí", "Altamira", "São Félix", "Itaituba"]
+HEADERS = ["Nota de Despacho", "Origem", "Destino", "Data", "Qtde", "Peso Total", "Unitizador", "Lacre", "Peso"]
+# Spliced into the e-mails: entities, comments, Office conditionals, broken and unusual tags
+FRAGMENTS = [
+    "&nbsp;", "&amp;", "&#8211;", "&#150;", "&#x41;", "&ccedil;", "&copy", "&foo;", "AT&T", "a & b", "&#129;", "&#0;",
+    "<br>", "<br/>", "<br />", "</br>", "<BR>", "<br><br/>", "<!-- c -->", "<!---->", "<!-- a>b -->",
+    "<![if !supportLists]>", "<![endif]>", "<o:p></o:p>", "<o:p>&nbsp;</o:p>", "<span>", "</span>", "</b>", "<b>",
+    "<p class=MsoNormal>", "</p>", "<font size=3D\"2\">", "=\r\n", "\r\n", "<td>", "</td>", "<th>", "<tr>", "</tr>",
+    "<table>", "</table>", "NN12345678", "  ", "\xa0", "<div>", "</div>", "<img src=3D\"cid:x\">",
+    "<style>p{x:1}</style>", "<script>if(a<b)x()</script>", "1.234,56 Kg", "Kg", "?", "=", "<a href='x>y'>", "</a>",
+    "<?xml x?>", "<!x>", "<!DOCTYPE html>", "<td nowrap>", "<td\nclass=\"a\">", "<TD>", "</TD>", "< b", "<", ">",
+    "Unitizador", "lacre", "<u>", "<pre> </pre>", "<![CDATA[x]]>", "<td a==b>", "</ td>", "<title>T</title>",
+    "<textarea>x</textarea>", "<br/ >", "&#65a;", "<td a=\"1\"b=\"2\">", "<span/>", "<wbr>", "<br\xa0>", "<td\x0bx>",
+    "&#xZ;", "&#;", "<br><br>x</br>y", "<template>x</template>", "<!-- unterminated",
+]
+_TAG_RE = re.compile(r'<[^>]+>')
+
+
+# -------------------------------------------------------------------------
+# CORPUS
+# -------------------------------------------------------------------------
+def unit_code(rng):
+    style = rng.random()
+    if style < 0.5:
+        return "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(2)) + str(rng.randint(10**8, 10**9 - 1)) + "BR"
+    if style < 0.8:
+        return str(rng.randint(10**10, 10**11))
+    return "UN" + str(rng.randint(1000, 99999))
+
+
+def peso_text(value, rng):
+    text = f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return text + (" Kg" if rng.random() < 0.5 else "")
+
+
+def cell(rng, content, tag="td"):
+    attrs = rng.choice(['', ' style="font-family:Arial;font-size:10pt"', ' class="x_td" valign="top"', ' width=3D"120"'])
+    wrap = rng.random()
+    if wrap < 0.2:
+        content = f"<span style=\"color:#000\">{content}</span>"
+    elif wrap < 0.3:
+        content = f"<font face=\"Arial\"><b>{content}</b></font>"
+    elif wrap < 0.35:
+        content = f"<p class=MsoNormal>{content}<o:p></o:p></p>"
+    elif wrap < 0.4:
+        content = f"&nbsp;{content}&nbsp;"
+    elif wrap < 0.45:
+        content = f"\n   {content}\n  "
+    return f"<{tag}{attrs}>{content}</{tag}>"
+
+
+def list_cell(rng, values):
+    inner = rng.choice(["<br>", "<br/>", "<br />", "<BR>", "<br>\n", " <br> "]).join(values)
+    if rng.random() < 0.2:
+        inner = "".join(f"<div>{value}</div>" for value in values)
+    if rng.random() < 0.1:
+        inner += "<br>"
+    return cell(rng, inner)
+
+
+def nota_row(rng, nota, items, data):
+    units = [unit for unit, _, _ in items] + (["Unitizador"] if rng.random() < 0.05 else [])
+    cols = [
+        cell(rng, rng.choice([nota, f"Nota {nota}", f"<a href=\"x\">{nota}</a>"])),
+        cell(rng, rng.choice(CITIES)),
+        cell(rng, rng.choice(CITIES)),
+        cell(rng, data),
+        cell(rng, f"{len(items)}" + rng.choice(["", " un", " unid."])),
+        cell(rng, peso_text(sum(peso for _, _, peso in items), rng)),
+        list_cell(rng, units),
+        list_cell(rng, [lacre for _, lacre, _ in items]),
+        list_cell(rng, [peso_text(peso, rng) for _, _, peso in items]),
+    ]
+    if rng.random() < 0.05:
+        cols = cols[:7]
+    return "<tr>" + "".join(cols) + "</tr>\n"
+
+
+def email_html(rng, notas):
+    tag = rng.choice(["th", "td"])
+    rows = ["<tr>" + "".join(cell(rng, name, tag) for name in HEADERS) + "</tr>\n"]
+    rows += [nota_row(rng, *nota) for nota in notas]
+    if rng.random() < 0.2:
+        rows.insert(1, "<tr><td colspan=9>Resumo do dia &amp; informações</td></tr>")
+    table = "<table border=1 cellpadding=2>" + "".join(rows) + "</table>"
+    layout = rng.random()
+    if layout < 0.3:
+        table = f"<table width=\"100%\"><tr><td>{table}</td></tr></table>"
+    elif layout < 0.4:
+        table = "<table><tr><td>Prezados,</td></tr></table>" + table
+    return (
+        "<html><head><meta charset=\"utf-8\"><style>td {font-size: 10pt}</style></head><body>"
+        "<p>Segue rela&ccedil;&atilde;o de notas:</p><!-- gerado automaticamente -->"
+        + table
+        + "<p>Att,<br>TIM &ndash; Log&iacute;stica</p></body></html>"
+    )
+
+
+def nota_items(rng, count=None):
+    return [(unit_code(rng), str(rng.randint(100000, 999999)), round(rng.uniform(0.5, 80), 2))
+            for _ in range(count or rng.randint(1, 12))]
+
+
+def mailbox(seed):
+    """A month of e-mails: notas are repeated, partially resent, corrected and extended."""
+    rng = random.Random(seed)
+    notas = {}
+    emails = []
+    for i in range(EMAILS_PER_MAILBOX):
+        data = f"{1 + i // 4:02d}/03/2026 {rng.randint(6, 20):02d}:{rng.randint(0, 59):02d}"
+        chosen = []
+        for _ in range(rng.randint(1, 5)):
+            if notas and rng.random() < 0.5:
+                nota = rng.choice(list(notas))
+            else:
+                nota = f"NN{rng.randint(10**7, 10**8)}"
+                notas[nota] = nota_items(rng)
+            items = notas[nota]
+            change = rng.random()
+            if change < 0.3:
+                items = rng.sample(items, max(1, len(items) // 2))
+            elif change < 0.4:
+                items = [(unit, lacre, round(peso + 1, 2)) for unit, lacre, peso in items]
+            elif change < 0.5:
+                items = nota_items(rng, 2)
+                notas[nota] = notas[nota] + items
+            chosen.append((nota, items, data))
+        if rng.random() < 0.05:
+            emails.append("<html><body><p>Sem notas hoje.</p></body></html>")
+        else:
+            emails.append(email_html(rng, chosen))
+    return emails
+
+
+def fuzzed_email(rng):
+    notas = [(f"NN{rng.randint(10**7, 10**8)}", nota_items(rng), "01/03/2026 10:00") for _ in range(rng.randint(1, 3))]
+    html = email_html(rng, notas)
+    for _ in range(rng.randint(0, 12)):
+        position = rng.randint(0, len(html))
+        html = html[:position] + rng.choice(FRAGMENTS) + html[position:]
+    return html
+
+
+def realistic_corpus():
+    return [html for seed in range(1, MAILBOXES + 1) for html in mailbox(seed)]
+
+
+def fuzzed_corpus():
+    rng = random.Random(99)
+    return [fuzzed_email(rng) for _ in range(FUZZED_EMAILS)]
+
+
+# -------------------------------------------------------------------------
+# ROW SIGNATURE (what parse_email_html reads, in the order it reads it)
+# -------------------------------------------------------------------------
+class Bs4Cell:
+    def __init__(self, tag):
+        self.tag = tag
+
+    def __str__(self):
+        return str(self.tag)
+
+    def list_text(self):
+        for br in self.tag.find_all('br'): br.replace_with(' ||| ')
+        return self.tag.get_text(separator=' ', strip=True)
+
+
+def bs4_rows(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    return ([Bs4Cell(col) for col in row.find_all(['td', 'th'])] for table in soup.find_all('table') for row in table.find_all('tr'))
+
+
+def rendered(cell):
+    # str() as limpar_html reads it: _email_table renders tags without attributes and void elements as <br></br>
+    return ' '.join(_TAG_RE.sub(' ', str(cell)).split())
+
+
+def signature(rows):
+    # Cells rendered, then the lists read with their <br> replaced (seen by the cells read afterwards)
+    signature = []
+    for cols in rows:
+        before = [rendered(col) for col in cols]
+        lists = [col.list_text() for col in cols[6:]] if len(cols) >= 7 else []
+        signature.append((before, lists, [rendered(col) for col in cols]))
+    return signature
+
+
+OUTLOOK_EMAIL = (
+    "<html xmlns:v=\"urn:schemas-microsoft-com:vml\" xmlns:o=\"urn:schemas-microsoft-com:office:office\">"
+    "<head><meta http-equiv=Content-Type content=\"text/html; charset=iso-8859-1\">"
+    "<!--[if !mso]><style>v\\:* {behavior:url(#default#VML);}</style><![endif]-->"
+    "<style><!--\n/* Font Definitions */\np.MsoNormal {margin:0cm; font-size:11.0pt;}\n--></style>"
+    "<!--[if gte mso 9]><xml><o:shapedefaults v:ext=\"edit\" spidmax=\"1026\" /></xml><![endif]--></head>"
+    "<body lang=PT-BR link=\"#0563C1\" vlink=\"#954F72\"><div class=WordSection1>"
+    "<p class=MsoNormal>Prezados,<o:p></o:p></p><p class=MsoNormal><o:p>&nbsp;</o:p></p>"
+    "<table class=MsoNormalTable border=0 cellspacing=0 cellpadding=0 width=900 style='width:675.0pt;border-collapse:collapse'>"
+    "<tr style='height:15.0pt'>"
+    + "".join(f"<td nowrap style='border:solid windowtext 1.0pt;padding:0cm 3.5pt'><p class=MsoNormal><b>{name}<o:p></o:p></b></p></td>"
+              for name in HEADERS)
+    + "</tr>\n<tr>"
+    "<td nowrap valign=top><p class=MsoNormal>NN12345678<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>CDD SANTAR&Eacute;M<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>AC &Oacute;BIDOS<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>01/03/2026 10:00<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>2<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>1.500,50 Kg<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>NX123456789BR<br>UN12345<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal><![if !supportLists]>100001<![endif]><br>100002<o:p></o:p></p></td>"
+    "<td valign=top><p class=MsoNormal>750,25<br>750,25&nbsp;Kg<o:p></o:p></p></td>"
+    "</tr></table><p class=MsoNormal>Att,<o:p></o:p></p></div></body></html>"
+)
+
+
+@unittest.skipIf(BeautifulSoup is None, "bs4 not installed")
+class EmailTableTest(unittest.TestCase):
+    def assertSameRows(self, html):
+        self.assertEqual(signature(parse_tables(html).table_rows()), signature(bs4_rows(html)), repr(html[:2000]))
+
+    def test_realistic_emails_match_bs4(self):
+        for html in realistic_corpus():
+            self.assertSameRows(html) # No fallback either: the TIM markup is all in the modelled subset
+
+    def test_outlook_email_matches_bs4(self):
+        self.assertSameRows(OUTLOOK_EMAIL)
+        rows = list(parse_tables(OUTLOOK_EMAIL).table_rows())
+        self.assertEqual(rows[1][7].list_text(), "100001 ||| 100002")
+
+    def test_fuzzed_emails_match_bs4_or_fall_back(self):
+        supported = 0
+        for html in fuzzed_corpus():
+            try:
+                parse_tables(html)
+            except UnsupportedMarkup:
+                continue
+            supported += 1
+            self.assertSameRows(html)
+        self.assertGreater(supported, FUZZED_EMAILS // 5) # Most fragments send the e-mail to bs4
+
+    def test_quirks(self):
+        for html in [
+            "<table><tr><td>a<br><br/>b</br>c</td><td>1</td><td>2</td><td>3</td><td>4</td><td>5</td><td>x<br>y</td></tr></table>",
+            "<table><tr><td>1<td>2</tr></table>", # No implicit closing
+            "<table><tr><td>AT&T &copy &#150; &#x41; &foo;</td></tr></table>",
+            "<table><tr><td><![if !supportLists]>x<![endif]></td></tr></table>",
+            "<table><tr><td>\n   \n</td><td> </td></tr></table>",
+            "<div><table><tr><td>a</div>b</td></tr></table>", # </div> closes the cell, row and table
+            "<table><tr><td><table><tr><td>inner</td></tr></table></td></tr></table>", # Inner rows read twice
+            "<table><tr>" + "<td>a<br>b</td>" * 9 + "</tr><tr>" + "<td>c</td>" * 9 + "</tr></table>",
+        ]:
+            self.assertSameRows(html)
+
+    def test_unsupported_markup(self):
+        for html in ["<template>x</template>", "<!-- unterminated", "<td>&#", "<![CDATA[x]]>",
+                     "<script>a</b></script>", "<td\x0bx>", "<?xml x?>", "<!x>",
+                     "<td>a<br><br/><table><tr><td>b</td></tr></table></br></td>"]: # Cells inside an open <br>
+            with self.assertRaises(UnsupportedMarkup, msg=repr(html)):
+                parse_tables(html)
+
+
+@unittest.skipIf(BeautifulSoup is None or sync_emails is None, "bs4 / Google client libraries not installed")
+class ParseEmailHtmlTest(unittest.TestCase):
+    def test_same_notas_as_bs4(self):
+        for html in realistic_corpus() + fuzzed_corpus():
+            fast = sync_emails.parse_email_html(html)
+            with mock.patch.object(sync_emails, 'parse_tables', side_effect=UnsupportedMarkup):
+                self.assertEqual(fast, sync_emails.parse_email_html(html))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+Round trips of api/_firestore_codec.py: python value -> typed JSON -> (json.dumps / loads, as sent to
+and read from the REST API) -> python value, and back. Micro-benchmark: tests/bench_firestore_codec.py.
+"""
+import json
+import math
+import os
+import random
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+from _firestore_codec import (encode_value, encode_fields, decode_value, decode_fields, decode_records,
+                              as_str, as_int, as_float, as_bool, as_list)
+
+RANDOM_DOCUMENTS = 5000
+ITEM_SCHEMA = {"unitizador": "", "lacre": "", "peso": 0.0, "conferido": False}
+
+
+def over_the_wire(value):
+    return json.loads(json.dumps(value))
+
+
+def same(a, b):
+    """Equality that also checks types (True is not 1, 1 is not 1.0) and lets NaN equal NaN."""
+    if type(a) is not type(b): return False
+    if isinstance(a, float) and math.isnan(a): return math.isnan(b)
+    if isinstance(a, list): return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict): return a.keys() == b.keys() and all(same(a[key], b[key]) for key in a)
+    return a == b
+
+
+def random_scalar(rng):
+    kind = rng.randrange(8)
+    if kind == 0: return None
+    if kind == 1: return rng.random() < 0.5
+    if kind == 2: return rng.randint(-2**63, 2**63 - 1)
+    if kind == 3: return rng.choice([rng.uniform(-1e9, 1e9), 0.0, -0.0, 1e-300, float('inf'), float('-inf'), float('nan')])
+    if kind == 4: return ''.join(rng.choice('abcÇã 🚚`.\\"') for _ in range(rng.randrange(12)))
+    if kind == 5: return bytes(rng.randrange(256) for _ in range(rng.randrange(20)))
+    if kind == 6: return datetime(2000, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=rng.randrange(10**15))
+    return "SERVER_TIMESTAMP"
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(10)
+    if depth < 3 and kind == 0: return [random_value(rng, depth + 1) for _ in range(rng.randrange(5))]
+    if depth < 3 and kind == 1: return {f"k{i}": random_value(rng, depth + 1) for i in range(rng.randrange(5))}
+    return random_scalar(rng)
+
+
+class RoundTripTest(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        encoded = encode_value(value)
+        decoded = decode_value(over_the_wire(encoded))
+        self.assertTrue(same(decoded, value), f"{value!r} -> {encoded!r} -> {decoded!r}")
+        self.assertEqual(encode_value(decoded), encoded)
+
+    def test_null(self):
+        self.assertEqual(encode_value(None), {"nullValue": None})
+        self.assertRoundTrip(None)
+
+    def test_int_and_double(self):
+        self.assertEqual(encode_value(3), {"integerValue": "3"})
+        self.assertEqual(encode_value(3.0), {"doubleValue": 3.0})
+        for value in [0, -1, 2**63 - 1, -2**63, 0.0, -0.0, 1.5, 1e-300, 1e300, float('inf'), float('-inf'), float('nan')]:
+            self.assertRoundTrip(value)
+
+    def test_bool_is_not_int(self):
+        self.assertEqual(encode_value(True), {"booleanValue": True})
+        self.assertRoundTrip(False)
+
+    def test_strings(self):
+        for value in ["", "NN12345678", "Conceição 🚚", "SERVER_TIMESTAMP", "a`b.c\\d"]:
+            self.assertRoundTrip(value)
+        self.assertEqual(encode_value("SERVER_TIMESTAMP"), {"stringValue": "SERVER_TIMESTAMP"})
+
+    def test_bytes(self):
+        for value in [b"", b"\x00\xff", bytes(range(256))]:
+            self.assertRoundTrip(value)
+
+    def test_timestamps(self):
+        self.assertRoundTrip(datetime(2026, 3, 1, 10, 0, 0, 123456, tzinfo=timezone.utc))
+        self.assertRoundTrip(datetime(1970, 1, 1, tzinfo=timezone.utc))
+        # Naive datetimes are UTC; other offsets come back in UTC
+        self.assertEqual(decode_value(encode_value(datetime(2026, 3, 1, 10))), datetime(2026, 3, 1, 10, tzinfo=timezone.utc))
+        brt = timezone(timedelta(hours=-3))
+        self.assertEqual(decode_value(encode_value(datetime(2026, 3, 1, 7, tzinfo=brt))),
+                         datetime(2026, 3, 1, 10, tzinfo=timezone.utc))
+        # As written by Firestore: nanoseconds, no fraction, an offset
+        self.assertEqual(decode_value({"timestampValue": "2026-03-01T10:00:00.123456789Z"}),
+                         datetime(2026, 3, 1, 10, 0, 0, 123456, tzinfo=timezone.utc))
+        self.assertEqual(decode_value({"timestampValue": "2026-03-01T10:00:00Z"}),
+                         datetime(2026, 3, 1, 10, tzinfo=timezone.utc))
+        self.assertEqual(decode_value({"timestampValue": "2026-03-01T10:00:00.5-03:00"}),
+                         datetime(2026, 3, 1, 13, 0, 0, 500000, tzinfo=timezone.utc))
+
+    def test_arrays(self):
+        for value in [[], [1, "a", None, 2.5, True], [[1, [2]], {"a": [3]}], [b"x", datetime(2026, 1, 1, tzinfo=timezone.utc)]]:
+            self.assertRoundTrip(value)
+        self.assertEqual(decode_value(encode_value((1, 2))), [1, 2])
+        self.assertEqual(decode_value({"arrayValue": {}}), [])
+
+    def test_maps(self):
+        for value in [{}, {"a": {"b": {"c": [1, {"d": None}]}}}, {"itens": [{"unitizador": "X", "peso": 1.5}]}]:
+            self.assertRoundTrip(value)
+        self.assertEqual(decode_value({"mapValue": {}}), {})
+
+    def test_other_kinds(self):
+        self.assertEqual(decode_value({"referenceValue": "projects/p/databases/(default)/documents/a/b"}),
+                         "projects/p/databases/(default)/documents/a/b")
+        self.assertEqual(decode_value({"geoPointValue": {"latitude": -1.45}}), {"latitude": -1.45, "longitude": 0.0})
+        self.assertIsNone(decode_value({}))
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            encode_value(object())
+
+    def test_random_documents(self):
+        rng = random.Random(7)
+        for _ in range(RANDOM_DOCUMENTS):
+            document = {f"f{i}": random_value(rng) for i in range(rng.randrange(1, 4))}
+            fields = encode_fields(document)
+            decoded = decode_fields(over_the_wire(fields))
+            self.assertTrue(same(decoded, document), repr(document))
+            self.assertEqual(encode_fields(decoded), fields)
+
+
+class TypedAccessTest(unittest.TestCase):
+    def test_getters(self):
+        self.assertEqual(as_str(None, 'x'), 'x')
+        self.assertEqual(as_int(3.0), 3)
+        self.assertEqual(as_int(True, 9), 9)
+        self.assertEqual(as_int(float('nan'), 9), 9)
+        self.assertEqual(as_float(2), 2.0)
+        self.assertEqual(as_float("2", 0.5), 0.5)
+        self.assertEqual(as_bool(1), False)
+        self.assertEqual(as_list("x"), [])
+
+    def test_records(self):
+        items = [
+            {"unitizador": "NX1BR", "lacre": "L1", "peso": 10.5, "conferido": True},
+            {"unitizador": "NX2BR", "peso": 3}, # Missing fields, an integer peso
+            {"unitizador": 7, "lacre": None, "peso": "x", "conferido": "sim"}, # Mistyped fields
+        ]
+        value = over_the_wire(encode_value(items + ["not a map"]))
+        self.assertEqual(decode_records(value, ITEM_SCHEMA), [
+            {"unitizador": "NX1BR", "lacre": "L1", "peso": 10.5, "conferido": True},
+            {"unitizador": "NX2BR", "lacre": "", "peso": 3.0, "conferido": False},
+            {"unitizador": "", "lacre": "", "peso": 0.0, "conferido": False},
+            {"unitizador": "", "lacre": "", "peso": 0.0, "conferido": False},
+        ])
+        self.assertEqual(decode_records({}, ITEM_SCHEMA), [])
+
+    def test_records_match_decode_value(self):
+        rng = random.Random(3)
+        items = [{"unitizador": f"NX{i:09d}BR", "lacre": str(rng.randint(100000, 999999)),
+                  "peso": round(rng.uniform(0.5, 80), 2), "conferido": rng.random() < 0.5} for i in range(300)]
+        value = over_the_wire(encode_value(items))
+        self.assertEqual(decode_records(value, ITEM_SCHEMA), decode_value(value))
+
+
+if __name__ == '__main__':
+    unittest.main()
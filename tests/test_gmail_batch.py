@@ -0,0 +1,144 @@
+"""
+fetch_messages_batch (api/sync_emails.py) against canned multipart responses of the Gmail batch
+endpoint: rate limited parts (429, 403 rateLimitExceeded) are sent again after the backoff, the
+other errors are returned as they are, and nothing is left without a result.
+"""
+import json
+import os
+import re
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+try:
+    import httplib2
+    import sync_emails
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
+except ImportError: # Google client libraries not installed
+    sync_emails = None
+
+BOUNDARY = "batch_canned"
+REASONS = {429: "rateLimitExceeded", 403: "rateLimitExceeded", 500: "backendError", 404: "notFound", 400: "badRequest"}
+
+
+def part(content_id, status, body):
+    return (f"--{BOUNDARY}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+            f"HTTP/1.1 {status} Canned\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+            f"{json.dumps(body)}\r\n")
+
+
+def error_body(status, reason=None):
+    reason = reason or REASONS[status]
+    return {"error": {"code": status, "message": reason, "errors": [{"reason": reason, "domain": "usageLimits"}]}}
+
+
+class GmailBatchEndpoint:
+    """
+    httplib2.Http for https://gmail.googleapis.com/batch. outcome(msg id, round) -> HTTP status of
+    that call or (status, reason); whole(round) -> status of the whole round-trip (200 by default).
+    """
+    def __init__(self, outcome=lambda msg_id, attempt: 200, whole=lambda attempt: 200):
+        self.outcome = outcome
+        self.whole = whole
+        self.calls = [] # msg ids of every batch request
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        assert (method, uri) == ("POST", "https://gmail.googleapis.com/batch")
+        ids = re.findall(r'GET /gmail/v1/users/me/messages/([^?\s]+)', body)
+        content_ids = re.findall(r'Content-ID: <([^>]+)>', body)
+        self.calls.append(ids)
+        attempt = len(self.calls)
+
+        status = self.whole(attempt)
+        if status != 200:
+            return httplib2.Response({"status": status, "retry-after": "3"}), json.dumps(error_body(status)).encode()
+
+        parts = []
+        for msg_id, content_id in zip(ids, content_ids):
+            outcome = self.outcome(msg_id, attempt)
+            status, reason = outcome if isinstance(outcome, tuple) else (outcome, None)
+            parts.append(part(content_id, status, {"id": msg_id} if status == 200 else error_body(status, reason)))
+        content = "".join(parts) + f"--{BOUNDARY}--\r\n"
+        return httplib2.Response({"status": 200, "content-type": f"multipart/mixed; boundary={BOUNDARY}"}), content.encode()
+
+
+@unittest.skipIf(sync_emails is None, "Google client libraries not installed")
+class FetchMessagesBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.service = build('gmail', 'v1', http=httplib2.Http(), static_discovery=True)
+        self.sleeps = []
+        sleep = mock.patch.object(sync_emails.time, 'sleep', self.sleeps.append)
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def fetch(self, endpoint, ids, backoff=None):
+        results = sync_emails.fetch_messages_batch(self.service, ids, http=endpoint, backoff=backoff)
+        self.assertEqual(set(results), set(ids)) # Every id gets a result
+        return results
+
+    def test_rate_limited_parts_are_sent_again(self):
+        # m1 and m3 are rate limited in the first round-trip, m3 once more with a 403
+        def outcome(msg_id, attempt):
+            if attempt == 1 and msg_id in ("m1", "m3"): return 429
+            if attempt == 2 and msg_id == "m3": return (403, "userRateLimitExceeded")
+            return 200
+        endpoint = GmailBatchEndpoint(outcome)
+        results = self.fetch(endpoint, ["m0", "m1", "m2", "m3"])
+        self.assertEqual(results, {m: {"id": m} for m in ["m0", "m1", "m2", "m3"]})
+        self.assertEqual(endpoint.calls, [["m0", "m1", "m2", "m3"], ["m1", "m3"], ["m3"]])
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_other_errors_are_not_retried(self):
+        # A 403 that is not a rate limit and a 404 are answers, not retried; a 500 is retried
+        endpoint = GmailBatchEndpoint(lambda msg_id, attempt: {"m0": (403, "insufficientPermissions"), "m1": 404,
+                                                               "m2": 500 if attempt == 1 else 200}.get(msg_id, 200))
+        results = self.fetch(endpoint, ["m0", "m1", "m2"])
+        self.assertEqual([sync_emails.gmail_error_status(results[m]) for m in ["m0", "m1"]], [403, 404])
+        self.assertEqual(results["m2"], {"id": "m2"})
+        self.assertEqual(endpoint.calls[1:], [["m2"]])
+
+    def test_rate_limited_round_trip_is_sent_again(self):
+        endpoint = GmailBatchEndpoint(whole=lambda attempt: 429 if attempt == 1 else 200)
+        results = self.fetch(endpoint, ["m0", "m1"])
+        self.assertEqual(results, {"m0": {"id": "m0"}, "m1": {"id": "m1"}})
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertAlmostEqual(self.sleeps[0], 3.0, places=1) # Retry-After of the refused round-trip
+
+        endpoint = GmailBatchEndpoint(whole=lambda attempt: 400)
+        with self.assertRaises(HttpError):
+            self.fetch(endpoint, ["m0"])
+
+    def test_still_rate_limited_after_the_last_round(self):
+        endpoint = GmailBatchEndpoint(lambda msg_id, attempt: 429 if msg_id == "m1" else 200)
+        results = self.fetch(endpoint, ["m0", "m1"])
+        self.assertEqual(results["m0"], {"id": "m0"})
+        self.assertEqual(sync_emails.gmail_error_status(results["m1"]), 429) # Raised by parse_message: backlog
+        self.assertEqual(len(endpoint.calls), sync_emails.GMAIL_BATCH_RETRIES)
+
+    def test_no_wait_past_the_deadline(self):
+        endpoint = GmailBatchEndpoint(lambda msg_id, attempt: 429)
+        backoff = sync_emails.GmailBackoff(deadline=sync_emails.time.time())
+        with mock.patch.object(sync_emails.random, 'uniform', lambda low, high: high):
+            results = self.fetch(endpoint, ["m0"], backoff)
+        self.assertEqual(sync_emails.gmail_error_status(results["m0"]), 429)
+        self.assertEqual((len(endpoint.calls), self.sleeps), (1, []))
+
+    def test_backoff_is_shared_and_jittered(self):
+        backoff = sync_emails.GmailBackoff()
+        with mock.patch.object(sync_emails.random, 'uniform', lambda low, high: high):
+            backoff.pause(10)
+        delay = backoff.resume_at - sync_emails.time.time()
+        self.assertTrue(sync_emails.GMAIL_BACKOFF_MAX_SECONDS - 1 < delay <= sync_emails.GMAIL_BACKOFF_MAX_SECONDS)
+
+        # Another worker's next round-trip waits for the same resume time
+        endpoint = GmailBatchEndpoint()
+        self.fetch(endpoint, ["m0"], backoff)
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertGreater(self.sleeps[0], sync_emails.GMAIL_BACKOFF_MAX_SECONDS - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+"""
+The writes a sync buffers for its notas: persist_email folds the e-mails into a NotaFold, and
+queue_writes buffers them on a FirestoreClient whose commits are kept in memory.
+Scenario: a stored nota (one unitizer already matched by the audit) gets two Recebimento
+e-mails and a Devolução in the same run, and the first e-mail also brings a new nota.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+try:
+    import sync_emails
+    from _firestore_codec import encode_fields, decode_value
+    from _unitizer_index import INDEX_COLLECTION, shard_id, entry_field_path
+except ImportError: # Google client libraries not installed
+    sync_emails = None
+
+STORED_ID = "NN10000001"
+NEW_ID = "NN20000002"
+UPDATE_TIME = "2026-03-02T12:00:00.000000Z"
+DATE = "01/03/2026 10:00"
+DATE_ISO = "2026-03-01T10:00"
+
+
+def item(code, lacre="100001", peso=1.5):
+    return {"unitizador": code, "lacre": lacre, "peso": peso, "conferido": False}
+
+
+def stored_document():
+    """The stored nota as batchGet returns it: AA1 matched by an audit, AA2 still pending."""
+    matched = {**item("AA1"), "correios_match": True, "correios_ref_month": "Março/2026",
+               "correios_type": "Postal", "correios_value": 2.89}
+    fields = encode_fields({
+        "nota_despacho": STORED_ID, "status": "RECEBIDO", "data_ocorrencia": DATE, "data_ocorrencia_iso": DATE_ISO,
+        "origem": "CDD SANTARÉM", "destino": "AC ÓBIDOS", "msgs_entrada": 1, "msgs_saida": 0,
+        "itens": [matched, {**item("AA2"), "correios_match": False}],
+    })
+    return {"name": f"{MemoryFirestoreClient.documents_path}/{sync_emails.COLLECTION_NAME}/{STORED_ID}",
+            "fields": fields, "updateTime": UPDATE_TIME}
+
+
+def email(msg_id, subject, notas):
+    return {"id": msg_id, "subject": subject, "date_header": "Mon, 2 Mar 2026 10:00:00 -0300", "notas": [
+        {"nota": nota_id, "data_ocorrencia": data, "origem": "CDD SANTARÉM", "destino": "AC ÓBIDOS",
+         "qtde_unitizadores": len(itens), "peso_total_declarado": sum(i['peso'] for i in itens),
+         "peso_total_calculado": sum(i['peso'] for i in itens), "itens": itens}
+        for nota_id, data, itens in notas
+    ]}
+
+
+RECEBIMENTO_1 = email("m1", "Recebimento de Carga 1", [(STORED_ID, DATE, [item("AA2"), item("BB1")]),
+                                                        (NEW_ID, DATE, [item("CC1"), item("CC2")])])
+RECEBIMENTO_2 = email("m2", "Recebimento de Carga 2", [(STORED_ID, DATE, [item("BB2")])])
+DEVOLUCAO = email("m3", "Devolução de Carga", [(STORED_ID, DATE, [item("AA1"), item("AA2")])])
+
+
+class MemoryFirestoreClient(sync_emails.FirestoreClient if sync_emails else object):
+    """FirestoreClient without credentials: commits are kept in memory; names in `rejected` fail."""
+    documents_path = "projects/demo/databases/(default)/documents"
+
+    def __init__(self):
+        self.base_url = f"https://firestore.googleapis.com/v1/{self.documents_path}"
+        self.pending_writes = {}
+        self.pending_tags = {}
+        self.commits = []
+        self.rejected = set()
+
+    def _request(self, method, url, json=None, **kwargs):
+        self.commits.append(json['writes'])
+        failed = any(write['update']['name'] in self.rejected for write in json['writes'])
+        return mock.Mock(status_code=400 if failed else 200, text="FAILED_PRECONDITION" if failed else "")
+
+    def write(self, collection, doc_id):
+        return self.pending_writes[f"{self.documents_path}/{collection}/{doc_id}"]
+
+    def tags(self, collection, doc_id):
+        return self.pending_tags.get(f"{self.documents_path}/{collection}/{doc_id}", set())
+
+
+@unittest.skipIf(sync_emails is None, "Google client libraries not installed")
+class NotaFoldWritesTest(unittest.TestCase):
+    def fold(self, *emails):
+        fold = sync_emails.NotaFold()
+        fold.add_document(STORED_ID, stored_document())
+        fold.add_document(NEW_ID, None)
+        for parsed_email in emails:
+            sync_emails.persist_email(fold, parsed_email, [])
+        db = MemoryFirestoreClient()
+        self.assertEqual(fold.queue_writes(db), len({nota['nota'] for e in emails for nota in e['notas']}))
+        return db
+
+    def appended(self, write, field):
+        transform = next(t for t in write.get('updateTransforms', []) if t['fieldPath'] == field)
+        return decode_value({"arrayValue": transform['appendMissingElements']})
+
+    def assertIndexed(self, db, nota_id, entries, tags):
+        """entries: { code: item index }; every shard write holding them is tagged with (at least) tags."""
+        for code, item_index in entries.items():
+            write = db.write(INDEX_COLLECTION, shard_id(code))
+            self.assertIn(entry_field_path(code, nota_id), write['updateMask']['fieldPaths'])
+            entry = write['update']['fields']['codes']['mapValue']['fields'][code]['mapValue']['fields'][nota_id]
+            self.assertEqual(decode_value(entry), {"item_index": item_index, "data_ocorrencia_iso": DATE_ISO})
+            self.assertLessEqual(set(tags), db.tags(INDEX_COLLECTION, shard_id(code)))
+
+    def indexed_codes(self, db, nota_id):
+        return {path.split('.')[1].strip('`')
+                for name, write in db.pending_writes.items() if f"/{INDEX_COLLECTION}/" in name
+                for path in write['updateMask']['fieldPaths'] if path.endswith(f".`{nota_id}`")}
+
+    def test_delta_writes(self):
+        db = self.fold(RECEBIMENTO_1, RECEBIMENTO_2, DEVOLUCAO)
+        write = db.write(sync_emails.COLLECTION_NAME, STORED_ID)
+
+        # One field merge for the three e-mails, conditional on the version read
+        self.assertEqual(write['currentDocument'], {"updateTime": UPDATE_TIME})
+        self.assertEqual(set(write['updateMask']['fieldPaths']), {
+            "nota_despacho", "data_email", "data_ocorrencia", "data_ocorrencia_iso", "origem", "destino",
+            "qtde_unitizadores", "peso_total_declarado", "peso_total_calculado", "last_updated", "msgs_entrada",
+            "status", "data_entrega", "divergencia", "msgs_saida",
+        })
+        fields = write['update']['fields']
+        self.assertEqual(decode_value(fields['msgs_entrada']), 3)
+        self.assertEqual(decode_value(fields['msgs_saida']), 1)
+        self.assertEqual(decode_value(fields['qtde_unitizadores']), 2) # The Devolução's count comes last
+
+        # The stored items (and AA1's correios_* fields) are not rewritten: only the new ones travel
+        self.assertNotIn('itens', fields)
+        self.assertEqual(self.appended(write, 'itens'), [item("BB1"), item("BB2")])
+        self.assertEqual(self.appended(write, 'itens_conferencia'), [item("AA1"), item("AA2")])
+        self.assertEqual(db.tags(sync_emails.COLLECTION_NAME, STORED_ID), {"m1", "m2", "m3"})
+
+        # New nota: a create that must not overwrite a nota created meanwhile
+        create = db.write(sync_emails.COLLECTION_NAME, NEW_ID)
+        self.assertEqual(create['currentDocument'], {"exists": False})
+        self.assertNotIn('updateMask', create)
+        self.assertEqual(decode_value(create['update']['fields']['itens']), [item("CC1"), item("CC2")])
+        self.assertEqual(db.tags(sync_emails.COLLECTION_NAME, NEW_ID), {"m1"})
+
+        # Index: the appended unitizers after the stored ones, tagged with the Recebimentos only
+        self.assertEqual(self.indexed_codes(db, STORED_ID), {"BB1", "BB2"})
+        self.assertIndexed(db, STORED_ID, {"BB1": 2, "BB2": 3}, {"m1", "m2"})
+        self.assertEqual(self.indexed_codes(db, NEW_ID), {"CC1", "CC2"})
+        self.assertIndexed(db, NEW_ID, {"CC1": 0, "CC2": 1}, {"m1"})
+        for name, tags in db.pending_tags.items():
+            if f"/{INDEX_COLLECTION}/" in name: self.assertNotIn("m3", tags)
+
+    def test_new_date_reindexes_the_pending_stored_items(self):
+        moved = email("m4", "Recebimento de Carga 4", [(STORED_ID, "05/03/2026 08:00", [item("BB1")])])
+        db = self.fold(moved)
+        write = db.write(sync_emails.COLLECTION_NAME, STORED_ID)
+        self.assertEqual(self.appended(write, 'itens'), [item("BB1")])
+        # AA1 is matched: its entry was removed by the audit and stays out
+        self.assertEqual(self.indexed_codes(db, STORED_ID), {"AA2", "BB1"})
+        for code, item_index in {"AA2": 1, "BB1": 2}.items():
+            entry = db.write(INDEX_COLLECTION, shard_id(code))['update']['fields']['codes']['mapValue']['fields'][code]
+            self.assertEqual(decode_value(entry)[STORED_ID], {"item_index": item_index, "data_ocorrencia_iso": "2026-03-05T08:00"})
+
+    def test_full_writes(self):
+        with mock.patch.object(sync_emails, 'SYNC_ITEM_WRITES', 'full'):
+            db = self.fold(RECEBIMENTO_1, RECEBIMENTO_2, DEVOLUCAO)
+        write = db.write(sync_emails.COLLECTION_NAME, STORED_ID)
+        self.assertIn("itens", write['updateMask']['fieldPaths'])
+        self.assertIn("itens_conferencia", write['updateMask']['fieldPaths'])
+        self.assertNotIn('updateTransforms', write)
+        self.assertEqual(decode_value(write['update']['fields']['itens']),
+                         [item("AA1"), item("AA2"), item("BB1"), item("BB2")])
+        # The rewrite drops AA1's correios_* fields: every item is pending again
+        self.assertIndexed(db, STORED_ID, {"AA1": 0, "AA2": 1, "BB1": 2, "BB2": 3}, {"m1", "m2"})
+
+    def test_failed_write_reports_its_emails(self):
+        db = self.fold(RECEBIMENTO_1, RECEBIMENTO_2, DEVOLUCAO)
+        stored_name = f"{db.documents_path}/{sync_emails.COLLECTION_NAME}/{STORED_ID}"
+        db.rejected.add(stored_name)
+        failures = db.flush_writes()
+        self.assertEqual([(f['name'], f['tags']) for f in failures], [(stored_name, {"m1", "m2", "m3"})])
+        self.assertEqual(len(db.commits), 1 + len(db.commits[0])) # The rejected chunk, then write by write
+        self.assertEqual(db.pending_writes, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+api/_unitizer_index.py: shard mapping, the plain-dict index a rebuild writes, the entries a
+concurrent sync adds during a rebuild, and when the audit trusts the index.
+"""
+import os
+import sys
+import unittest
+import zlib
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+from _firestore_codec import decode_value
+from _unitizer_index import (INDEX_SHARDS, INDEX_MAX_AGE_DAYS, shard_id, normalize_code, entries_by_shard,
+                             plain_shards, add_entries, concurrent_entries, read_plain_entries, index_status)
+
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def entry(item_index, data_iso="2026-03-01T10:00"):
+    return {"item_index": item_index, "data_ocorrencia_iso": data_iso}
+
+
+class ShardIdTest(unittest.TestCase):
+    def test_stable_across_processes(self):
+        # crc32, not hash(): the sync and the audit run in different processes
+        self.assertEqual(shard_id("NX123456789BR"), f"shard_{zlib.crc32(b'NX123456789BR') % INDEX_SHARDS:02d}")
+        self.assertEqual(shard_id("AB1"), shard_id("AB1"))
+
+    def test_every_shard_is_used(self):
+        shards = {shard_id(f"NX{n:09d}BR") for n in range(2000)}
+        self.assertEqual(shards, {f"shard_{n:02d}" for n in range(INDEX_SHARDS)})
+
+    def test_normalized_codes(self):
+        self.assertEqual(normalize_code(" nx 123 br "), "NX123BR")
+
+    def test_non_ascii_codes(self):
+        self.assertRegex(shard_id("UNÇ1"), r"^shard_\d\d$")
+
+
+class PlainShardsTest(unittest.TestCase):
+    def test_pending_items_only(self):
+        doc_itens = {
+            "NN1": [{"unitizador": " nx1br "}, {"unitizador": "NX2BR", "correios_match": True}, {"unitizador": ""}],
+            "NN2": [{"unitizador": "NX1BR"}, {"unitizador": "NX3BR", "correios_match": False}],
+        }
+        shards = plain_shards(doc_itens, {"NN1": "2026-03-01T10:00", "NN2": None})
+        self.assertEqual(set(shards), {f"shard_{n:02d}" for n in range(INDEX_SHARDS)}) # Empty shards are written too
+        self.assertEqual(read_plain_entries({"codes": codes} for codes in shards.values()), {
+            "NX1BR": {"NN1": entry(0), "NN2": entry(0, None)}, # Pending in two notas
+            "NX3BR": {"NN2": entry(1, None)},
+        })
+        self.assertIn("NX1BR", shards[shard_id("NX1BR")])
+
+    def test_same_entries_as_the_sync_writes(self):
+        itens = [{"unitizador": f"NX{n}BR", "correios_match": n % 3 == 0} for n in range(40)]
+        fields, paths = {}, []
+        for entries in entries_by_shard("NN1", itens, "2026-03-01T10:00").values():
+            add_entries(fields, entries, paths)
+        synced = {code: {nota: decode_value(value) for nota, value in notas['mapValue']['fields'].items()}
+                  for code, notas in fields['codes']['mapValue']['fields'].items()}
+        rebuilt = read_plain_entries({"codes": codes} for codes in plain_shards({"NN1": itens}, {"NN1": "2026-03-01T10:00"}).values())
+        self.assertEqual(synced, rebuilt)
+        self.assertEqual(len(paths), len(rebuilt))
+
+
+class ConcurrentEntriesTest(unittest.TestCase):
+    def test_added_and_changed_entries(self):
+        loaded = {"A": {"NN1": entry(0)}, "B": {"NN1": entry(1), "NN2": entry(0)}}
+        current = {
+            "A": {"NN1": entry(0), "NN3": entry(2)}, # NN3 synced during the scan
+            "B": {"NN1": entry(1, "2026-03-05T08:00"), "NN2": entry(0)}, # NN1 got a new date
+            "C": {"NN4": entry(0)}, # New code
+        }
+        self.assertEqual(concurrent_entries(loaded, current), {
+            ("A", "NN3"): entry(2), ("B", "NN1"): entry(1, "2026-03-05T08:00"), ("C", "NN4"): entry(0),
+        })
+
+    def test_removed_entries_are_not_restored(self):
+        # An entry removed since the load (a match) is not a concurrent addition
+        self.assertEqual(concurrent_entries({"A": {"NN1": entry(0)}}, {}), {})
+        self.assertEqual(concurrent_entries({"A": {"NN1": entry(0)}}, {"A": {"NN1": entry(0)}}), {})
+
+
+class IndexStatusTest(unittest.TestCase):
+    def rebuilt(self, days_ago):
+        return {"complete": True, "rebuilt_at": (NOW - timedelta(days=days_ago)).replace(tzinfo=None).isoformat() + "Z"}
+
+    def test_incomplete(self):
+        for meta in [{}, {"complete": False, "rebuilt_at": self.rebuilt(0)['rebuilt_at']}, {"complete": "true"}]:
+            self.assertEqual(index_status(meta, NOW), "incomplete")
+
+    def test_current_until_max_age(self):
+        self.assertEqual(index_status(self.rebuilt(0), NOW), "current")
+        self.assertEqual(index_status(self.rebuilt(INDEX_MAX_AGE_DAYS - 0.01), NOW), "current")
+        self.assertEqual(index_status(self.rebuilt(INDEX_MAX_AGE_DAYS + 0.01), NOW), "stale")
+
+    def test_unreadable_rebuild_time_is_stale(self):
+        for rebuilt_at in [None, "", "ontem", 1700000000]:
+            self.assertEqual(index_status({"complete": True, "rebuilt_at": rebuilt_at}, NOW), "stale")
+        self.assertEqual(index_status({"complete": True}, NOW), "stale")
+
+
+if __name__ == '__main__':
+    unittest.main()